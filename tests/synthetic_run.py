@@ -0,0 +1,158 @@
+"""Synthetic BEAM events and trips covering the trip modes handled by the legs parsers."""
+import gzip
+
+import numpy as np
+import pandas as pd
+
+TRANSIT_AGENCY = 'siouxareametro-sd-us'
+
+NUM_BUSES = 5
+
+EVENT_COLUMNS = ['time', 'type', 'person', 'vehicle', 'driver', 'vehicleType', 'length', 'numPassengers',
+                 'departureTime', 'arrivalTime', 'mode', 'links', 'fuelType', 'fuel']
+
+
+def _clock(seconds):
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def _path_traversal(rng, vehicle, driver, vehicle_type, mode, departure_time, duration, links, fuel_type,
+                    num_passengers=0):
+    return dict(time=departure_time + duration, type='PathTraversal', vehicle=vehicle, driver=driver,
+                vehicleType=vehicle_type, length=float(rng.randint(1, 900)), numPassengers=num_passengers,
+                departureTime=departure_time, arrivalTime=departure_time + duration, mode=mode, links=links,
+                fuelType=fuel_type, fuel=float(rng.randint(1, 100)))
+
+
+def _enters_vehicle(time, person, vehicle):
+    return dict(time=time, type='PersonEntersVehicle', person=person, vehicle=vehicle)
+
+
+def make_events(num_persons=60, seed=0):
+    """Generates the events and the trips of `num_persons` persons making 4 trips each.
+
+    The trips mix ride-hail trips (some of which cannot be matched to a single vehicle or path traversal), transit
+    trips (with zero to two bus entries), car and walk trips, and bike trips which none of the parsers handle.
+
+    Returns
+    -------
+    events_df: pandas DataFrame
+        PathTraversal and PersonEntersVehicle events, sorted by time
+    trips_df: pandas DataFrame
+        Trips as parsed from the experienced plans
+    """
+    rng = np.random.RandomState(seed)
+    events = []
+    trips = []
+
+    buses = ['{}:t{}'.format(TRANSIT_AGENCY, i) for i in range(NUM_BUSES)]
+    for bus in buses:
+        time = 20000.
+        while time < 80000:
+            duration = float(rng.randint(60, 400))
+            events.append(_path_traversal(rng, bus, 'TransitDriverAgent-' + bus, 'BUS-DEFAULT', 'bus', time,
+                                          duration, '1,2,3', 'Diesel', int(rng.randint(0, 5))))
+            time += duration + float(rng.randint(0, 30))
+
+    for person in range(num_persons):
+        pid = '%d-abc' % person
+        time = float(rng.randint(20000, 30000))
+        for trip in range(4):
+            mode = rng.choice(['car', 'walk', 'walk_transit', 'drive_transit', 'OnDemand_ride', 'bike'])
+            start_time = time
+            if mode in ('car', 'walk', 'bike'):
+                vehicle = 'car-' + pid if mode == 'car' else 'body-' + pid
+                for _ in range(int(rng.randint(0, 3))):
+                    duration = float(rng.randint(10, 500))
+                    events.append(_enters_vehicle(time, pid, vehicle))
+                    if mode == 'car':
+                        events.append(_path_traversal(rng, vehicle, pid, 'Car', 'car', time, duration, '4,5',
+                                                      'Gasoline'))
+                    else:
+                        events.append(_path_traversal(rng, vehicle, pid, 'BODY', 'walk', time, duration, '4,5',
+                                                      'Food'))
+                    time += duration
+            elif mode == 'OnDemand_ride':
+                duration = float(rng.randint(10, 500))
+                events.append(_enters_vehicle(time, pid, 'body-' + pid))
+                vehicle = 'rideHailVehicle-%s-%d' % (pid, trip)
+                time += 5
+                if rng.random_sample() < 0.85:
+                    events.append(_enters_vehicle(time, pid, vehicle))
+                    if rng.random_sample() < 0.1:
+                        # the person entered another vehicle too: the trip cannot be matched
+                        events.append(_enters_vehicle(time + 1, pid, vehicle + '-2'))
+                if rng.random_sample() < 0.85:
+                    events.append(_path_traversal(rng, vehicle, 'rideHailAgent', 'Car', 'car', float(int(time)),
+                                                  duration, '6,7', 'Gasoline', 1))
+                time += duration
+            else:
+                for _ in range(int(rng.randint(0, 3))):
+                    duration = float(rng.randint(10, 300))
+                    events.append(_path_traversal(rng, 'body-' + pid, pid, 'BODY', 'walk', time, duration, '8',
+                                                  'Food'))
+                    time += duration
+                    events.append(_enters_vehicle(time + 1, pid, buses[rng.randint(0, NUM_BUSES)]))
+                    time += float(rng.randint(100, 2000))
+                duration = float(rng.randint(10, 300))
+                events.append(_path_traversal(rng, 'body-' + pid, pid, 'BODY', 'walk', time, duration, '9', 'Food'))
+                time += duration
+
+            trips.append(dict(PID=pid, Trip_ID=pid + '_t-%d' % (trip + 1),
+                              Origin_Activity_ID=pid + '_a-%d' % (trip + 1),
+                              Destination_activity_ID=pid + '_a-%d' % (trip + 2), Trip_Purpose='Work', Mode=mode,
+                              Start_time=_clock(start_time), Duration_sec=_clock(time - start_time + rng.randint(0, 3)),
+                              Distance_m='1.0', Path_linkIds='1 2'))
+            time += float(rng.randint(100, 3000))
+
+    events_df = pd.DataFrame(events).reindex(columns=EVENT_COLUMNS)
+    return events_df.sort_values('time', kind='mergesort').reset_index(drop=True), pd.DataFrame(trips)
+
+
+def write_run_files(folder, num_persons=30, seed=0):
+    """Writes the output files of a synthetic run to `folder`.
+
+    Returns
+    -------
+    args: tuple
+        The positional arguments of plans_parser.output_parse() reading these files and writing to `folder`
+    """
+    events_df, trips_df = make_events(num_persons, seed)
+    events_df.to_csv(folder / 'events.csv.gz', index=False)
+
+    plans = ['<?xml version="1.0"?><population>']
+    for pid, trips in trips_df.groupby('PID', sort=False):
+        plans.append('<person id="%s"><plan selected="yes">' % pid)
+        for i, trip in enumerate(trips.itertuples()):
+            plans.append('<activity type="%s" link="1" x="1" y="2" end_time="%s"/>'
+                         % ('Home' if i == 0 else trip.Trip_Purpose, trip.Start_time))
+            plans.append('<leg mode="%s" dep_time="%s" trav_time="%s"><route type="links" distance="%s">%s</route>'
+                         '</leg>' % (trip.Mode, trip.Start_time, trip.Duration_sec, trip.Distance_m,
+                                     trip.Path_linkIds))
+        plans.append('<activity type="Home" link="1" x="1" y="2"/></plan></person>')
+    plans.append('</population>')
+    with gzip.open(folder / 'experiencedPlans.xml.gz', 'wt') as file:
+        file.write(''.join(plans))
+
+    pids = trips_df['PID'].unique()
+    with gzip.open(folder / 'outputPlans.xml.gz', 'wt') as file:
+        file.write('<population>' + ''.join(
+            '<person id="%s"><attributes><attribute name="sex">M</attribute><attribute name="age">%d</attribute>'
+            '</attributes><plan selected="yes"><activity type="Home" x="1" y="2"/></plan></person>' % (pid, 20 + i)
+            for i, pid in enumerate(pids)) + '</population>')
+    with gzip.open(folder / 'outputPersonAttributes.xml.gz', 'wt') as file:
+        file.write('<objectAttributes>' + ''.join(
+            '<object id="%s"><attribute name="income">%d</attribute><attribute name="rank">1</attribute></object>'
+            % (pid, 1000 * i) for i, pid in enumerate(pids)) + '</objectAttributes>')
+    with gzip.open(folder / 'outputHouseholds.xml.gz', 'wt') as file:
+        file.write('<households xmlns="http://www.matsim.org/files/dtd">' + ''.join(
+            '<household id="h%d"><members><personId refId="%s"/></members><income>1000</income></household>'
+            % (i, pid) for i, pid in enumerate(pids)) + '</households>')
+
+    fares_df = pd.DataFrame({'agencyId': [217] * 3, 'routeId': [np.nan, 1, 2],
+                             'age': ['[0:120)', '[0:50]', '(10:30)'], 'amount': [1.5, 2.0, 0.5]})
+    trip_to_route = {'t%d' % i: i % 3 for i in range(NUM_BUSES)}
+    fuel_costs = {'gasoline': 0.03, 'diesel': 0.02, 'electricity': 0.01}
+    return (folder / 'events.csv.gz', folder / 'outputPlans.xml.gz', folder / 'outputPersonAttributes.xml.gz',
+            folder / 'outputHouseholds.xml.gz', folder / 'experiencedPlans.xml.gz', fares_df, [0, 1, 2],
+            trip_to_route, fuel_costs, folder)
@@ -0,0 +1,245 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+pytest.importorskip("docker")
+import competition_executor  # noqa: E402
+
+
+@pytest.mark.parametrize("mem_limit, expected", [("4g", 4 * 1024 ** 3), ("4gb", 4 * 1024 ** 3),
+                                                 ("512mb", 512 * 1024 ** 2), ("512M", 512 * 1024 ** 2),
+                                                 (1024, 1024)])
+def test_memory_bytes(mem_limit, expected):
+    assert competition_executor._memory_bytes(mem_limit) == expected
+
+
+class _StartingContainer(object):
+    """Container logging its output directory after a few reads of its logs."""
+
+    def __init__(self, reads_before_config, status="running"):
+        self.reads = 0
+        self.reads_before_config = reads_before_config
+        self.status = status
+
+    def logs(self):
+        self.reads += 1
+        if self.reads <= self.reads_before_config:
+            return b"Starting BEAM\n"
+        return b"Config saved to /output/sioux_faux/sioux_faux-1k__2019-01-01_10-00-00/beam.conf\n"
+
+    def reload(self):
+        pass
+
+
+def test_submission_timestamp_is_read_as_soon_as_logged(monkeypatch):
+    monkeypatch.setattr(competition_executor, "SUBMISSION_LOG_POLL_INTERVAL", 0)
+    container = _StartingContainer(3)
+    assert competition_executor._wait_for_submission_timestamp(container) == "2019-01-01_10-00-00"
+    assert container.reads == 4
+
+
+def test_submission_timestamp_of_stopped_container():
+    with pytest.raises(ValueError):
+        competition_executor._wait_for_submission_timestamp(_StartingContainer(10, status="exited"))
+
+
+class _Tracker(object):
+
+    def __init__(self):
+        self.futures = {}
+
+    def track(self, submission):
+        return self.futures.setdefault(submission, Future())
+
+
+class _SlowExecutor(object):
+    """Executor whose containers take a while to start."""
+
+    def __init__(self):
+        self.completion = _Tracker()
+        self.containers = {}
+        self.starting = 0
+        self.max_starting = 0
+        self._lock = threading.Lock()
+
+    def run_simulation(self, submission_id, **kwargs):
+        with self._lock:
+            self.starting += 1
+            self.max_starting = max(self.max_starting, self.starting)
+        time.sleep(0.2)
+        with self._lock:
+            self.starting -= 1
+        self.containers[submission_id] = submission_id
+
+
+def test_scheduler_starts_containers_concurrently():
+    executor = _SlowExecutor()
+    scheduler = competition_executor.SimulationScheduler(executor, cpu_budget=4, mem_budget="16g")
+    futures = [scheduler.submit("sim{}".format(i), num_cpus=1, mem_limit="4g") for i in range(4)]
+
+    deadline = time.time() + 5
+    while len(executor.completion.futures) < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    assert executor.max_starting > 1
+
+    for submission_id, completion in executor.completion.futures.items():
+        completion.set_result(submission_id)
+    scheduler.shutdown()
+    assert sorted(future.result() for future in futures) == ["sim0", "sim1", "sim2", "sim3"]
+
+
+class _Stream(object):
+    """Docker events stream yielding `events` once `ready` is set, then failing (or blocking) until closed."""
+
+    def __init__(self, events=(), ready=None, fail=False):
+        self.events = list(events)
+        self.ready = ready or threading.Event()
+        self.fail = fail
+        self.closed = threading.Event()
+        if not ready:
+            self.ready.set()
+
+    def __iter__(self):
+        self.ready.wait()
+        for event in self.events:
+            yield event
+        if self.fail:
+            raise ConnectionError("stream reset")
+        self.closed.wait()
+
+    def close(self):
+        self.closed.set()
+
+
+class _Client(object):
+
+    def __init__(self, *streams):
+        self.streams = list(streams)
+
+    def events(self, **kwargs):
+        return self.streams.pop(0)
+
+
+class _Container(object):
+    id = "c1"
+
+
+class _Submission(object):
+
+    def __init__(self, status="running", complete=False):
+        self._container = _Container()
+        self._submission_id = "sim"
+        self._status = status
+        self.complete = complete
+        self.results = "results"
+        self.output_directory = "."
+
+    def is_complete(self):
+        return self.complete
+
+    def status(self):
+        return self._status
+
+
+def test_tracker_subscribes_again_when_the_events_stream_fails(monkeypatch):
+    monkeypatch.setattr(competition_executor, "EVENTS_RECONNECT_DELAY", 0)
+    tracked = threading.Event()
+    die = {"id": "c1", "Actor": {"Attributes": {"exitCode": "137"}}}
+    tracker = competition_executor.CompletionTracker(_Client(_Stream(ready=tracked, fail=True), _Stream([die])))
+    future = tracker.track(_Submission())
+    tracked.set()
+
+    with pytest.raises(RuntimeError, match="exit code 137"):
+        future.result(timeout=5)
+    tracker.close()
+
+
+def test_tracker_checks_the_status_after_subscribing_again(monkeypatch):
+    monkeypatch.setattr(competition_executor, "EVENTS_RECONNECT_DELAY", 0)
+    tracked = threading.Event()
+    tracker = competition_executor.CompletionTracker(_Client(_Stream(ready=tracked, fail=True), _Stream()))
+    submission = _Submission()
+    future = tracker.track(submission)
+    # the container died while the stream was down
+    submission._status = "exited"
+    tracked.set()
+
+    with pytest.raises(RuntimeError):
+        future.result(timeout=5)
+    tracker.close()
+
+
+def test_tracker_runs_callbacks_outside_of_its_lock():
+    tracker = competition_executor.CompletionTracker(_Client(_Stream()))
+    submission = _Submission()
+    future = tracker.track(submission)
+    waited = []
+    future.add_done_callback(lambda _: waited.append(tracker.wait(timeout=0)))
+
+    submission.complete = True
+    tracker._resolve(submission)
+    assert future.result(timeout=0) == "results"
+    assert waited[0][0] == [submission]
+    tracker.close()
+
+
+def _stats(second):
+    return {"read": "2019-01-01T10:00:%02d.5Z" % second,
+            "cpu_stats": {"cpu_usage": {"total_usage": 2 * second}, "system_cpu_usage": 4 * second, "online_cpus": 4},
+            "precpu_stats": {"cpu_usage": {"total_usage": 2 * second - 2}, "system_cpu_usage": 4 * second - 4},
+            "memory_stats": {"usage": 100, "limit": 1000, "stats": {"cache": 10}}}
+
+
+class _StatsContainer(object):
+    """Container streaming `num_samples` stats samples, then empty samples forever."""
+
+    def __init__(self, num_samples, status="exited"):
+        self.num_samples = num_samples
+        self.status = status
+        self.reloads = 0
+
+    def stats(self, stream, decode):
+        for second in range(self.num_samples):
+            yield _stats(second + 1)
+        while True:
+            yield {"read": "0001-01-01T00:00:00Z", "memory_stats": {}}
+
+    def reload(self):
+        self.reloads += 1
+
+
+class _Executor(object):
+
+    def __init__(self, **containers):
+        self.containers = containers
+        self.telemetry = None
+
+
+@pytest.mark.parametrize("num_samples", [0, 5])
+def test_telemetry_stops_with_the_container(tmp_path, num_samples):
+    executor = _Executor(sim=_StatsContainer(num_samples))
+    telemetry = competition_executor.TelemetryCollector(executor, database=str(tmp_path / "telemetry.sqlite"))
+    assert executor.telemetry is telemetry
+
+    telemetry.watch("sim")
+    telemetry.join(timeout=5)
+    assert not telemetry._threads["sim"].is_alive()
+    # the first sample has no previous cpu reading
+    assert len(telemetry.samples("sim")) == max(num_samples - 1, 0)
+    telemetry.close()
+    assert executor.telemetry is None
+
+
+def test_scheduler_rejects_used_submission_ids():
+    executor = _SlowExecutor()
+    executor.containers["previous"] = "previous"
+    scheduler = competition_executor.SimulationScheduler(executor, cpu_budget=1, mem_budget="4g")
+    scheduler.submit("sim0", num_cpus=1, mem_limit="4g")
+    scheduler.submit("sim1", num_cpus=1, mem_limit="4g")
+
+    for submission_id in ["previous", "sim0", "sim1"]:
+        with pytest.raises(ValueError):
+            scheduler.submit(submission_id, num_cpus=1, mem_limit="4g")
+    scheduler.shutdown(wait=False, cancel_queued=True)
@@ -0,0 +1,16 @@
+import pandas as pd
+import pytest
+
+import data_parsing
+
+pytest.importorskip("pyarrow")
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather"])
+def test_path_is_a_flat_list_of_links(tmp_path, output_format):
+    legs_df = pd.DataFrame({'Mode': ['car', 'bus', 'walk'],
+                            'Path': ['1,2,3', ['5250,1648', '1648,5254'], '']})
+    data_parsing.write_dataframe(legs_df, tmp_path, 'legs_dataframe', output_format)
+    paths = data_parsing.read_dataframe(tmp_path, 'legs_dataframe', output_format)['Path']
+
+    assert [list(path) for path in paths] == [['1', '2', '3'], ['5250', '1648', '1648', '5254'], []]
@@ -0,0 +1,95 @@
+import pandas as pd
+import pytest
+
+import plans_parser
+from synthetic_run import NUM_BUSES, make_events
+
+
+def _legs(engine, events_df, trips_df, **kwargs):
+    legs_df, _ = plans_parser.get_legs_output(events_df.copy(), trips_df.copy(), engine=engine, **kwargs)
+    return legs_df
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("engine", ["indexed", "vectorized"])
+def test_engines_match_rowwise(engine, seed):
+    events_df, trips_df = make_events(80, seed)
+    expected = _legs("rowwise", events_df, trips_df)
+
+    assert set(expected["Mode"]) == {"walk", "car", "bus", "OnDemand_ride"}
+    pd.testing.assert_frame_equal(_legs(engine, events_df, trips_df), expected, check_dtype=False,
+                                  check_exact=False, rtol=1e-9)
+
+
+def test_sharded_engine_matches_rowwise():
+    events_df, trips_df = make_events(80, 0)
+    pd.testing.assert_frame_equal(_legs("indexed", events_df, trips_df, n_jobs=2),
+                                  _legs("rowwise", events_df, trips_df), check_dtype=False, check_exact=False,
+                                  rtol=1e-9)
+
+
+@pytest.mark.parametrize("engine", ["indexed", "vectorized"])
+def test_engines_without_trips(engine):
+    events_df, trips_df = make_events(5, 0)
+    legs_df = _legs(engine, events_df, trips_df.iloc[:0])
+    assert len(legs_df) == 0
+    assert list(legs_df.columns) == plans_parser.LEGS_COLUMNS
+
+
+@pytest.mark.parametrize("n_jobs", [0, -1000])
+def test_invalid_n_jobs(n_jobs):
+    events_df, trips_df = make_events(5, 0)
+    with pytest.raises(ValueError):
+        _legs("indexed", events_df, trips_df, n_jobs=n_jobs)
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+@pytest.mark.parametrize("engine", ["indexed", "vectorized"])
+def test_engines_ridehail_diagnostics_match_rowwise(engine, n_jobs):
+    events_df, trips_df = make_events(80, 1)
+    _, _, expected = plans_parser.get_legs_output(events_df.copy(), trips_df.copy(), engine="rowwise",
+                                                  return_diagnostics=True)
+    _, _, diagnostics_df = plans_parser.get_legs_output(events_df.copy(), trips_df.copy(), engine=engine,
+                                                        n_jobs=n_jobs, return_diagnostics=True)
+
+    assert set(expected["reason"]) == set(plans_parser.RIDEHAIL_UNMATCHED_REASONS)
+    pd.testing.assert_frame_equal(diagnostics_df, expected, check_dtype=False)
+    pd.testing.assert_frame_equal(plans_parser.get_ridehail_diagnostics(events_df.copy(), trips_df.copy()), expected,
+                                  check_dtype=False)
+
+
+def test_events_are_not_modified():
+    events_df, trips_df = make_events(20, 0)
+    columns = list(events_df.columns)
+    _, path_traversals_df = plans_parser.get_legs_output(events_df, trips_df.copy())
+
+    assert list(events_df.columns) == columns
+    assert "is_transit" not in path_traversals_df.columns
+
+
+def test_non_bus_transit_legs_are_charged_and_labelled():
+    events_df, trips_df = make_events(40, 0)
+    legs_df, _ = plans_parser.get_legs_output(events_df, trips_df.copy())
+    trips_df = trips_df.copy()
+    legs_df = legs_df.assign(FuelCost=0.0)
+    persons_df = pd.DataFrame({"Age": 30}, index=legs_df["PID"].unique())
+    fares = plans_parser.compile_bus_fares(
+        pd.DataFrame({"agencyId": [217], "routeId": [float("nan")], "age": ["[0:120)"], "amount": [1.5]}), [0])
+    trip_to_route = {"t%d" % i: 0 for i in range(NUM_BUSES)}
+
+    bus_trips = plans_parser.merge_legs_trips(
+        plans_parser.calc_fares(legs_df.copy(), plans_parser.RIDE_HAIL_FARES, fares, persons_df, trip_to_route),
+        trips_df)
+    tram_legs_df = legs_df.assign(Mode=legs_df["Mode"].replace("bus", "tram"))
+    tram_trips = plans_parser.merge_legs_trips(
+        plans_parser.calc_fares(tram_legs_df, plans_parser.RIDE_HAIL_FARES, fares, persons_df, trip_to_route),
+        trips_df)
+
+    pd.testing.assert_series_equal(tram_trips["Fare"], bus_trips["Fare"])
+    pd.testing.assert_series_equal(tram_trips["realizedTripMode"], bus_trips["realizedTripMode"])
+
+
+def test_fuel_costs_of_unknown_fuel_types_are_zero():
+    legs_df = pd.DataFrame({"fuelType": ["Gasoline", "Food", None, "Diesel"], "fuel": [2e6, 5e6, 1e6, 1e6]})
+    costs = plans_parser.calc_fuel_costs(legs_df, {"gasoline": 0.5, "diesel": 2.0})["FuelCost"]
+    assert costs.tolist() == [1.0, 0.0, 0.0, 2.0]
@@ -0,0 +1,67 @@
+import pandas as pd
+import pytest
+
+import plans_parser
+from data_parsing import LIST_COLUMNS
+from synthetic_run import write_run_files
+
+FRAMES = ['persons_df', 'activities_df', 'legs_df', 'path_traversals_df', 'trips_df']
+
+
+def _dtypes(outputs):
+    return {name: (getattr(outputs, name).dtypes.astype(str).to_dict(), str(getattr(outputs, name).index.dtype))
+            for name in FRAMES}
+
+
+@pytest.fixture(scope="module")
+def fresh_dtypes(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("reference")
+    return _dtypes(plans_parser.output_parse(*write_run_files(folder)))
+
+
+@pytest.mark.parametrize("output_format", ["csv", "parquet", "feather"])
+def test_dtypes_do_not_depend_on_format_or_cache(tmp_path, fresh_dtypes, output_format):
+    args = write_run_files(tmp_path)
+    fresh = plans_parser.output_parse(*args, output_format=output_format, incremental=True)
+    cached = plans_parser.output_parse(*args, output_format=output_format, incremental=True)
+
+    assert _dtypes(fresh) == fresh_dtypes
+    assert _dtypes(cached) == fresh_dtypes
+    for name in FRAMES:
+        pd.testing.assert_frame_equal(getattr(cached, name), getattr(fresh, name))
+    for column, name in zip(LIST_COLUMNS, ["legs_df", "trips_df"]):
+        assert getattr(fresh, name)[column].dropna().map(type).eq(list).all()
+
+
+def test_visualized_columns_are_usable(tmp_path):
+    outputs = plans_parser.output_parse(*write_run_files(tmp_path))
+
+    assert outputs.path_traversals_df['vehicleType'].dtype == object
+    for column in ['income', 'Home_X', 'Household_income [$]']:
+        assert pd.api.types.is_numeric_dtype(outputs.persons_df[column])
+    pd.cut(outputs.persons_df['income'], [0, 10000, 100000])
+
+
+@pytest.mark.parametrize("engine, n_jobs", [("vectorized", 1), ("indexed", 2)])
+def test_legs_engine_is_forwarded(tmp_path, engine, n_jobs):
+    args = write_run_files(tmp_path)
+    expected = plans_parser.output_parse(*args, output_format=None)
+    outputs = plans_parser.output_parse(*args, output_format=None, engine=engine, n_jobs=n_jobs)
+
+    for name in FRAMES:
+        pd.testing.assert_frame_equal(getattr(outputs, name), getattr(expected, name), check_exact=False, rtol=1e-9)
+    with pytest.raises(ValueError):
+        plans_parser.output_parse(*args, output_format=None, engine="unknown")
+    with pytest.raises(ValueError):
+        plans_parser.output_parse(*args, output_format=None, n_jobs=0)
+
+
+def test_activities_output_gives_the_purposes_of_every_trip(tmp_path):
+    args = write_run_files(tmp_path)
+    experienced_plans_path = args[4]
+    activities_df, trip_purposes = plans_parser.get_activities_output(experienced_plans_path)
+    expected_activities_df, trips_df = plans_parser.get_activities_trips_output(experienced_plans_path)
+
+    pd.testing.assert_frame_equal(activities_df, expected_activities_df)
+    assert trip_purposes == trips_df["Trip_Purpose"].tolist()
+    assert len(trip_purposes) > len(activities_df["PID"].unique())
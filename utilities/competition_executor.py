@@ -1,12 +1,26 @@
+import calendar
 import docker
+import glob
+import math
 import multiprocessing
+import os
 import pandas as pd
+import re
+import sqlite3
 import sys
+import threading
 import time
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ALL_COMPLETED, Future, ThreadPoolExecutor, wait
 from functools import wraps
 from os import path
 
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
 # TODO: Change to map or parameter
 SCENARIO_NAME = 'sioux_faux'
 
@@ -28,6 +42,54 @@ IMAGE_TAG = "0.0.3-noacc-SNAPSHOT" # Change the latest docker image here
 
 IMAGE_NAME = "{}:{}".format(IMAGE_REPOSITORY, IMAGE_TAG)
 
+# Share of the host memory the scheduler hands out to simulations, the rest is left to the OS and docker daemon
+HOST_MEMORY_FRACTION = 0.9
+
+MEGABYTE = 1024 ** 2
+
+# Share of the container memory given to the JVM heap (-Xmx), the rest is left to the JVM itself and native memory.
+# The initial heap (-Xms) is half of it.
+JVM_HEAP_FRACTION = 0.75
+
+NUMA_NODES_PATTERN = "/sys/devices/system/node/node[0-9]*/cpulist"
+
+# Number of simulation containers a SimulationScheduler starts at the same time
+SCHEDULER_START_THREADS = 4
+
+# Seconds between two reads of the logs of a starting container, and seconds to wait for BEAM to log its output
+# directory
+SUBMISSION_LOG_POLL_INTERVAL = 0.5
+SUBMISSION_START_TIMEOUT = 60
+
+# Seconds between two checks of the score files when watchdog is not installed
+SCORES_POLL_INTERVAL = 5
+
+# Seconds between two checks of the status of the containers of the pending submissions, a backstop of the docker
+# events stream and of watchdog
+STATUS_POLL_INTERVAL = 60
+
+# Seconds to wait before subscribing again to the docker events stream once it failed
+EVENTS_RECONNECT_DELAY = 1
+
+WAIT_CONDITIONS = {'any': FIRST_COMPLETED, 'all': ALL_COMPLETED}
+
+# Size and number of the files a LogTail rotates its log file through
+LOG_MAX_BYTES = 50 * 1024 ** 2
+LOG_BACKUP_COUNT = 5
+
+# BEAM log markers of the progress of a simulation
+ITERATION_START_MARKER = "Starting Iteration"
+ITERATION_END_MARKER = "Ending Iteration"
+ITERATION_EXECUTED_PATTERN = re.compile(r"Iteration (\d+) executed in (\d+) seconds")
+
+TELEMETRY_DATABASE = "telemetry.sqlite"
+
+# Number of stats samples of a container written to the telemetry database at once
+TELEMETRY_BATCH_SIZE = 30
+
+TELEMETRY_COLUMNS = ['submission_id', 'scenario_name', 'sample_size', 'time', 'cpus', 'rss_bytes', 'mem_limit_bytes',
+                     'blkio_read_bytes', 'blkio_write_bytes', 'net_rx_bytes', 'net_tx_bytes']
+
 
 def lazy_property(fn):
     """Decorator that makes a property lazy-evaluated.
@@ -135,11 +197,8 @@ class Submission(object):
                  sample_size,
                  num_iterations,
                  container):
-        # Delay initialization in order to get timestamp
-        time.sleep(10)
-        log = container.logs()
         self._submission_id = submission_id
-        self._timestamp = _get_submission_timestamp_from_log(log.decode('utf-8'))
+        self._timestamp = _wait_for_submission_timestamp(container)
         self.num_iterations = num_iterations
         self.sample_size = sample_size
         self.scenario_name = scenario_name
@@ -158,8 +217,8 @@ class Submission(object):
     def name(self):
         return self._container.name
 
-    def logs(self):
-        return self._container.logs()
+    def logs(self, **kwargs):
+        return self._container.logs(**kwargs)
 
     def stop(self):
         self._container.stop()
@@ -168,7 +227,7 @@ class Submission(object):
         self._container.remove()
 
     def status(self):
-        self._container.update()
+        self._container.reload()
         return self._container.status
 
     def reload(self):
@@ -230,9 +289,11 @@ class Submission(object):
 
         """
 
-        path_submission_scores = path.join(self.output_directory, SUBMISSION_SCORES_DIR, SUBMISSION_SCORES_FILE)
-        print(path_submission_scores)
-        return path.exists(path_submission_scores)
+        return path.exists(self.scores_path)
+
+    @property
+    def scores_path(self):
+        return path.join(self.output_directory, SUBMISSION_SCORES_DIR, SUBMISSION_SCORES_FILE)
 
     def __str__(self):
         return "Submission_id: {}\n\t Scenario name: {}\n\t # iters: {}\n\t sample size: {}".format(self._submission_id,
@@ -273,6 +334,557 @@ def _get_submission_timestamp_from_log(log):
         raise ValueError("No timestamp found for submission. Error running submission!")
 
 
+def _wait_for_submission_timestamp(container, timeout=SUBMISSION_START_TIMEOUT):
+    """Reads the logs of a starting container until BEAM logged its output directory, and returns the timestamp of
+    the directory.
+
+    Raises
+    ------
+    ValueError
+        If the container stopped, or the timeout elapsed, before the output directory was logged.
+
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return _get_submission_timestamp_from_log(container.logs().decode('utf-8'))
+        except ValueError:
+            container.reload()
+            if container.status not in ('created', 'running') or time.time() >= deadline:
+                raise
+        time.sleep(SUBMISSION_LOG_POLL_INTERVAL)
+
+
+def _log_timestamp(timestamp):
+    """Converts the RFC 3339 timestamp docker prefixes the log lines with to a (seconds, nanoseconds) tuple.
+
+    """
+    seconds, _, fraction = timestamp.rstrip('Z').partition('.')
+    seconds = calendar.timegm(time.strptime(seconds[:19], "%Y-%m-%dT%H:%M:%S"))
+    return seconds, int(fraction.ljust(9, '0')[:9] or 0)
+
+
+def _append_rotating(filename, text, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+    """Appends text to a file, first moving the file to filename.1 (and so on up to backup_count) if it would
+    grow beyond max_bytes.
+
+    """
+    data = text.encode('utf-8')
+    if path.exists(filename) and path.getsize(filename) + len(data) > max_bytes:
+        for i in range(backup_count - 1, 0, -1):
+            if path.exists("{}.{}".format(filename, i)):
+                os.replace("{}.{}".format(filename, i), "{}.{}".format(filename, i + 1))
+        os.replace(filename, "{}.1".format(filename))
+    with open(filename, 'ab') as f:
+        f.write(data)
+
+
+class SimulationProgress(object):
+    """Progress of a simulation, as read from the iteration markers of its logs.
+
+    Parameters
+    ----------
+    num_iterations : int, optional
+        Number of iterations the simulation was started with (BEAM runs the iterations 0 to num_iterations)
+
+    """
+
+    def __init__(self, num_iterations=None):
+        self.num_iterations = num_iterations
+        self.iterations_started = 0
+        self.iterations_completed = 0
+        self.last_iteration_seconds = None
+
+    def update(self, line):
+        if ITERATION_START_MARKER in line:
+            self.iterations_started += 1
+        elif ITERATION_END_MARKER in line:
+            self.iterations_completed += 1
+        else:
+            executed = ITERATION_EXECUTED_PATTERN.search(line)
+            if executed is not None:
+                self.last_iteration_seconds = int(executed.group(2))
+
+    @property
+    def iteration(self):
+        """Index of the iteration currently running (or last run), None before the first one starts.
+
+        """
+        return self.iterations_started - 1 if self.iterations_started else None
+
+    def __str__(self):
+        if self.iteration is None:
+            return "not started"
+        total = "?" if self.num_iterations is None else self.num_iterations
+        return "iteration {} of {} ({} completed)".format(self.iteration, total, self.iterations_completed)
+
+
+class LogTail(object):
+    """Reads the logs of a simulation container incrementally, remembering how far they were read.
+
+    Each read only asks docker for the log lines written since the last one read, appends them to a rotating log file
+    if one is given and updates the progress of the simulation from its iteration markers.
+
+    Resuming is timestamp-based: docker logs cannot be read from a byte offset, so the timestamp of the last line read
+    is passed as `since` and the lines of that second which were already read are skipped.
+
+    Parameters
+    ----------
+    container : Submission or docker.models.containers.Container
+        Simulation whose logs are read
+    num_iterations : int, optional
+        Number of iterations the simulation was started with
+    filename : str, optional
+        Log file to which the new log lines are appended
+    max_bytes : int
+        Size from which the log file is rotated
+    backup_count : int
+        Number of rotated log files kept
+
+    """
+
+    def __init__(self, container, num_iterations=None, filename=None, max_bytes=LOG_MAX_BYTES,
+                 backup_count=LOG_BACKUP_COUNT):
+        self.container = container
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.progress = SimulationProgress(num_iterations)
+        self._last_timestamp = None
+
+    def read(self):
+        """Returns the log lines written since the last read (the whole log on the first read).
+
+        """
+        since = None if self._last_timestamp is None else self._last_timestamp[0]
+        logs = self.container.logs(timestamps=True, since=since).decode('utf-8')
+        return self._consume(logs.splitlines(True))
+
+    def follow(self):
+        """Generates the new log lines as they are written, until the container stops.
+
+        """
+        since = None if self._last_timestamp is None else self._last_timestamp[0]
+        partial = ''
+        for chunk in self.container.logs(stream=True, follow=True, timestamps=True, since=since):
+            lines = (partial + chunk.decode('utf-8')).splitlines(True)
+            partial = lines.pop() if lines and not lines[-1].endswith('\n') else ''
+            text = self._consume(lines)
+            if text:
+                yield text
+        if partial:
+            yield self._consume([partial])
+
+    def _consume(self, lines):
+        """Strips the docker timestamps of the log lines not read yet, and records them.
+
+        """
+        new_lines = []
+        for line in lines:
+            timestamp, _, message = line.partition(' ')
+            timestamp = _log_timestamp(timestamp)
+            # `since` has a one second resolution, so the lines of that second that were already read come again
+            if self._last_timestamp is not None and timestamp <= self._last_timestamp:
+                continue
+            self._last_timestamp = timestamp
+            self.progress.update(message)
+            new_lines.append(message)
+
+        text = ''.join(new_lines)
+        if text and self.filename is not None:
+            _append_rotating(self.filename, text, self.max_bytes, self.backup_count)
+        return text
+
+
+def _stats_sample(stats):
+    """Extracts the cpu, memory, block I/O and network use of a container from one docker stats sample.
+
+    CPU use is in number of cpus (i.e. 1.5 for one and a half cores fully used), the resident memory excludes the page
+    cache and the block I/O and network figures are cumulated since the container started.
+
+    """
+    cpu, precpu = stats['cpu_stats'], stats.get('precpu_stats', {})
+    cpu_delta = cpu['cpu_usage']['total_usage'] - precpu.get('cpu_usage', {}).get('total_usage', 0)
+    system_delta = cpu.get('system_cpu_usage', 0) - precpu.get('system_cpu_usage', 0)
+    online_cpus = cpu.get('online_cpus') or len(cpu['cpu_usage'].get('percpu_usage') or [1])
+    cpus = cpu_delta / system_delta * online_cpus if system_delta > 0 else 0.0
+
+    memory = stats.get('memory_stats', {})
+    # cgroup v1 reports the page cache as "cache", cgroup v2 as "inactive_file"
+    cache = memory.get('stats', {}).get('cache', memory.get('stats', {}).get('inactive_file', 0))
+    rss = memory.get('usage', 0) - cache
+
+    blkio = {'read': 0, 'write': 0}
+    for entry in (stats.get('blkio_stats', {}).get('io_service_bytes_recursive') or []):
+        op = entry['op'].lower()
+        if op in blkio:
+            blkio[op] += entry['value']
+
+    networks = (stats.get('networks') or {}).values()
+    seconds, nanoseconds = _log_timestamp(stats['read'])
+    return (seconds + nanoseconds * 1e-9, cpus, rss, memory.get('limit'), blkio['read'], blkio['write'],
+            sum(n['rx_bytes'] for n in networks), sum(n['tx_bytes'] for n in networks))
+
+
+def _is_running(container):
+    """Whether a container is still running (False if it was removed).
+
+    """
+    try:
+        container.reload()
+    except docker.errors.NotFound:
+        return False
+    return container.status == 'running'
+
+
+class TelemetryCollector(object):
+    """Records the resource use of simulation containers in a SQLite database, to size their num_cpus and mem_limit.
+
+    Each watched submission gets a thread consuming its docker stats stream until its container stops. The samples
+    (cpu, resident memory, block I/O and network) are written in batches to the container_stats table of the
+    database.
+
+    Parameters
+    ----------
+    executor : CompetitionContainerExecutor
+        Executor whose submissions are watched
+    database : str
+        Path of the SQLite database
+    sample_every : int
+        Keep one docker stats sample (taken every second) out of sample_every
+    watch_new : bool
+        Whether to also watch every simulation the executor starts from now on (with run_simulation(), directly or
+        from a SimulationScheduler), until the collector is closed
+
+    """
+
+    def __init__(self, executor, database=TELEMETRY_DATABASE, sample_every=1, watch_new=True):
+        self.executor = executor
+        self.database = database
+        self.sample_every = sample_every
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(database, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS container_stats ({})".format(
+            ", ".join(TELEMETRY_COLUMNS)))
+        self._connection.execute("CREATE INDEX IF NOT EXISTS container_stats_submission "
+                                 "ON container_stats (submission_id)")
+        self._connection.commit()
+        if watch_new:
+            executor.telemetry = self
+
+    def watch(self, sim_name):
+        """Starts recording the resource use of a simulation, until its container stops.
+
+        Parameters
+        ----------
+        sim_name : str
+            Name of the simulation in the executor
+
+        """
+        if sim_name in self._threads and self._threads[sim_name].is_alive():
+            return
+        container = self.executor.containers[sim_name]
+        thread = threading.Thread(target=self._record, args=(sim_name, container),
+                                  name="telemetry-{}".format(sim_name), daemon=True)
+        self._threads[sim_name] = thread
+        thread.start()
+
+    def watch_all(self):
+        """Starts recording the resource use of all the running simulations of the executor.
+
+        """
+        for sim_name in self.executor.list_running_simulations():
+            self.watch(sim_name)
+
+    def join(self, timeout=None):
+        """Blocks until the containers of all the watched simulations stopped.
+
+        """
+        for thread in list(self._threads.values()):
+            thread.join(timeout)
+
+    def samples(self, submission_id=None):
+        """Reads the recorded samples.
+
+        Parameters
+        ----------
+        submission_id : str, optional
+            Only reads the samples of this simulation (all the samples if None)
+
+        Returns
+        -------
+        pandas DataFrame
+            Time series of the resource use of the simulations (one row per sample)
+
+        """
+        query = "SELECT * FROM container_stats"
+        params = ()
+        if submission_id is not None:
+            query += " WHERE submission_id = ?"
+            params = (submission_id,)
+        with self._lock:
+            return pd.read_sql_query(query + " ORDER BY submission_id, time", self._connection, params=params)
+
+    def summary(self):
+        """Summarizes the peak and average resource use of the simulations per scenario and sample size.
+
+        Returns
+        -------
+        pandas DataFrame
+            Indexed by scenario_name and sample_size: number of simulations, peak and average cpus and resident
+            memory of the simulations, and the largest block I/O and network traffic of a simulation
+
+        """
+        query = """SELECT submission_id, scenario_name, sample_size,
+                          MAX(cpus) AS peak_cpus, AVG(cpus) AS avg_cpus,
+                          MAX(rss_bytes) AS peak_rss_bytes, AVG(rss_bytes) AS avg_rss_bytes,
+                          MAX(blkio_read_bytes) AS blkio_read_bytes, MAX(blkio_write_bytes) AS blkio_write_bytes,
+                          MAX(net_rx_bytes) AS net_rx_bytes, MAX(net_tx_bytes) AS net_tx_bytes
+                   FROM container_stats GROUP BY submission_id, scenario_name, sample_size"""
+        with self._lock:
+            per_submission = pd.read_sql_query(query, self._connection)
+        return per_submission.groupby(['scenario_name', 'sample_size']).agg({
+            'submission_id': 'count',
+            'peak_cpus': 'max', 'avg_cpus': 'mean',
+            'peak_rss_bytes': 'max', 'avg_rss_bytes': 'mean',
+            'blkio_read_bytes': 'max', 'blkio_write_bytes': 'max',
+            'net_rx_bytes': 'max', 'net_tx_bytes': 'max'}).rename(columns={'submission_id': 'simulations'})
+
+    def close(self):
+        if getattr(self.executor, 'telemetry', None) is self:
+            self.executor.telemetry = None
+        with self._lock:
+            self._connection.close()
+
+    def _write(self, rows):
+        with self._lock:
+            self._connection.executemany("INSERT INTO container_stats VALUES ({})".format(
+                ", ".join("?" * len(TELEMETRY_COLUMNS))), rows)
+            self._connection.commit()
+
+    def _record(self, sim_name, container):
+        # Submissions know their scenario, containers found from a previous session do not
+        labels = (sim_name, getattr(container, 'scenario_name', None), getattr(container, 'sample_size', None))
+        container = getattr(container, '_container', container)
+        rows = []
+        running = False
+        for i, stats in enumerate(container.stats(stream=True, decode=True)):
+            # The samples of a stopped container are empty, and docker keeps streaming them
+            if not stats.get('memory_stats'):
+                if running or not _is_running(container):
+                    break
+                continue
+            running = True
+            # The first sample has no previous cpu reading
+            if i == 0 or i % self.sample_every:
+                continue
+            rows.append(labels + _stats_sample(stats))
+            if len(rows) >= TELEMETRY_BATCH_SIZE:
+                self._write(rows)
+                rows = []
+        if rows:
+            self._write(rows)
+
+
+class _ScoresFileHandler(object):
+    """watchdog event handler resolving a submission as soon as its score file is written.
+
+    """
+
+    def __init__(self, tracker, submission):
+        self.tracker = tracker
+        self.submission = submission
+
+    def dispatch(self, event):
+        written = getattr(event, 'dest_path', None) or event.src_path
+        if path.basename(written) == SUBMISSION_SCORES_FILE:
+            self.tracker._resolve(self.submission)
+
+
+class CompletionTracker(object):
+    """Tracks the completion of submissions from a single subscription to the docker events stream.
+
+    A submission is complete when its competition/submissionScores.csv file is written, which is watched on the
+    filesystem (with watchdog if installed, else with a cheap periodic check of the file), or when its container dies.
+    The events stream is subscribed again if it fails, and the status of the pending submissions is checked every
+    STATUS_POLL_INTERVAL seconds in case an event was missed. Each tracked submission gets a Future resolving to its
+    Results, or to an error if its container died before the scores were written.
+
+    Parameters
+    ----------
+    client : docker.DockerClient
+        Client of the docker daemon running the simulations
+
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._futures = {}
+        self._submissions = {}
+        self._resolved = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        # Subscribe before any submission is tracked, so that no die event can be missed
+        self._events = self._subscribe()
+        threading.Thread(target=self._listen_events, name="completion-events", daemon=True).start()
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.daemon = True
+            self._observer.start()
+        else:
+            self._observer = None
+        threading.Thread(target=self._poll, name="completion-poll", daemon=True).start()
+
+    def track(self, submission):
+        """Starts tracking the completion of a submission.
+
+        Parameters
+        ----------
+        submission : Submission
+            Submission started by a CompetitionContainerExecutor
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the Results of the submission once it is complete
+
+        """
+        container_id = submission._container.id
+        with self._lock:
+            if container_id in self._futures:
+                return self._futures[container_id]
+            future = Future()
+            future.set_running_or_notify_cancel()
+            self._futures[container_id] = future
+            self._submissions[container_id] = submission
+        if self._observer is not None:
+            # BEAM has created the output directory by the time the submission knows it
+            self._observer.schedule(_ScoresFileHandler(self, submission), submission.output_directory,
+                                    recursive=True)
+        # The scores may have been written, or the container stopped, before the tracking started
+        if submission.is_complete() or submission.status() in ('exited', 'dead'):
+            self._resolve(submission)
+        return future
+
+    def future(self, submission):
+        """Returns the Future of a tracked submission.
+
+        """
+        return self._futures[submission._container.id]
+
+    def wait(self, submissions=None, return_when='all', timeout=None):
+        """Blocks until any or all of the tracked submissions are complete.
+
+        Parameters
+        ----------
+        submissions : list of Submission, optional
+            Submissions to wait for (all the tracked submissions if None)
+        return_when : str
+            "any" to return as soon as one of the submissions is complete, "all" to wait for all of them
+        timeout : float, optional
+            Maximum number of seconds to wait (no limit if None)
+
+        Returns
+        -------
+        Tuple(list, list)
+            [0] Submissions that are complete, and;
+            [1] submissions that are still running.
+
+        """
+        if return_when not in WAIT_CONDITIONS:
+            raise ValueError("return_when must be one of {}.".format(list(WAIT_CONDITIONS)))
+        with self._lock:
+            if submissions is None:
+                submissions = list(self._submissions.values())
+            futures = {self._futures[submission._container.id]: submission for submission in submissions}
+        done, not_done = wait(futures, timeout=timeout, return_when=WAIT_CONDITIONS[return_when])
+        return [futures[f] for f in done], [futures[f] for f in not_done]
+
+    def close(self):
+        """Ends the docker events subscription and the score files watch.
+
+        """
+        self._closed = True
+        self._events.close()
+        if self._observer is not None:
+            self._observer.stop()
+
+    def _resolve(self, submission, exit_code=None):
+        """Sets the result of a submission whose scores were written or whose container died.
+
+        The files and the container are checked, and the callbacks of the future run, outside of the lock.
+
+        """
+        container_id = submission._container.id
+        with self._lock:
+            future = self._futures.get(container_id)
+            if future is None or container_id in self._resolved:
+                return
+        complete = submission.is_complete()
+        if not complete and exit_code is None and submission.status() not in ('exited', 'dead'):
+            return
+        with self._lock:
+            # the submission may have been resolved from another thread in the meantime
+            if container_id in self._resolved:
+                return
+            self._resolved.add(container_id)
+        if complete:
+            future.set_result(submission.results)
+        else:
+            future.set_exception(RuntimeError(
+                "Simulation {0} stopped before writing its scores (exit code {1}).".format(
+                    submission._submission_id, exit_code)))
+
+    def _pending(self):
+        with self._lock:
+            return [self._submissions[container_id] for container_id in self._futures
+                    if container_id not in self._resolved]
+
+    def _subscribe(self):
+        return self.client.events(decode=True, filters={'type': 'container', 'event': 'die'})
+
+    def _listen_events(self):
+        while not self._closed:
+            try:
+                for event in self._events:
+                    submission = self._submissions.get(event.get('id'))
+                    if submission is not None:
+                        self._resolve(submission, event['Actor']['Attributes'].get('exitCode'))
+            except Exception as e:
+                # The stream raises once it is closed
+                if self._closed:
+                    return
+                print("The docker events stream failed ({0}), subscribing again.".format(e))
+            while not self._closed:
+                time.sleep(EVENTS_RECONNECT_DELAY)
+                try:
+                    self._events = self._subscribe()
+                    break
+                except Exception as e:
+                    print("Could not subscribe to the docker events stream ({0}).".format(e))
+            if self._closed:
+                self._events.close()
+                return
+            # Containers may have died while the stream was down
+            for submission in self._pending():
+                self._resolve(submission)
+
+    def _poll(self):
+        # Checks the score files every SCORES_POLL_INTERVAL seconds if watchdog is not installed, and the status of
+        # the containers every STATUS_POLL_INTERVAL seconds
+        interval = STATUS_POLL_INTERVAL if self._observer is not None else SCORES_POLL_INTERVAL
+        last_status_check = time.time()
+        while not self._closed:
+            time.sleep(interval)
+            check_status = time.time() - last_status_check >= STATUS_POLL_INTERVAL
+            if check_status:
+                last_status_check = time.time()
+            for submission in self._pending():
+                if check_status or submission.is_complete():
+                    self._resolve(submission)
+
+
 class AbstractCompetitionExecutor(ABC):
     """ Factors the common methods used by subclasses running instances of the simulation with different
     executors (e.g. Docker, Gradle...)
@@ -358,6 +970,16 @@ class CompetitionContainerExecutor(AbstractCompetitionExecutor):
         super().__init__(input_root, output_root)
         self.client = docker.from_env()
         self.containers = self.find_existing_simulation_containers()
+        self.log_tails = {}
+        # TelemetryCollector watching the simulations started from now on, if any
+        self.telemetry = None
+
+    @lazy_property
+    def completion(self):
+        """CompletionTracker of the submissions run by this executor.
+
+        """
+        return CompletionTracker(self.client)
 
     def find_existing_simulation_containers(self):
         all_containers = self.client.containers.list(all=True)
@@ -385,26 +1007,24 @@ class CompetitionContainerExecutor(AbstractCompetitionExecutor):
 
     @verify_submission_id
     def find_last_completed_simulation_path(self, submission_id):
-        lines = self.output_simulation_logs(submission_id).split("\n")
-        # .decode("utf-8")
-
-        for line in lines:
-            if "Beam output directory is" not in line:
-                words = line.split(' ')
-                output_dir = words[-1]
-                timestamp = output_dir.split('/')[-1].split('__')[-1]
-                # assumes simulation params stay the same
-                simulation_output_root = path.join(self.output_root, SCENARIO_NAME,
-                                                   "{}-{}__{}".format(SCENARIO_NAME, SAMPLE_SIZES[0], timestamp))
-                #print(simulation_output_root)
-                score_path = path.join(simulation_output_root, "competition", "submissionScores.csv")
-                print(score_path)
-                if score_path is not None and path.exists(path):
-                    return score_path
-                else:
-                    # don't keep going... there is nothing else to find here.
+        container = self.containers[submission_id]
+        if isinstance(container, Submission):
+            score_path = container.scores_path
+        else:
+            # Containers found from a previous session only know their output directory from their logs
+            score_path = None
+            for line in container.logs().decode('utf-8').split("\n"):
+                if "Beam output directory is" in line:
+                    output_dir = line.split(' ')[-1]
+                    timestamp = output_dir.split('/')[-1].split('__')[-1]
+                    # assumes simulation params stay the same
+                    simulation_output_root = path.join(self.output_root, SCENARIO_NAME,
+                                                       "{}-{}__{}".format(SCENARIO_NAME, SAMPLE_SIZES[0], timestamp))
+                    score_path = path.join(simulation_output_root, *SCORES_PATH)
                     break
 
+        if score_path is not None and path.exists(score_path):
+            return score_path
         return "Simulation run not completed!"
 
     @verify_submission_id
@@ -498,6 +1118,7 @@ class CompetitionContainerExecutor(AbstractCompetitionExecutor):
     def output_simulation_logs(self, sim_name, filename=None):
         """Prints a specified simulation log or writes to file if filename is provided.
 
+        The whole log is fetched on every call, see tail_simulation_logs() to only read the new log lines.
 
         Parameters
         ----------
@@ -521,6 +1142,63 @@ class CompetitionContainerExecutor(AbstractCompetitionExecutor):
                 f.write(logs)
         return logs
 
+    def _log_tail(self, sim_name):
+        if sim_name not in self.log_tails:
+            container = self.containers[sim_name]
+            self.log_tails[sim_name] = LogTail(container, getattr(container, 'num_iterations', None))
+        return self.log_tails[sim_name]
+
+    @verify_submission_id
+    def tail_simulation_logs(self, sim_name, filename=None, follow=False):
+        """Returns the log lines of a simulation written since the last call (the whole log on the first call).
+
+        Unlike output_simulation_logs(), only the new log lines are requested from docker, which keeps monitoring
+        loops cheap on long simulations. The progress of the simulation is updated along the way (see
+        simulation_progress()).
+
+        Parameters
+        ----------
+        sim_name : str
+            Name of the the requested simulation
+        filename : str, optional
+            A path of a rotating log file to which the new log lines are appended
+        follow : bool
+            Whether to generate the new log lines as they are written, until the simulation stops
+
+        Returns
+        -------
+        str or generator of str
+            New log lines
+
+        """
+        log_tail = self._log_tail(sim_name)
+        if filename is not None:
+            log_tail.filename = filename
+        return log_tail.follow() if follow else log_tail.read()
+
+    def simulation_progress(self, sim_names=None):
+        """Reads the new log lines of the running simulations to report their progress.
+
+        Parameters
+        ----------
+        sim_names : list of str, optional
+            Names of the simulations (all the running simulations if None)
+
+        Returns
+        -------
+        dict
+            Maps the simulation names to their SimulationProgress
+
+        """
+        if sim_names is None:
+            sim_names = self.list_running_simulations()
+        progress = {}
+        for sim_name in sim_names:
+            log_tail = self._log_tail(sim_name)
+            log_tail.read()
+            progress[sim_name] = log_tail.progress
+        return progress
+
     @verify_submission_id
     def check_if_submission_complete(self, sim_name):
         """ Checks if a given submission is complete.
@@ -540,6 +1218,46 @@ class CompetitionContainerExecutor(AbstractCompetitionExecutor):
 
         return self.containers[sim_name].is_complete()
 
+    def wait(self, submission_ids=None, return_when='all', timeout=None):
+        """Blocks until any or all of the given submissions are complete.
+
+        Completion is followed from the docker events and the score files of the submissions (see
+        CompletionTracker), so waiting on many submissions does not read their logs.
+
+        Parameters
+        ----------
+        submission_ids : list of str, optional
+            Identifiers of the submissions to wait for (all the submissions run by this executor if None)
+        return_when : str
+            "any" to return as soon as one of the submissions is complete, "all" to wait for all of them
+        timeout : float, optional
+            Maximum number of seconds to wait (no limit if None)
+
+        Returns
+        -------
+        Tuple(list, list)
+            [0] Identifiers of the submissions that are complete, and;
+            [1] identifiers of the submissions that are still running.
+
+        Raises
+        ------
+        ValueError
+            If one of the submissions was not executed using this interface.
+
+        """
+        if submission_ids is None:
+            submission_ids = [name for name, c in self.containers.items() if isinstance(c, Submission)]
+        submissions = []
+        for submission_id in submission_ids:
+            submission = self.containers.get(submission_id)
+            if not isinstance(submission, Submission):
+                raise ValueError("Container {0} not executed using this interface.".format(submission_id))
+            self.completion.track(submission)
+            submissions.append(submission)
+
+        done, not_done = self.completion.wait(submissions, return_when, timeout)
+        return [s._submission_id for s in done], [s._submission_id for s in not_done]
+
     def run_simulation(self,
                        submission_id,
                        submission_output_root=None,
@@ -547,15 +1265,17 @@ class CompetitionContainerExecutor(AbstractCompetitionExecutor):
                        scenario_name=SCENARIO_NAME,
                        sample_size=SAMPLE_SIZES[0],
                        num_iterations=1,
-                       num_cpus=multiprocessing.cpu_count() - 1,
-                       mem_limit="4g"):
+                       num_cpus=max(1, multiprocessing.cpu_count() - 1),
+                       mem_limit="4g",
+                       cpuset_cpus=None):
         """Creates a new container running an Uber Prize competition simulation on a specified set of inputs.
 
         Containers are run in a background process (detached mode), so several containers can be run in parallel
-        (though this is a loose and uncoordinated parallelism and is very experimental! Future updates are
-        planned to scale execution out over compute nodes).
+        (though this is a loose and uncoordinated parallelism, use a SimulationScheduler to queue many simulations
+        within the cpu and memory of the host).
 
-        This utility adds the container to the list of containers managed by this object.
+        This utility adds the container to the list of containers managed by this object, and to the simulations
+        watched by its TelemetryCollector if any (see TelemetryCollector).
 
         Parameters
         ----------
@@ -572,17 +1292,23 @@ class CompetitionContainerExecutor(AbstractCompetitionExecutor):
         num_iterations : int
             Number of iterations for which to run the BEAM simulation engine.
         num_cpus : float
-            Number of cpus to allocate to container (multiprocessing.cpu_count()-1 by default).
-            (not currently used).
-        mem_limit : int
-            Adds a maximum memory constraint to execution. Concretely, sets the Java parameter -Xmx{}.
+            Number of cpus to allocate to container (multiprocessing.cpu_count()-1 by default, at least 1).
+            Enforced by docker as a cpu quota.
+        mem_limit : int or str
+            Maximum memory of the container (without swap), i.e "4g". The JVM heap is sized from it: -Xmx is
+            JVM_HEAP_FRACTION of the limit and -Xms half of that.
+        cpuset_cpus : str, optional
+            Cpus to pin the container to, i.e "0-3" or "0,2,4,6" (see CpusetAllocator).
 
         Raises
         ------
         ValueError
-            If the output location or input location are nowhere specified (either here on object instantiation).
+            If the output location or input location are nowhere specified (either here on object instantiation), or
+            if num_cpus is not positive (docker would not limit the cpus of the container).
 
         """
+        if int(num_cpus * 1e9) <= 0:
+            raise ValueError("num_cpus must be positive, got {}.".format(num_cpus))
         output_root = self.output_root
         input_root = ''
         #self.input_root
@@ -604,8 +1330,11 @@ class CompetitionContainerExecutor(AbstractCompetitionExecutor):
         #            "on object instantiation or supplied to this method as an argument.")
 
         container = self.client.containers.run(IMAGE_NAME,
-                                               cpu_count=num_cpus,
-
+                                               nano_cpus=int(num_cpus * 1e9),
+                                               cpuset_cpus=cpuset_cpus,
+                                               mem_limit=mem_limit,
+                                               memswap_limit=mem_limit,
+                                               environment={"JAVA_OPTS": _jvm_heap_options(mem_limit)},
                                                name=submission_id,
                                                command=r"--scenario {0} --sample-size {1} --iters {2}".format(
                                                    scenario_name, sample_size, num_iterations),
@@ -622,6 +1351,349 @@ class CompetitionContainerExecutor(AbstractCompetitionExecutor):
                                                     sample_size,
                                                     num_iterations,
                                                     container)
+        self.completion.track(self.containers[submission_id])
+        if self.telemetry is not None:
+            self.telemetry.watch(submission_id)
+
+
+def _memory_bytes(mem_limit):
+    """Converts a docker memory limit (number of bytes or string such as "4g" or "512mb") to a number of bytes, as
+    docker does.
+
+    """
+    return int(docker.utils.parse_bytes(mem_limit))
+
+
+def _jvm_heap_options(mem_limit):
+    """JVM options sizing the heap of a simulation to the memory limit of its container.
+
+    """
+    max_heap = int(_memory_bytes(mem_limit) * JVM_HEAP_FRACTION) // MEGABYTE
+    return "-Xmx{}m -Xms{}m".format(max_heap, max_heap // 2)
+
+
+def _parse_cpulist(cpulist):
+    """Parses a Linux cpu list such as "0-3,8-11" into the list of cpus.
+
+    """
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if part:
+            first, _, last = part.partition('-')
+            cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _numa_nodes():
+    """Lists the cpus of each NUMA node of this machine (a single node with all the cpus if unknown).
+
+    """
+    nodes = []
+    for cpulist in sorted(glob.glob(NUMA_NODES_PATTERN)):
+        with open(cpulist) as f:
+            cpus = _parse_cpulist(f.read())
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [list(range(multiprocessing.cpu_count()))]
+
+
+class CpusetAllocator(object):
+    """Hands out disjoint sets of cpus to pin concurrent simulations to, keeping each set on one NUMA node when
+    possible.
+
+    The topology is read from this machine, so the docker daemon should run locally.
+
+    Parameters
+    ----------
+    nodes : list of list of int, optional
+        Cpus of each NUMA node (read from /sys if None)
+
+    """
+
+    def __init__(self, nodes=None):
+        self.nodes = _numa_nodes() if nodes is None else nodes
+        self._free = [set(cpus) for cpus in self.nodes]
+
+    def allocate(self, num_cpus):
+        """Reserves num_cpus cpus.
+
+        The cpus are taken from the NUMA node with the fewest free cpus that can hold them all, so that larger sets
+        remain available on the other nodes, else from the nodes with the most free cpus.
+
+        Returns
+        -------
+        list of int
+            Reserved cpus, or None if not enough cpus are free
+
+        """
+        num_cpus = int(math.ceil(num_cpus))
+        if sum(len(free) for free in self._free) < num_cpus:
+            return None
+        fitting = [free for free in self._free if len(free) >= num_cpus]
+        if fitting:
+            free = min(fitting, key=len)
+            cpus = sorted(free)[:num_cpus]
+        else:
+            cpus = []
+            for free in sorted(self._free, key=len, reverse=True):
+                cpus.extend(sorted(free)[:num_cpus - len(cpus)])
+                if len(cpus) == num_cpus:
+                    break
+        for free in self._free:
+            free.difference_update(cpus)
+        return cpus
+
+    def release(self, cpus):
+        """Frees cpus reserved by allocate().
+
+        """
+        for node, free in zip(self.nodes, self._free):
+            free.update(set(cpus).intersection(node))
+
+
+def _format_cpuset(cpus):
+    return ",".join(str(cpu) for cpu in sorted(cpus))
+
+
+class _SimulationJob(object):
+    """Simulation waiting in the queue of a SimulationScheduler, or running under it.
+
+    """
+
+    def __init__(self, submission_id, num_cpus, mem_limit, run_kwargs):
+        self.submission_id = submission_id
+        self.num_cpus = num_cpus
+        self.mem_limit = mem_limit
+        self.mem_bytes = _memory_bytes(mem_limit)
+        self.run_kwargs = run_kwargs
+        self.future = Future()
+        self.submission = None
+        self.cpuset = None
+
+
+class SimulationScheduler(object):
+    """Queues simulations and runs them on a CompetitionContainerExecutor without oversubscribing the host.
+
+    Each simulation is submitted with the number of cpus and the memory it will be given. Queued simulations are
+    started in submission order as soon as their cpus and memory fit in what is left of the host budget (smaller
+    simulations further down the queue are started when the first ones do not fit) and the number of running
+    simulations is below `max_running`. Every submission returns a Future resolving to the Results of the simulation
+    once its scores are written. Up to SCHEDULER_START_THREADS containers are started at the same time.
+
+    Parameters
+    ----------
+    executor : CompetitionContainerExecutor
+        Executor used to start the simulation containers
+    max_running : int, optional
+        Maximum number of simulations running at the same time (only bounded by the budgets if None)
+    cpu_budget : float, optional
+        Number of cpus shared by the simulations (all the cpus of the docker host by default)
+    mem_budget : int or str, optional
+        Memory shared by the simulations, i.e "48g" (HOST_MEMORY_FRACTION of the docker host memory by default)
+    pin_cpus : bool or CpusetAllocator
+        Whether to pin each simulation to its own cpus (on a single NUMA node when possible), so that concurrent
+        simulations do not compete for the same cores
+
+    """
+
+    def __init__(self, executor, max_running=None, cpu_budget=None, mem_budget=None, pin_cpus=False):
+        self.executor = executor
+        self.max_running = max_running
+        if cpu_budget is None or mem_budget is None:
+            host = executor.client.info()
+            if cpu_budget is None:
+                cpu_budget = host["NCPU"]
+            if mem_budget is None:
+                mem_budget = int(host["MemTotal"] * HOST_MEMORY_FRACTION)
+        self.cpu_budget = cpu_budget
+        self.mem_budget = _memory_bytes(mem_budget)
+        if pin_cpus is True:
+            pin_cpus = CpusetAllocator()
+        self.cpusets = pin_cpus or None
+
+        self._queue = deque()
+        self._running = {}
+        self._cpus_used = 0
+        self._mem_used = 0
+        self._lock = threading.Condition()
+        self._shutdown = False
+        self._dispatcher = None
+        self._starter = None
+
+    def submit(self, submission_id, num_cpus=1, mem_limit="4g", **run_kwargs):
+        """Queues a simulation, to be run with CompetitionContainerExecutor.run_simulation() once the host can
+        take it.
+
+        Parameters
+        ----------
+        submission_id : str
+            Identifier of the simulation instance (will become the container name). The containers are not removed
+            once complete, so the identifier must not be used by a queued, running or previous simulation of the
+            executor (remove the previous containers with CompetitionContainerExecutor.stop_all_simulations()).
+        num_cpus : float
+            Number of cpus allocated to the container
+        mem_limit : int or str
+            Maximum memory of the container, i.e "4g"
+        run_kwargs :
+            Other arguments of CompetitionContainerExecutor.run_simulation() (scenario_name, sample_size...)
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the Results of the simulation once it is complete
+
+        Raises
+        ------
+        ValueError
+            If the simulation can never fit in the cpu or memory budget of the scheduler, or if its identifier is
+            already used.
+
+        """
+        job = _SimulationJob(submission_id, num_cpus, mem_limit, run_kwargs)
+        if job.num_cpus > self.cpu_budget or job.mem_bytes > self.mem_budget:
+            raise ValueError("Simulation {0} needs more resources ({1} cpus, {2}) than the scheduler budget "
+                             "({3} cpus, {4} bytes).".format(submission_id, num_cpus, mem_limit,
+                                                            self.cpu_budget, self.mem_budget))
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit simulations to a scheduler that was shut down.")
+            if submission_id in self._running or submission_id in self.executor.containers or \
+                    any(queued.submission_id == submission_id for queued in self._queue):
+                raise ValueError("A simulation named {0} was already submitted, its container name cannot be "
+                                 "reused.".format(submission_id))
+            self._queue.append(job)
+            if self._dispatcher is None:
+                self._starter = ThreadPoolExecutor(max_workers=SCHEDULER_START_THREADS,
+                                                   thread_name_prefix="simulation-start")
+                self._dispatcher = threading.Thread(target=self._dispatch, name="simulation-scheduler",
+                                                    daemon=True)
+                self._dispatcher.start()
+            self._lock.notify()
+        return job.future
+
+    def queued(self):
+        """Lists the identifiers of the simulations waiting to be started.
+
+        """
+        with self._lock:
+            return [job.submission_id for job in self._queue]
+
+    def running(self):
+        """Lists the identifiers of the simulations started by the scheduler and not complete yet.
+
+        """
+        with self._lock:
+            return list(self._running)
+
+    def shutdown(self, wait=True, cancel_queued=False):
+        """Stops accepting new simulations.
+
+        Parameters
+        ----------
+        wait : bool
+            Whether to block until all the submitted simulations are complete
+        cancel_queued : bool
+            Whether to cancel the simulations that were not started yet
+
+        """
+        with self._lock:
+            self._shutdown = True
+            if cancel_queued:
+                while self._queue:
+                    self._queue.popleft().future.cancel()
+            self._lock.notify()
+            dispatcher = self._dispatcher
+        if wait and dispatcher is not None:
+            dispatcher.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=exc_type is None, cancel_queued=exc_type is not None)
+
+    def _fits(self, job):
+        if self.max_running is not None and len(self._running) >= self.max_running:
+            return False
+        return (self._cpus_used + job.num_cpus <= self.cpu_budget and
+                self._mem_used + job.mem_bytes <= self.mem_budget)
+
+    def _next_job(self):
+        """Takes the first queued simulation that fits in what is left of the budget, if any.
+
+        """
+        for job in list(self._queue):
+            if job.future.cancelled():
+                self._queue.remove(job)
+            elif self._fits(job):
+                if self.cpusets is not None:
+                    job.cpuset = self.cpusets.allocate(job.num_cpus)
+                    if job.cpuset is None:
+                        continue
+                self._queue.remove(job)
+                return job
+        return None
+
+    def _release(self, job):
+        with self._lock:
+            del self._running[job.submission_id]
+            self._cpus_used -= job.num_cpus
+            self._mem_used -= job.mem_bytes
+            if job.cpuset is not None:
+                self.cpusets.release(job.cpuset)
+            self._lock.notify()
+
+    def _finished(self, job, completion):
+        """Frees the resources of a simulation once the CompletionTracker of the executor resolved it.
+
+        """
+        self._release(job)
+        if completion.exception() is not None:
+            job.future.set_exception(completion.exception())
+        else:
+            job.future.set_result(completion.result())
+
+    def _start(self, job):
+        if not job.future.set_running_or_notify_cancel():
+            self._release(job)
+            return
+        if job.cpuset is not None:
+            job.run_kwargs['cpuset_cpus'] = _format_cpuset(job.cpuset)
+        try:
+            self.executor.run_simulation(job.submission_id, num_cpus=job.num_cpus, mem_limit=job.mem_limit,
+                                         **job.run_kwargs)
+            job.submission = self.executor.containers[job.submission_id]
+        except Exception as e:
+            self._release(job)
+            job.future.set_exception(e)
+            return
+        self.executor.completion.track(job.submission).add_done_callback(
+            lambda completion: self._finished(job, completion))
+
+    def _dispatch(self):
+        # created once, before the containers are started from several threads
+        self.executor.completion
+        while True:
+            with self._lock:
+                started = []
+                job = self._next_job()
+                while job is not None:
+                    self._running[job.submission_id] = job
+                    self._cpus_used += job.num_cpus
+                    self._mem_used += job.mem_bytes
+                    started.append(job)
+                    job = self._next_job()
+                if self._shutdown and not self._queue and not self._running:
+                    break
+                if not started:
+                    # Woken up by a submission, a completion or the shutdown
+                    self._lock.wait()
+                    continue
+            for job in started:
+                print("Starting simulation {0} ({1} cpus, {2})".format(job.submission_id, job.num_cpus,
+                                                                      job.mem_limit))
+                self._starter.submit(self._start, job)
+        self._starter.shutdown()
 
 
 if __name__ == '__main__':
@@ -1,9 +1,69 @@
 import re
 import lxml
+from contextlib import contextmanager
 from lxml import etree
 import gzip
+from pathlib import Path
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# Columns of the `<num_iterations>.events.csv.gz` file used to rebuild the legs and path traversals
+EVENTS_COLUMNS = ['time', 'type', 'person', 'vehicle', 'driver', 'vehicleType', 'length', 'numPassengers',
+                  'departureTime', 'arrivalTime', 'mode', 'links', 'fuelType', 'fuel']
+
+# Event types used to rebuild the legs and path traversals
+LEGS_EVENT_TYPES = ['PathTraversal', 'PersonEntersVehicle']
+
+EVENTS_NUMERIC_COLUMNS = ['time', 'length', 'numPassengers', 'departureTime', 'arrivalTime', 'fuel']
+EVENTS_CATEGORICAL_COLUMNS = ['type', 'mode', 'vehicleType', 'fuelType']
+
+EVENTS_CHUNKSIZE = 500000
+
+# Types of the attributes of MATSim/BEAM events: numeric attributes are stored as floats (they are missing for the
+# events of other types), ids as strings and attributes with few distinct values as categoricals
+EVENT_ATTRIBUTE_TYPES = {
+    'time': float, 'type': 'category', 'person': str, 'driver': str, 'vehicle': str, 'vehicleType': 'category',
+    'link': str, 'links': str, 'facility': str, 'actType': 'category', 'legMode': 'category', 'mode': 'category',
+    'length': float, 'numPassengers': float, 'capacity': float, 'departureTime': float, 'arrivalTime': float,
+    'fuelType': 'category', 'fuel': float, 'x': float, 'y': float, 'startX': float, 'startY': float, 'endX': float,
+    'endY': float, 'amount': float, 'cost': float, 'incentive': float, 'tollCost': float, 'netCost': float,
+    'seatingCapacity': float, 'tripId': str, 'agency': 'category', 'route': str}
+
+# Number of values from which the type of an attribute missing from EVENT_ATTRIBUTE_TYPES is inferred
+SCHEMA_SAMPLE_SIZE = 1000
+
+# Order in which inferred types are promoted when the sampled values disagree
+TYPE_PROMOTION = [int, float, str]
+
+# File extension of the parsed dataframes for each output format (parquet and feather require pyarrow)
+OUTPUT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+OUTPUT_COMPRESSION = 'zstd'
+
+# Columns of the parsed dataframes holding lists (stored as list columns in parquet and feather files)
+LIST_COLUMNS = ['Path', 'legModes']
+
+# Columns of the parsed dataframes holding ids, kept as strings even when they look like numbers
+ID_COLUMNS = ['PID', 'Trip_ID', 'Leg_ID', 'Activity_ID', 'Origin_Activity_ID', 'Destination_activity_ID',
+              'Household_ID', 'Veh', 'vehicle', 'driver', 'person', 'links']
+
+
+@contextmanager
+def _xml_source(path):
+    # file object of an xml.gz file (closed on exit), or the path of an xml file, to be parsed by lxml
+    path = str(path)
+    if path.endswith('.gz'):
+        with gzip.open(path) as source:
+            yield source
+    else:
+        yield path
+
 
 def open_xml(path):
     """
@@ -14,59 +74,125 @@ def open_xml(path):
     path: string
         Absolute path of the file to parse
     """
-    # Make sure that the path is a string (and not a pathlib.Path object)
-    path = str(path)
-    if path.endswith('.gz'):
-        return etree.parse(gzip.open(path))
-    else:
-        return etree.parse(path)
+    with _xml_source(path) as source:
+        return etree.parse(source)
 
 
 def guess_type(s):
     """
-    Cast objects to appropriate data types
+    Guess the data type of the string representation of a value
 
     Parameters
     ----------
-    s: object
-        Object whose data type is unknown
+    s: str
+        String representation of a value whose data type is unknown
 
     Returns
     -------
-    data type
+    data type: int, float or str
 
     """
-    if re.match("^[0-9.]+$", s):
-        return float
-    elif re.match("^[0-9]+$", s):
+    if re.match(r"^-?[0-9]+$", s):
         return int
+    elif re.match(r"^-?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?$", s):
+        return float
     else:
         return str
 
 
+def infer_type(values, sample_size=SCHEMA_SAMPLE_SIZE):
+    """
+    Infer the data type of a column from a sample of its values
+
+    The type guessed for each of the first `sample_size` non-missing values (see guess_type()) is promoted following
+    TYPE_PROMOTION (int, then float, then str), so that e.g. a column of integers with some decimals is a float.
+
+    Parameters
+    ----------
+    values: iterable of str
+        String representations of the values of the column (None if missing)
+    sample_size: int
+        Number of non-missing values to look at
+
+    Returns
+    -------
+    data type: int, float or str (str if all values are missing)
+
+    """
+    rank = None
+    num_sampled = 0
+    for value in values:
+        if value is None:
+            continue
+        rank = max(rank or 0, TYPE_PROMOTION.index(guess_type(value)))
+        num_sampled += 1
+        if num_sampled == sample_size or TYPE_PROMOTION[rank] is str:
+            break
+    return str if rank is None else TYPE_PROMOTION[rank]
+
+
+def convert_column(values, column_type):
+    """
+    Convert the string representations of the values of a column at once
+
+    Parameters
+    ----------
+    values: list of str
+        String representations of the values of the column (None if missing)
+    column_type: int, float, str or 'category'
+        Type of the column. Numeric columns whose values do not all parse are kept as strings.
+
+    Returns
+    -------
+    : pandas Series
+
+    """
+    if column_type in (int, float):
+        try:
+            column = pd.to_numeric(pd.Series(values, dtype=object))
+        except (ValueError, TypeError):
+            return pd.Series(values, dtype=object)
+        return column.astype(float) if column_type is float else column
+    elif column_type == 'category':
+        return pd.Series(values, dtype='category')
+    else:
+        return pd.Series(values, dtype=object)
+
+
 def list_attributes(tree):
     """
-    Find the unique attribute names of the xml file.
+    Find the unique attribute names of the xml file and their types.
+
+    The type of the attributes listed in EVENT_ATTRIBUTE_TYPES is known; the type of the others is inferred from
+    their values in the first SCHEMA_SAMPLE_SIZE children of the root (see infer_type()).
 
     Parameters
     ----------
-    root:
+    tree: ElementTree object
+        Output of the open_xml() function
 
     Returns
     -------
     columns: list
         Columns of the future DataFrame
 
+    column_types: list
+        Types of the columns (int, float, str or 'category')
+
     """
     root = tree.getroot()
 
     columns = []
-    column_types = []
-    for event in root:
-        for i in event.items():
-            if i[0] not in columns:
-                columns.append(i[0])
-                column_types.append(guess_type(i[1]))
+    samples = {}
+    for event_index, event in enumerate(root):
+        for attribute_name, attribute_value in event.items():
+            if attribute_name not in samples:
+                columns.append(attribute_name)
+                samples[attribute_name] = []
+            if event_index < SCHEMA_SAMPLE_SIZE:
+                samples[attribute_name].append(attribute_value)
+
+    column_types = [EVENT_ATTRIBUTE_TYPES.get(column) or infer_type(samples[column]) for column in columns]
     return columns, column_types
 
 
@@ -80,30 +206,338 @@ def create_dataframe(tree, columns, column_types):
     """
     root = tree.getroot()
 
-    event_data_size = len(columns)
-    data = []
-
-    # Reading the data of each event to append values in the correct order.
-    for event in root:
-        event_data = [None] * event_data_size
+    positions = {column: position for position, column in enumerate(columns)}
+    buffers = [[None] * len(root) for _ in columns]
 
-        for i in event.items():
-            attribute_name = i[0]
-            attribute_value = i[1]
-            column_index = columns.index(attribute_name)
-            event_data[column_index] = column_types[column_index](attribute_value)
-        data.append(event_data)
+    # Reading the data of each event to store values in the buffer of their column.
+    for event_index, event in enumerate(root):
+        for attribute_name, attribute_value in event.items():
+            buffers[positions[attribute_name]][event_index] = attribute_value
 
-    output_data = pd.DataFrame(data=data, columns=columns)
+    output_data = pd.DataFrame({column: convert_column(buffer, column_type)
+                                for column, buffer, column_type in zip(columns, buffers, column_types)},
+                               columns=columns)
 
     return output_data
 
 
-def extract_dataframe(path):
-    tree = open_xml(path)
-    columns, column_types = list_attributes(tree)
-    output_data = create_dataframe(tree, columns, column_types)
-    return output_data
+def iterparse_elements(path, tag):
+    """
+    Iterate over the elements of an xml or xml.gz file with a given tag, without holding the whole tree in memory
+
+    Each element is yielded once it is fully parsed (with its children), then cleared along with the elements
+    preceding it.
+
+    Parameters
+    ----------
+    path: string
+        Absolute path of the file to parse
+    tag: str
+        Tag of the elements to yield. Use "{*}<tag>" to match the tag in any namespace.
+
+    Yields
+    ------
+    element: lxml Element
+        Element to process before the iteration resumes
+    """
+    with _xml_source(path) as source:
+        for _, element in etree.iterparse(source, events=('end',), tag=tag):
+            yield element
+            # free the memory used by the elements parsed so far
+            element.clear()
+            parent = element.getparent()
+            while element.getprevious() is not None:
+                del parent[0]
+
+
+def iterparse_dataframes(path, chunksize=None, column_types=None):
+    """
+    Collect the attributes of the children of the root of an xml or xml.gz file in pandas DataFrames, in a single
+    pass over the file.
+
+    The file is parsed incrementally with etree.iterparse(): each child is cleared once its attributes are stored, so
+    that the whole tree is never held in memory. The attributes are stored in one buffer per column and each column
+    is converted at once when a DataFrame is built (see convert_column()). The type of a column comes from
+    `column_types`, then EVENT_ATTRIBUTE_TYPES, and is otherwise inferred from its first SCHEMA_SAMPLE_SIZE values
+    (see infer_type()); it is then kept for the following chunks.
+
+    Parameters
+    ----------
+    path: string
+        Absolute path of the file to parse
+    chunksize: int, optional
+        Maximum number of rows of each DataFrame. By default, a single DataFrame is yielded.
+    column_types: dict, optional
+        Types (int, float, str or 'category') of some of the attributes, overriding EVENT_ATTRIBUTE_TYPES
+
+    Yields
+    ------
+    : pandas DataFrame
+        One row per child of the root and one column per attribute name (in order of first appearance). Missing
+        attributes are NaN.
+    """
+    schema = dict(EVENT_ATTRIBUTE_TYPES, **(column_types or {}))
+    positions = {}
+    buffers = []
+    num_rows = 0
+
+    def to_dataframe():
+        columns = {}
+        for column, buffer in zip(positions, buffers):
+            if column not in schema:
+                schema[column] = infer_type(buffer)
+            columns[column] = convert_column(buffer, schema[column])
+            if schema[column] in (int, float) and columns[column].dtype == object:
+                # some values are not numbers: keep the column as strings in the next chunks
+                schema[column] = str
+        # the columns are named in order of their position
+        return pd.DataFrame(columns, columns=list(positions))
+
+    with _xml_source(path) as source:
+        for _, element in etree.iterparse(source, events=('end',)):
+            parent = element.getparent()
+            if parent is None or parent.getparent() is not None:
+                continue
 
+            for attribute_name, attribute_value in element.items():
+                position = positions.get(attribute_name)
+                if position is None:
+                    position = positions[attribute_name] = len(buffers)
+                    buffers.append([None] * num_rows)
+                buffers[position].append(attribute_value)
+            num_rows += 1
+            for buffer in buffers:
+                if len(buffer) < num_rows:
+                    buffer.append(None)
 
+            # free the memory used by the children parsed so far
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
 
+            if chunksize is not None and num_rows == chunksize:
+                yield to_dataframe()
+                buffers = [[] for _ in buffers]
+                num_rows = 0
+
+        if num_rows > 0 or chunksize is None:
+            yield to_dataframe()
+
+
+def extract_dataframe(path, column_types=None):
+    """
+    Parse an xml or xml.gz file into a pandas DataFrame with one row per child of the root and one column per
+    attribute (see iterparse_dataframes())
+
+    Parameters
+    ----------
+    path: string
+        Absolute path of the file to parse
+    column_types: dict, optional
+        Types (int, float, str or 'category') of some of the attributes, overriding EVENT_ATTRIBUTE_TYPES
+
+    Returns
+    -------
+    output_data: pandas DataFrame
+    """
+    return next(iterparse_dataframes(path, column_types=column_types))
+
+
+def read_events(events_path, columns=EVENTS_COLUMNS, event_types=LEGS_EVENT_TYPES, chunksize=EVENTS_CHUNKSIZE):
+    """
+    Read the events csv(.gz) file in chunks, keeping only some of its columns and event types
+
+    Only one chunk of the raw file is held in memory at a time: each chunk is filtered on the event types before
+    being kept. Numeric columns are read as floats, the ids (persons, vehicles, links) as strings and the columns with
+    few distinct values (event type, mode, vehicle type, fuel type) as categoricals, chunk by chunk, so that the kept
+    rows never hold them as strings.
+
+    Parameters
+    ----------
+    events_path: pathlib.Path object or str
+        Absolute path of the `ITERS/it.<num_iterations>/<num_iterations>.events.csv.gz` file
+    columns: list of str
+        Columns to keep. Columns missing from the file are filled with NaN.
+    event_types: list of str
+        Values of the `type` column to keep, or None to keep all events
+    chunksize: int
+        Number of rows of the file read at a time
+
+    Returns
+    -------
+    events_df: pandas DataFrame
+        Filtered events, with the columns in the order of `columns`
+    """
+    categorical_columns = [column for column in columns if column in EVENTS_CATEGORICAL_COLUMNS]
+    dtypes = {column: ('category' if column in categorical_columns else
+                       float if column in EVENTS_NUMERIC_COLUMNS else str) for column in columns}
+
+    chunks = []
+    for chunk in pd.read_csv(str(events_path), usecols=lambda column: column in columns, dtype=dtypes,
+                             chunksize=chunksize):
+        if event_types is not None:
+            chunk = chunk[chunk['type'].isin(event_types)]
+        chunks.append(chunk)
+
+    if chunks:
+        # the categories differ between chunks, and concatenating them as such would turn the columns back into
+        # strings: the chunks are first recoded (without copying the values) to the categories of all the chunks
+        categories = {column: pd.CategoricalDtype(sorted(set().union(*(chunk[column].cat.categories
+                                                                        for chunk in chunks))))
+                      for column in categorical_columns if column in chunks[0]}
+        events_df = pd.concat([chunk.astype(categories) for chunk in chunks], ignore_index=True)
+        for column in categories:
+            events_df[column] = events_df[column].cat.remove_unused_categories()
+        events_df = events_df.reindex(columns=columns)
+    else:
+        events_df = pd.DataFrame(columns=columns)
+    for column in categorical_columns:
+        if events_df[column].dtype.name != 'category':
+            events_df[column] = events_df[column].astype('category')
+
+    return events_df
+
+
+def dataframe_path(output_folder_path, name, output_format='csv'):
+    """Returns the path of the `name` dataframe in the output folder, e.g. `<output_folder_path>/trips_dataframe.csv`"""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format {0!r}, expected one of {1}".format(output_format, list(OUTPUT_FORMATS)))
+    return Path(output_folder_path) / (name + OUTPUT_FORMATS[output_format])
+
+
+def _as_list(value):
+    # `Path` is a comma-separated string of link ids (a list of them, one per path traversal, for bus legs) and
+    # `legModes` an array of modes: both become a flat list of link ids (or modes), empty if missing
+    if value is None or (isinstance(value, float) and value != value):
+        return []
+    if isinstance(value, str):
+        value = [value]
+    return [link for item in value for link in str(item).split(',') if link]
+
+
+def normalize_dtypes(df):
+    """
+    Gives a parsed dataframe the same dtypes whether it was just parsed or read back from a csv, parquet or feather
+    file
+
+    Categorical and string columns become plain object columns, the other object columns holding numbers (such as the
+    person attributes parsed from the xml files) become numeric, as read_csv() would have them, and a named index
+    (PID, Trip_ID) holds strings. Missing strings are NaN. ID_COLUMNS are left as they are, and the values of the
+    LIST_COLUMNS (comma-separated strings, or lists of them) become flat lists of link ids (or modes).
+
+    Parameters
+    ----------
+    df: pandas DataFrame
+        Parsed dataframe
+
+    Returns
+    -------
+    df: pandas DataFrame
+        Dataframe with normalized dtypes (a shallow copy if some columns changed)
+    """
+    normalized = {}
+    for column in df.columns:
+        values = df[column]
+        if values.dtype.name == 'category' or (values.dtype != object and pd.api.types.is_string_dtype(values.dtype)):
+            values = values.astype(object)
+        if column in LIST_COLUMNS:
+            values = values.map(_as_list).astype(object)
+        elif values.dtype == object and column not in ID_COLUMNS:
+            try:
+                values = pd.to_numeric(values)
+            except (ValueError, TypeError):
+                pass
+        if values.dtype == object and column not in LIST_COLUMNS and values.isna().any():
+            # parquet and feather files give None for missing strings, read_csv() NaN
+            values = values.where(values.notna(), float('nan'))
+        if values is not df[column]:
+            normalized[column] = values
+
+    if normalized or (df.index.name is not None and df.index.dtype != object):
+        df = df.copy(deep=False)
+        for column, values in normalized.items():
+            df[column] = values
+        if df.index.name is not None:
+            df.index = df.index.astype(str).astype(object)
+    return df
+
+
+def write_dataframe(df, output_folder_path, name, output_format='csv'):
+    """
+    Writes a parsed dataframe to the output folder in the given format
+
+    The dtypes are first normalized (see normalize_dtypes()). csv files store the LIST_COLUMNS as comma-separated
+    strings. Parquet and feather files are compressed, keep the index and the dtypes of the columns, and store the
+    LIST_COLUMNS as lists of strings.
+
+    Parameters
+    ----------
+    df: pandas DataFrame
+        Dataframe to write
+    output_folder_path: pathlib.Path object
+        Absolute path of the output folder of the simulation
+    name: str
+        Name of the dataframe, e.g. `trips_dataframe`
+    output_format: str
+        One of OUTPUT_FORMATS
+
+    Returns
+    -------
+    path: pathlib.Path object
+        Path of the written file
+    """
+    path = dataframe_path(output_folder_path, name, output_format)
+    df = normalize_dtypes(df)
+
+    if output_format == 'csv':
+        list_columns = {column: df[column].map(','.join) for column in LIST_COLUMNS if column in df.columns}
+        df.assign(**list_columns).to_csv(str(path))
+        return path
+
+    if pa is None:
+        raise ImportError("pyarrow is required to write {} files".format(output_format))
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    if output_format == 'parquet':
+        pq.write_table(table, str(path), compression=OUTPUT_COMPRESSION)
+    else:
+        feather.write_feather(table, str(path), compression=OUTPUT_COMPRESSION)
+
+    return path
+
+
+def read_dataframe(output_folder_path, name, output_format='csv'):
+    """
+    Reads a dataframe written by write_dataframe()
+
+    The index written with the dataframe is restored, and the dtypes are normalized (see normalize_dtypes()), so the
+    LIST_COLUMNS are lists whatever the format.
+
+    Parameters
+    ----------
+    output_folder_path: pathlib.Path object
+        Absolute path of the output folder of the simulation
+    name: str
+        Name of the dataframe, e.g. `trips_dataframe`
+    output_format: str
+        One of OUTPUT_FORMATS
+
+    Returns
+    -------
+    df: pandas DataFrame
+        Dataframe read
+    """
+    path = dataframe_path(output_folder_path, name, output_format)
+
+    if output_format == 'csv':
+        return normalize_dtypes(pd.read_csv(str(path), index_col=0, dtype={column: str for column in ID_COLUMNS},
+                                            converters={column: _as_list for column in LIST_COLUMNS}))
+
+    if pa is None:
+        raise ImportError("pyarrow is required to read {} files".format(output_format))
+    if output_format == 'parquet':
+        table = pq.read_table(str(path))
+    else:
+        table = feather.read_table(str(path), memory_map=True)
+    df = table.to_pandas()
+    # pyarrow returns the list columns as numpy arrays, made lists by normalize_dtypes()
+    return normalize_dtypes(df)
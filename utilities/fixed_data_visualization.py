@@ -63,6 +63,9 @@ class ReferenceData(object):
         trips = pd.read_csv(Path.cwd().parent / REFERENCE_DATA / scenario_name / AGENCY / "gtfs_data/trips.txt")
         self.trip_to_route = trips[["trip_id", "route_id"]].set_index("trip_id", drop=True).T.to_dict('records')[0]
 
+        # Transit vehicle ids of all the agencies of the scenario, to tell the transit vehicles of the events apart
+        self.transit_vehicles = parser.load_transit_vehicles(Path.cwd().parent / REFERENCE_DATA, scenario_name)
+
 
         #Extracting Fuel cost from the `beamFuelTypes.csv` file
         fuel_costs = pd.read_csv(Path.cwd().parent / REFERENCE_DATA / scenario_name / CONFIG / sample_size / "beamFuelTypes.csv")
@@ -80,12 +83,24 @@ class ReferenceData(object):
         self.path_population_file = Path.cwd().parent / REFERENCE_DATA /scenario_name / CONFIG / f"{sample_size}/population.xml.gz"
 
 
+def _index_as_columns(df):
+    # named indexes (PID, Trip_ID) become columns again, as when the csv files were read without index_col
+    return df.reset_index(drop=df.index.name is None)
+
+
 class ResultFiles:
-    def __init__(self, path_output_folder, number_iterations, reference_data: ReferenceData):
+    def __init__(self, path_output_folder, number_iterations, reference_data: ReferenceData, output_format="csv",
+                 engine="indexed", n_jobs=1):
 
         self.path_output_folder = path_output_folder
         self.number_iterations = number_iterations
         self.reference_data = reference_data
+        # format of the parsed dataframe files: "csv", "parquet" or "feather"
+        self.output_format = output_format
+        # how the legs are rebuilt from the events: "indexed", "vectorized" or "rowwise" (see parser.get_legs_output())
+        self.engine = engine
+        # number of processes rebuilding the legs, -1 for all the cores (see parser.get_legs_output())
+        self.n_jobs = n_jobs
 
         # Extracting input data from the submission input csv files
         self.bus_fares_data = pd.read_csv(path_output_folder / COMPETITION / SUBMISSION_INPUTS / "MassTransitFares.csv")
@@ -101,7 +116,8 @@ class ResultFiles:
         self.process_all_xml_files()
 
     def process_all_xml_files(self):
-        """ Import all xml.gz files from the output folder of the scenario, parse them and create .csv files"
+        """ Import all xml.gz files from the output folder of the scenario, parse them and create .csv (or .parquet /
+        .feather) files
 
         """
 
@@ -113,15 +129,18 @@ class ResultFiles:
         self.persons_path = self.path_output_folder / "outputPersonAttributes.xml.gz"
         self.households_path = self.path_output_folder / "outputHouseholds.xml.gz"
 
-        if not Path(self.path_output_folder / "trips_dataframe.csv").exists():
-            # Parsing and creating the csv files in the output folder
-            parser.output_parse(self.events_path, self.output_plans_path, self.persons_path, self.households_path,
-                                self.experienced_plans_path, self.bus_fares_data, self.reference_data.route_ids,
-                                self.reference_data.trip_to_route, self.reference_data.fuel_costs, self.path_output_folder)
-
-        # Get the data from the generated csv files
-        self.trips_df = pd.read_csv(self.path_output_folder / "trips_dataframe.csv")
-        self.person_df = pd.read_csv(self.path_output_folder / "persons_dataframe.csv")
-        self.activities_df = pd.read_csv(self.path_output_folder / "activities_dataframe.csv")
-        self.legs_df = pd.read_csv(self.path_output_folder / "legs_dataframe.csv")
-        self.paths_traversals_df = pd.read_csv(self.path_output_folder / "path_traversals_dataframe.csv")
\ No newline at end of file
+        # Parsing the output files: only the dataframes whose inputs changed since the previous parse are rebuilt, the
+        # others are read from the output folder (see parser.output_parse())
+        parsed_outputs = parser.output_parse(self.events_path, self.output_plans_path, self.persons_path,
+                                             self.households_path, self.experienced_plans_path, self.bus_fares_data,
+                                             self.reference_data.route_ids, self.reference_data.trip_to_route,
+                                             self.reference_data.fuel_costs, self.path_output_folder,
+                                             self.output_format, incremental=True,
+                                             transit_vehicles=self.reference_data.transit_vehicles,
+                                             engine=self.engine, n_jobs=self.n_jobs)
+
+        self.trips_df = _index_as_columns(parsed_outputs.trips_df)
+        self.person_df = _index_as_columns(parsed_outputs.persons_df)
+        self.activities_df = _index_as_columns(parsed_outputs.activities_df)
+        self.legs_df = _index_as_columns(parsed_outputs.legs_df)
+        self.paths_traversals_df = _index_as_columns(parsed_outputs.path_traversals_df)
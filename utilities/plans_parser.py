@@ -1,10 +1,68 @@
 import pandas as pd
 import numpy as np
 from pathlib import Path
-from data_parsing import extract_dataframe, open_xml
+from data_parsing import extract_dataframe, open_xml, read_events, iterparse_elements, write_dataframe, read_dataframe, \
+    normalize_dtypes, \
+    dataframe_path, EVENTS_COLUMNS, LEGS_EVENT_TYPES
+from utils import file_fingerprint
+from input_sampler import scenario_agencies
 
 import gzip
+import hashlib
+import json
+import os
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+
+LEGS_COLUMNS = ['PID', 'Trip_ID', 'Leg_ID', 'Mode', 'Veh', 'Veh_type', 'Start_time', 'End_time', 'Duration_sec',
+                'Distance_m', 'Path', 'fuel', 'fuelType']
+
+RIDEHAIL_TRIP_MODES = ['OnDemand_ride', 'ride_hail']
+TRANSIT_TRIP_MODES = ['drive_transit', 'walk_transit']
+WALK_CAR_TRIP_MODES = ['car', 'walk']
+
+# Why a ride-hail trip has no leg: the person entered no vehicle, or several, during the trip, or the vehicle has no
+# path traversal with passengers departing when they entered it
+RIDEHAIL_UNMATCHED_REASONS = ['no_vehicle_entry', 'multiple_vehicle_entries', 'no_path_traversal']
+RIDEHAIL_DIAGNOSTICS_COLUMNS = ['PID', 'Trip_ID', 'Start_time', 'End_time', 'Veh', 'reason']
+
+# Modes of the path traversals of transit vehicles in BEAM. The transit legs of all these modes are charged the bus
+# fares and count as bus legs when labelling the realized mode of a trip.
+TRANSIT_MODES = ['bus', 'tram', 'subway', 'rail', 'ferry', 'cable_car', 'gondola', 'funicular']
+
+LEGS_ENGINES = ['indexed', 'vectorized', 'rowwise']
+
+# Fares of the on-demand rides: {'base': $, 'duration': $/hour, 'distance': $/km}
+RIDE_HAIL_FARES = {'base': 0.0, 'distance': 1.0, 'duration': 0.5}
+
+# Stages of an incremental parse (see output_parse()): the stages they depend on, and the dataframes they write.
+# The inputs of each stage are recorded in the PARSE_MANIFEST of the output folder.
+PARSE_STAGES = ['persons', 'plans', 'legs', 'fuel', 'fares', 'trips']
+PARSE_STAGE_DEPENDENCIES = {'persons': [], 'plans': [], 'legs': ['plans'], 'fuel': ['legs'], 'fares': ['legs', 'persons'],
+                            'trips': ['plans', 'fuel', 'fares']}
+PARSE_STAGE_OUTPUTS = {'persons': ['persons_dataframe', 'households_dataframe'], 'plans': ['activities_dataframe'],
+                       'legs': ['legs_dataframe', 'path_traversals_dataframe'], 'fuel': ['legs_dataframe',
+                       'path_traversals_dataframe'], 'fares': ['legs_dataframe'], 'trips': ['trips_dataframe']}
+PARSE_MANIFEST = "parse_manifest.json"
+
+# Number of dataframe files written at the same time by an OutputWriter
+OUTPUT_WRITER_THREADS = 2
+
+# Bits of the leg modes used to label the realized mode of a trip (see merge_legs_trips())
+TRIP_MODE_FLAGS = {'walk': 1, 'car': 2, 'bus': 4, 'OnDemand_ride': 8}
+OTHER_MODE_FLAG = 16
+
+# Number of ages (0 to MAX_AGE - 1) covered by the bus fares
+MAX_AGE = 120
+
+# Folder of the output folder where the filtered events are cached (requires pyarrow)
+EVENTS_CACHE_FOLDER = ".events_cache"
 
 
 # ########### 1. INTERMEDIARY FUNCTIONS ###########
@@ -29,6 +87,156 @@ def unzip_file(path: Path):
         return path
 
 
+def _write_output(df, output_folder_path, name, output_format, writer=None):
+    # writes one of the parsed dataframes, unless writing is disabled (output_format=None)
+    # with a writer, the dataframe is only queued: it must not be modified afterwards
+    if writer is not None:
+        return writer.write(df, name)
+    if output_format is None:
+        return None
+    path = write_dataframe(df, output_folder_path, name, output_format)
+    print("{} generated".format(path.name))
+    return path
+
+
+class OutputWriter(object):
+    """Writes the parsed dataframes to the output folder from a pool of background threads.
+
+    The parsing goes on while the dataframes already parsed are serialized and compressed. A dataframe must not be
+    modified once submitted. flush() returns once every submitted dataframe is written.
+
+    Parameters
+    ----------
+    output_folder_path: pathlib.Path object
+        Absolute path of the output folder of the simulation
+    output_format: str
+        Format of the written dataframe files, one of OUTPUT_FORMATS (see write_dataframe()), or None not to write them
+    max_workers: int
+        Number of dataframes written at the same time
+    """
+
+    def __init__(self, output_folder_path, output_format='csv', max_workers=OUTPUT_WRITER_THREADS):
+        self.output_folder_path = output_folder_path
+        self.output_format = output_format
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = []
+
+    def write(self, df, name):
+        """Queues the `name` dataframe to be written, returns the future of its path (None if writing is disabled)."""
+        if self.output_format is None:
+            return None
+        future = self._executor.submit(_write_output, df, self.output_folder_path, name, self.output_format)
+        self._futures.append(future)
+        return future
+
+    def flush(self):
+        """Waits until all the queued dataframes are written, and returns their paths. Raises the first write error."""
+        futures, self._futures = self._futures, []
+        return [future.result() for future in futures]
+
+    def close(self):
+        """Flushes the writer and stops its threads."""
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # the pending writes still complete, but their errors do not hide the one being raised
+            self._executor.shutdown()
+
+
+class BusFareTable(object):
+    """Bus fares compiled into an age x route matrix that fare lookups can index directly.
+
+    Parameters
+    ----------
+    fares: numpy array
+        Array of shape (MAX_AGE, number of routes): fares[age, column of the route]. The fares are kept as float64,
+        exactly as given in the input.
+    route_ids: list
+        Route id of each column of `fares`
+    """
+
+    def __init__(self, fares, route_ids):
+        self.fares = np.asarray(fares, dtype=float)
+        self.route_index = pd.Index(route_ids)
+
+    @classmethod
+    def from_frame(cls, bus_fare_per_route_df):
+        """Builds the table from a dataframe with rows = ages and columns = routes (see parse_bus_fare_input())."""
+        return cls(bus_fare_per_route_df.reindex(np.arange(MAX_AGE)).fillna(0).to_numpy(), bus_fare_per_route_df.columns)
+
+    def lookup(self, ages, routes):
+        """Returns the fares for the given ages and routes (NaN where the age or the route is not in the table)."""
+        ages = np.asarray(ages, dtype=float)
+        route_positions = self.route_index.get_indexer(routes)
+        missing = np.isnan(ages) | (ages < 0) | (ages >= self.fares.shape[0]) | (route_positions == -1)
+        fares = self.fares[np.where(missing, 0, ages).astype(int), route_positions]
+        fares[missing] = np.nan
+        return fares
+
+    def to_frame(self):
+        """Returns the table as a dataframe with rows = ages and columns = routes."""
+        return pd.DataFrame(self.fares.copy(), columns=self.route_index)
+
+
+def compile_bus_fares(bus_fare_data_df, route_ids):
+    """Compiles the `MassTransitFares.csv` input file into a BusFareTable
+
+    Fares with no `routeId` apply to every route and are overridden by the fares specific to a route. Among rows of the
+    same kind, the later ones win. Ages that no row covers are free.
+
+    Parameters
+    ----------
+    bus_fare_data_df: pandas DataFrame
+        Bus fares extracted from the "submission-inputs/MassTransitFares.csv"
+    route_ids: list of strings
+        All routes ids where buses operate (from `routes.txt` file in the GTFS data)
+
+    Returns
+    -------
+    bus_fare_table: BusFareTable
+        Fares indexed by age and route
+    """
+    # general fares first so that the route-specific ones are painted over them
+    fares_df = bus_fare_data_df.iloc[np.argsort(bus_fare_data_df['routeId'].notnull().to_numpy(), kind='mergesort')]
+
+    # age intervals look like `[6:15]` or `(5:16)`, exclusive bounds are shifted to make them all inclusive
+    bounds = fares_df['age'].astype(str).str.extract(r'^\s*([\[(])\s*(\d+)\s*:\s*(\d+)\s*([\])])\s*$', expand=True)
+    if bounds.isnull().to_numpy().any():
+        raise ValueError("Invalid age intervals in the bus fares: {}".format(
+            fares_df['age'][bounds.isnull().any(axis=1).to_numpy()].tolist()))
+    min_ages = bounds[1].astype(int).to_numpy() + (bounds[0] == '(').to_numpy()
+    max_ages = bounds[2].astype(int).to_numpy() - (bounds[3] == ')').to_numpy()
+
+    route_index = pd.Index(route_ids)
+    route_positions = route_index.get_indexer(fares_df['routeId'])
+    is_general = fares_df['routeId'].isnull().to_numpy()
+
+    if len(fares_df) == 0:
+        return BusFareTable(np.zeros((MAX_AGE, len(route_index))), route_index)
+
+    # covers[row, age, route]: whether the fare row applies to this age and route
+    ages = np.arange(MAX_AGE)
+    age_covers = (ages[None, :] >= min_ages[:, None]) & (ages[None, :] <= max_ages[:, None])
+    route_covers = is_general[:, None] | (route_positions[:, None] == np.arange(len(route_index))[None, :])
+    covers = age_covers[:, :, None] & route_covers[:, None, :]
+
+    # the last row covering each cell sets its fare
+    last_rows = len(fares_df) - 1 - np.argmax(covers[::-1], axis=0)
+    amounts = fares_df['amount'].to_numpy(dtype=float)
+    fares = np.where(covers.any(axis=0), amounts[last_rows], 0)
+
+    return BusFareTable(fares, route_index)
+
+
 def parse_bus_fare_input(bus_fare_data_df, route_ids):
     """Processes the `MassTransitFares.csv` input file into a dataframe with rows = ages and columns = routes
 
@@ -45,66 +253,72 @@ def parse_bus_fare_input(bus_fare_data_df, route_ids):
         Dataframe with rows = ages and columns = routes
     """
 
-    bus_fare_per_route_df = pd.DataFrame(np.zeros((120, len(route_ids))), columns=route_ids)
-
-    routes = bus_fare_data_df['routeId'].unique()
-    for r in routes:
-        if np.isnan(r):
-            cols = route_ids
-        else:
-            cols = int(r)
-        # get all fare rows for this route:
-        r_fares = bus_fare_data_df.loc[np.isnan(bus_fare_data_df['routeId']),]
-        for i, row in r_fares.iterrows():
-            age_group = row['age']
-            left = age_group[0]
-            ages = age_group[1:-1].split(':')
-            right = age_group[-1]
-            if left == '(':
-                min_a = int(ages[0]) + 1
-            else:
-                min_a = int(ages[0])
-            if right == ')':
-                max_a = int(ages[1]) - 1
-            else:
-                max_a = int(ages[1])
-                bus_fare_per_route_df.loc[min_a:max_a, cols] = float(row['amount'])
-
-    return bus_fare_per_route_df
+    return compile_bus_fares(bus_fare_data_df, route_ids).to_frame()
 
 
 def calc_fuel_costs(legs_df, fuel_cost_dict):
-    # legs_df: legs_dataframe
+    # legs_df: legs_dataframe (or path_traversals_dataframe)
     # fuel_cost_dict: {fuel_type: $/MJoule}
     # returns: legs_df augmented with an additional column of estimated fuel costs
 
-    legs_df.loc[:, "FuelCost"] = np.zeros(legs_df.shape[0])
-    for f in fuel_cost_dict.keys():
-        legs_df.loc[legs_df["fuelType"] == f.capitalize(), "FuelCost"] = (pd.to_numeric(
-            legs_df.loc[legs_df["fuelType"] == f.capitalize(), "fuel"]) * float(fuel_cost_dict[f])) / 1000000
+    # fuel types are looked up by their position in the prices: -1 (unknown fuel type) picks the trailing 0 price
+    prices = {f.capitalize(): float(price) for f, price in fuel_cost_dict.items()}
+    codes = pd.Index(list(prices)).get_indexer(np.asarray(legs_df["fuelType"], dtype=object))
+    price_per_code = np.append(np.fromiter(prices.values(), dtype=float, count=len(prices)), 0.0)
+
+    legs_df.loc[:, "FuelCost"] = np.where(codes >= 0, price_per_code[codes] * pd.to_numeric(legs_df["fuel"]) / 1000000, 0.0)
 
     return legs_df
 
 
-def calc_transit_fares(row, bus_fare_dict, person_df, trip_to_route):
-    pid = row['PID']
-    age = person_df.loc[pid,'Age']
-    vehicle = row['Veh']
-    route = trip_to_route[vehicle.split(':')[1]]
-    fare = bus_fare_dict.loc[age,route]
-    return fare
+def calc_transit_fares(bus_legs_df, bus_fare_dict, person_df, trip_to_route):
+    """ Computes the fare of each bus leg from the age of the passenger and the route of the bus
+
+    All the legs are handled at once: ages and routes are mapped in bulk, then the fares are picked from the
+    age x route matrix of the BusFareTable with numpy fancy indexing.
+
+    Parameters
+    ----------
+    bus_legs_df: pandas DataFrame
+        Bus legs of the legs_dataframe (with the `PID` and `Veh` columns)
+
+    bus_fare_dict: BusFareTable or pandas DataFrame
+        Output of the compile_bus_fares() function, or dataframe with rows = ages and columns = routes: output of the
+        parse_bus_fare_input() function
+
+    person_df: pandas DataFrame
+        Record of each person's attributes, indexed by PID (with the `Age` column)
+
+    trip_to_route: dictionary
+        route_id / trip_id correspondence
+
+    Returns
+    -------
+    fares: numpy array
+        Fare of each bus leg (NaN if the age or the route of the leg is not in the fare matrix)
+    """
+    if isinstance(bus_fare_dict, pd.DataFrame):
+        bus_fare_dict = BusFareTable.from_frame(bus_fare_dict)
+
+    ages = bus_legs_df['PID'].map(person_df['Age'])
+    # bus vehicle ids are formatted as `<agency>:<trip_id>`
+    routes = bus_legs_df['Veh'].str.split(':').str[1].map(trip_to_route)
+
+    return bus_fare_dict.lookup(ages, routes)
 
 
 def calc_fares(legs_df, ride_hail_fares, bus_fare_dict, person_df, trip_to_route):
     # legs_df: legs_dataframe
     # ride_hail_fares: {'base': $, 'duration': $/hour, 'distance': $/km}
-    # transit_fares isnt being used currently - would need to be updated to compute fare based on age
+    # bus_fare_dict: age x route fare matrix, output of compile_bus_fares() or parse_bus_fare_input()
     # returns: legs_df augmented with an additional column of estimated transit and on-demand ride fares
 
     legs_df["Fare"] = np.zeros(legs_df.shape[0])
 
-    legs_df.loc[legs_df["Mode"] == 'bus', "Fare"] = legs_df.loc[legs_df["Mode"] == 'bus'].apply(
-        lambda row: calc_transit_fares(row, bus_fare_dict, person_df, trip_to_route), axis=1)
+    is_bus = legs_df["Mode"].isin(TRANSIT_MODES).to_numpy()
+    if is_bus.any():
+        legs_df.loc[is_bus, "Fare"] = calc_transit_fares(legs_df.loc[is_bus], bus_fare_dict, person_df,
+                                                         trip_to_route)
 
     legs_df.loc[legs_df["Mode"] == 'OnDemand_ride', "Fare"] = ride_hail_fares['base'] + (
                 pd.to_timedelta(legs_df['Duration_sec']).dt.seconds / 60) * float(ride_hail_fares['duration']) + (
@@ -167,7 +381,7 @@ def parse_transit_trips(row, non_bus_path_traversal_events, bus_path_traversal_e
                 enter_veh_events['time'] <= end_time)]
 
     # get bus entry events for this person & trip
-    bus_entries = veh_entries[veh_entries['vehicle'].str.startswith('siouxareametro-sd-us:', na=False)]
+    bus_entries = veh_entries[veh_entries['is_transit']]
     bus_entries = bus_entries.reset_index(drop=True)
 
     if len(bus_entries) > 0:
@@ -262,18 +476,19 @@ def parse_walk_car_trips(row, path_traversal_events, enter_veh_events):
                     path_traversal_events['departureTime'] >= start_time.total_seconds()),]
     path_trav.reset_index(drop=True, inplace=True)
     # iterate through the path traversals
-    if len(path_trav > 0):
+    if len(path_trav) > 0:
         these_legs = path_trav.apply(lambda row: one_path(row, leg_id, pid, trip_id), axis=1)
         leg_array.extend(these_legs)
     return leg_array
 
 
-def parse_ridehail_trips(row, path_traversal_events, enter_veh_events):
+def parse_ridehail_trips(row, path_traversal_events, enter_veh_events, diagnostics=None):
     # inputs:
     # row: a row from transit_trips_df
     # path_traversal_events: non-transit path traversal df
     # person_costs: person cost events df
     # enter_veh_events: enter vehicle events
+    # diagnostics: list to which the trip is added (with RIDEHAIL_DIAGNOSTICS_COLUMNS) if it cannot be matched
 
     leg_array = []
     pid = row['PID']
@@ -291,18 +506,17 @@ def parse_ridehail_trips(row, path_traversal_events, enter_veh_events):
                     enter_veh_events['time'] <= end_time),]
     veh_entry2 = veh_entry.loc[(veh_entry['vehicle'] != 'body-' + pid),]
 
-
-       
+    veh_id = None
     try:
         veh_id = veh_entry2['vehicle'].item()
         leg_start_time = veh_entry2['time'].item()
         # get the path traversal corresponding to this ridehail trip
         path_trav = path_traversal_events.loc[(path_traversal_events['vehicle'] == veh_id) & (
                     path_traversal_events['departureTime'] == int(leg_start_time)) & (path_traversal_events['numPassengers'] > 0),]
-    except: 
+    except ValueError:
+        # .item() raises a ValueError unless the person entered exactly one vehicle
         path_trav = []
-        print(row)
-        
+
     leg_id += 1
     # create leg ID
     leg_id_full = trip_id + "_l-" + str(leg_id)
@@ -318,10 +532,553 @@ def parse_ridehail_trips(row, path_traversal_events, enter_veh_events):
         leg_array.append(
             [pid, trip_id, leg_id_full, leg_mode, veh_id, veh_type, leg_start_time, leg_end_time, leg_duration,
              distance, leg_path, leg_fuel, leg_fuel_type])
+    elif diagnostics is not None:
+        if veh_id is not None:
+            reason = 'no_path_traversal'
+        elif len(veh_entry2) == 0:
+            reason = 'no_vehicle_entry'
+        else:
+            reason = 'multiple_vehicle_entries'
+        diagnostics.append([pid, trip_id, start_time.total_seconds(), end_time, veh_id, reason])
     return leg_array
 
 
+class _TimeWindowIndex(object):
+    """Row positions of an events DataFrame grouped by a key column and sorted by a time column.
+
+    The rows of one key (person, driver or vehicle) falling in a time window are then found by binary search instead
+    of applying boolean masks over the whole DataFrame.
+
+    Parameters
+    ----------
+    keys: numpy array
+        Value of the key column for each row (e.g. `driver`, `person` or `vehicle`)
+    times: numpy array
+        Value of the time column for each row (e.g. `departureTime` or `time`)
+    """
+
+    def __init__(self, keys, times):
+        codes, uniques = pd.factorize(keys)
+        self._codes = {key: code for code, key in enumerate(uniques)}
+        self._order = np.lexsort((times, codes))
+        self._times = np.asarray(times, dtype=float)[self._order]
+        self._bounds = np.searchsorted(codes[self._order], np.arange(len(uniques) + 1))
+
+    def positions(self, key, start=-np.inf, end=np.inf):
+        """Returns the positions of the rows of `key` such that start <= time <= end, sorted by time."""
+        code = self._codes.get(key)
+        if code is None:
+            return self._order[:0]
+        lower, upper = self._bounds[code], self._bounds[code + 1]
+        times = self._times[lower:upper]
+        return self._order[lower + np.searchsorted(times, start, side='left'):
+                           lower + np.searchsorted(times, end, side='right')]
+
+
+class _BusTraversalIndex(object):
+    """Path traversals of each transit vehicle sorted by departure time, with the running sum of their lengths.
+
+    The traversals of a vehicle during a transit leg are found by binary search on the departure and arrival times,
+    and their total length by a difference of running sums. For the few vehicles whose traversals do not arrive in the
+    same order as they depart (or are not in that order in the DataFrame), the arrival times are masked instead.
+
+    Parameters
+    ----------
+    vehicles, departure_times, arrival_times, lengths: numpy arrays
+        `vehicle`, `departureTime`, `arrivalTime` and `length` columns of the bus path traversal events
+    """
+
+    def __init__(self, vehicles, departure_times, arrival_times, lengths):
+        codes, uniques = pd.factorize(vehicles)
+        self._codes = {key: code for code, key in enumerate(uniques)}
+        # lexsort is stable: traversals departing at the same time stay in DataFrame order
+        self._order = np.lexsort((departure_times, codes))
+        sorted_codes = codes[self._order]
+        self._departures = np.asarray(departure_times, dtype=float)[self._order]
+        self._arrivals = np.asarray(arrival_times, dtype=float)[self._order]
+        self._lengths = np.asarray(lengths, dtype=float)[self._order]
+        self._bounds = np.searchsorted(sorted_codes, np.arange(len(uniques) + 1))
+        # running sum of the lengths, restarting at each vehicle
+        self._length_sums = pd.Series(self._lengths).groupby(sorted_codes).cumsum().to_numpy()
+
+        same_vehicle = sorted_codes[1:] == sorted_codes[:-1]
+        in_order = (self._order[1:] > self._order[:-1]) & (self._arrivals[1:] >= self._arrivals[:-1])
+        self._monotone = np.ones(len(uniques), dtype=bool)
+        self._monotone[sorted_codes[1:][same_vehicle & ~in_order]] = False
+
+    def traversals(self, vehicle, start, end, include_end=True):
+        """Returns the positions (in DataFrame order) of the traversals of `vehicle` departing at or after `start` and
+        arriving before `end` (or at `end` if `include_end`), and their total length."""
+        code = self._codes.get(vehicle)
+        if code is None:
+            return self._order[:0], 0.0
+        lower, upper = self._bounds[code], self._bounds[code + 1]
+        first = lower + np.searchsorted(self._departures[lower:upper], start, side='left')
+        side = 'right' if include_end else 'left'
+
+        if self._monotone[code]:
+            # the traversals arriving before `end` are the first ones of the vehicle
+            last = max(first, lower + np.searchsorted(self._arrivals[lower:upper], end, side=side))
+            if last == first:
+                return self._order[:0], 0.0
+            length = self._length_sums[last - 1] - (self._length_sums[first - 1] if first > lower else 0.0)
+            return self._order[first:last], length
+
+        arrivals = self._arrivals[first:upper]
+        matches = first + np.flatnonzero(arrivals <= end if include_end else arrivals < end)
+        return np.sort(self._order[matches]), self._lengths[matches].sum()
+
+
+def _path_traversal_leg(pt, position, leg_id, pid, trip_id):
+    # indexed counterpart of one_path(): builds the leg record of one path traversal from the column arrays `pt`
+    departure_time = pt['departureTime'][position]
+    arrival_time = pt['arrivalTime'][position]
+    return [pid, trip_id, trip_id + "_l-" + str(leg_id), pt['mode'][position], pt['vehicle'][position],
+            pt['vehicleType'][position], departure_time, arrival_time, int(arrival_time) - int(departure_time),
+            pt['length'][position], pt['links'][position], pt['fuel'][position], pt['fuelType'][position]]
+
+
+def _driver_path_traversals(pt, driver_index, pid, start_time, end_time):
+    # positions (in DataFrame order) of the path traversals driven by `pid` within [start_time, end_time]
+    candidates = driver_index.positions(pid, start=start_time)
+    return np.sort(candidates[pt['arrivalTime'][candidates] <= end_time])
+
+
+def _indexed_walk_car_legs(pt, driver_index, pid, trip_id, start_time, end_time):
+    # indexed counterpart of parse_walk_car_trips()
+    return [_path_traversal_leg(pt, p, 0, pid, trip_id)
+            for p in _driver_path_traversals(pt, driver_index, pid, start_time, end_time)]
+
+
+def _indexed_transit_legs(pt, driver_index, bus_pt, bus_index, entries, entry_index, pid, trip_id, start_time,
+                          end_time):
+    # indexed counterpart of parse_transit_trips()
+    veh_entries = np.sort(entry_index.positions(pid, start_time, end_time))
+    bus_entries = veh_entries[entries['is_transit'][veh_entries]]
+    if len(bus_entries) == 0:
+        # if the agent underwent replanning, there will be no bus entry
+        return _indexed_walk_car_legs(pt, driver_index, pid, trip_id, start_time, end_time)
+
+    leg_array = []
+    leg_id = 0
+    path_trav = _driver_path_traversals(pt, driver_index, pid, start_time, end_time)
+    arrival_times = pt['arrivalTime'][path_trav]
+    entry_times = entries['time'][bus_entries]
+    prev_entry_time = start_time
+    for idx, entry_time in enumerate(entry_times):
+        next_entry_time = entry_times[idx + 1] if idx < len(entry_times) - 1 else end_time
+        prev_path_trav = path_trav[(arrival_times <= entry_time) & (arrival_times >= prev_entry_time)]
+        post_path_trav = path_trav[(arrival_times > entry_time) & (arrival_times <= next_entry_time)]
+        prev_entry_time = entry_time
+
+        leg_array.extend(_path_traversal_leg(pt, p, leg_id, pid, trip_id) for p in prev_path_trav)
+
+        # record transit leg
+        leg_id += 1
+        veh_id = entries['vehicle'][bus_entries[idx]]
+        leg_start_time = int(entry_time)
+        if len(post_path_trav) > 0:
+            leg_end_time = int(pt['departureTime'][post_path_trav[0]])
+            bus_path_trav, distance = bus_index.traversals(veh_id, leg_start_time, leg_end_time)
+        else:
+            leg_end_time = next_entry_time
+            bus_path_trav, distance = bus_index.traversals(veh_id, leg_start_time, leg_end_time, include_end=False)
+        if len(bus_path_trav) > 0:
+            leg_array.append(
+                [pid, trip_id, trip_id + "_l-" + str(leg_id), bus_pt['mode'][bus_path_trav[0]], veh_id,
+                 bus_pt['vehicleType'][bus_path_trav[0]], leg_start_time, leg_end_time,
+                 int(leg_end_time - entry_time), distance,
+                 list(bus_pt['links'][bus_path_trav]), 0, 'Diesel'])
+
+        leg_array.extend(_path_traversal_leg(pt, p, leg_id, pid, trip_id) for p in post_path_trav)
+
+    return leg_array
+
+
+class _RideHailIndex(object):
+    """Positions of the path traversals carrying passengers, hashed by (vehicle, departureTime).
+
+    The traversal of a ride-hail leg is then found in constant time from the vehicle the person entered and the time
+    they entered it. When several traversals share a key, the first one (in DataFrame order) is kept.
+
+    Parameters
+    ----------
+    vehicles, departure_times, num_passengers: numpy arrays
+        `vehicle`, `departureTime` and `numPassengers` columns of the path traversal events
+    """
+
+    def __init__(self, vehicles, departure_times, num_passengers):
+        # reversed, so that the first traversal of a key is the last one written in the dictionary
+        positions = np.flatnonzero(np.asarray(num_passengers, dtype=float) > 0)[::-1]
+        self._positions = dict(zip(zip(vehicles[positions], np.asarray(departure_times, dtype=float)[positions]),
+                                   positions))
+
+    def position(self, vehicle, departure_time):
+        """Returns the position of the traversal of `vehicle` departing at `departure_time`, or None."""
+        return self._positions.get((vehicle, float(departure_time)))
+
+
+def _match_ridehail_trip(pt, ridehail_index, entries, entry_index, pid, trip_id, start_time, end_time):
+    # indexed counterpart of parse_ridehail_trips(): returns the legs of the trip, and the reason why it has none
+    # (one of RIDEHAIL_UNMATCHED_REASONS) and the vehicle entered if it could not be matched
+    veh_entries = entry_index.positions(pid, start_time, end_time)
+    veh_entries = veh_entries[entries['vehicle'][veh_entries] != 'body-' + pid]
+    if len(veh_entries) == 0:
+        return [], 'no_vehicle_entry', None
+    if len(veh_entries) > 1:
+        return [], 'multiple_vehicle_entries', None
+    veh_id = entries['vehicle'][veh_entries[0]]
+    leg_start_time = entries['time'][veh_entries[0]]
+    position = ridehail_index.position(veh_id, int(leg_start_time))
+    if position is None:
+        return [], 'no_path_traversal', veh_id
+    leg_end_time = pt['arrivalTime'][position]
+    return [[pid, trip_id, trip_id + "_l-1", 'OnDemand_ride', veh_id, pt['vehicleType'][position], leg_start_time,
+             leg_end_time, int(leg_end_time) - int(leg_start_time), pt['length'][position], pt['links'][position],
+             pt['fuel'][position], pt['fuelType'][position]]], None, veh_id
+
+
+def _column_arrays(df, columns):
+    return {column: df[column].to_numpy() for column in columns}
+
+
+def _parse_legs_indexed(trips_df, non_bus_path_traversal_events, bus_path_traversal_events, enter_veh_events,
+                        diagnostics):
+    """Reconstructs the legs of every trip with the same rules as the parse_*_trips() functions.
+
+    The path traversal and vehicle entry events are sorted and grouped once, by driver/person and by vehicle, so each
+    trip only looks at its own events (found by binary search on its time window) instead of the whole DataFrames.
+    The ride-hail trips which cannot be matched are added to `diagnostics`.
+    """
+    pt = _column_arrays(non_bus_path_traversal_events, ['driver', 'vehicle', 'vehicleType', 'length', 'numPassengers',
+                                                        'departureTime', 'arrivalTime', 'mode', 'links', 'fuel',
+                                                        'fuelType'])
+    bus_pt = _column_arrays(bus_path_traversal_events, ['vehicle', 'vehicleType', 'length', 'departureTime',
+                                                        'arrivalTime', 'mode', 'links'])
+    entries = _column_arrays(enter_veh_events, ['time', 'person', 'vehicle'])
+    entries['is_transit'] = enter_veh_events['is_transit'].to_numpy()
+
+    driver_index = _TimeWindowIndex(pt['driver'], pt['departureTime'])
+    ridehail_index = _RideHailIndex(pt['vehicle'], pt['departureTime'], pt['numPassengers'])
+    bus_index = _BusTraversalIndex(bus_pt['vehicle'], bus_pt['departureTime'], bus_pt['arrivalTime'], bus_pt['length'])
+    entry_index = _TimeWindowIndex(entries['person'], entries['time'])
+
+    def trips_of(modes):
+        trips = trips_df[trips_df['Mode'].isin(modes)]
+        return zip(trips['PID'], trips['Trip_ID'], trips['Start_time'].dt.total_seconds(), trips['End_time'])
+
+    legs_array = []
+    for pid, trip_id, start_time, end_time in trips_of(RIDEHAIL_TRIP_MODES):
+        legs, reason, veh_id = _match_ridehail_trip(pt, ridehail_index, entries, entry_index, pid, trip_id,
+                                                    start_time, end_time)
+        legs_array.extend(legs)
+        if reason is not None:
+            diagnostics.append([pid, trip_id, start_time, end_time, veh_id, reason])
+    for pid, trip_id, start_time, end_time in trips_of(TRANSIT_TRIP_MODES):
+        legs_array.extend(_indexed_transit_legs(pt, driver_index, bus_pt, bus_index, entries, entry_index, pid,
+                                                trip_id, start_time, end_time))
+    for pid, trip_id, start_time, end_time in trips_of(WALK_CAR_TRIP_MODES):
+        legs_array.extend(_indexed_walk_car_legs(pt, driver_index, pid, trip_id, start_time, end_time))
+    return legs_array
+
+
+def _path_traversal_legs_frame(matches, leg_id):
+    # builds the leg records of the path traversals in `matches` (trips joined to path traversals)
+    legs = pd.DataFrame({
+        'PID': matches['PID'].to_numpy(),
+        'Trip_ID': matches['Trip_ID'].to_numpy(),
+        'Leg_ID': matches['Trip_ID'].to_numpy() + "_l-" + np.asarray(leg_id).astype(str),
+        'Mode': matches['mode'].to_numpy(),
+        'Veh': matches['vehicle'].to_numpy(),
+        'Veh_type': matches['vehicleType'].to_numpy(),
+        'Start_time': matches['departureTime'].to_numpy(),
+        'End_time': matches['arrivalTime'].to_numpy(),
+        'Duration_sec': matches['arrivalTime'].to_numpy().astype(np.int64) - matches['departureTime'].to_numpy().astype(np.int64),
+        'Distance_m': matches['length'].to_numpy(),
+        'Path': matches['links'].to_numpy(),
+        'fuel': matches['fuel'].to_numpy(),
+        'fuelType': matches['fuelType'].to_numpy()}, columns=LEGS_COLUMNS)
+    return legs
+
+
+def _sort_keys(legs, trips, entry, part, pt_pos):
+    # keys ordering the legs as the row-wise engine emits them:
+    # trip block (ride-hail, transit, walk/car), trip, bus entry, part of the bus entry (before, bus, after), event
+    legs['_block'] = np.asarray(trips['_block'])
+    legs['_trip'] = np.asarray(trips['_trip'])
+    legs['_entry'] = entry
+    legs['_part'] = part
+    legs['_event'] = pt_pos
+    return legs
+
+
+def _window_join(left, right, left_on, right_on, start, end, time):
+    """Joins the rows of `left` to the rows of `right` with the same key whose `time` is within [start, end].
+
+    The right rows are sorted once by (key, time) and the window of each left row is found by binary search, so only
+    the rows in the window are joined, instead of all the rows of the key before filtering on the window. The joined
+    rows are ordered by left row, then by time (then by right row).
+    """
+    num_left = len(left)
+    codes = pd.factorize(np.concatenate([left[left_on].to_numpy(dtype=object),
+                                         right[right_on].to_numpy(dtype=object)]))[0]
+    left_codes, right_codes = codes[:num_left], codes[num_left:]
+    starts = left[start].to_numpy(dtype=float)
+    ends = left[end].to_numpy(dtype=float)
+    times = right[time].to_numpy(dtype=float)
+
+    # (key, time) pairs as exact int64 keys: the times are replaced by their rank among all the times
+    valid = ~np.isnan(times)
+    all_times = np.concatenate([starts, ends, times[valid]])
+    known = ~np.isnan(all_times)
+    time_ranks = np.full(len(all_times), -1, dtype=np.int64)
+    time_ranks[known] = np.unique(all_times[known], return_inverse=True)[1].reshape(-1)
+    scale = len(all_times) + 1
+    start_keys = left_codes * scale + time_ranks[:num_left]
+    end_keys = left_codes * scale + time_ranks[num_left:2 * num_left]
+    right_positions = np.flatnonzero(valid)
+    right_keys = right_codes[valid] * scale + time_ranks[2 * num_left:]
+
+    order = np.argsort(right_keys, kind='mergesort')
+    sorted_keys = right_keys[order]
+    lower = np.searchsorted(sorted_keys, start_keys, side='left')
+    upper = np.searchsorted(sorted_keys, end_keys, side='right')
+    counts = np.where(np.isnan(starts) | np.isnan(ends), 0, np.maximum(upper - lower, 0))
+
+    left_positions = np.repeat(np.arange(num_left), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    right_matches = right_positions[order[np.repeat(lower, counts) + offsets]]
+    return pd.concat([left.iloc[left_positions].reset_index(drop=True),
+                      right.iloc[right_matches].reset_index(drop=True)], axis=1)
+
+
+def _parse_legs_vectorized(trips_df, non_bus_path_traversal_events, bus_path_traversal_events, enter_veh_events):
+    """Reconstructs the legs of every trip with the same rules as the parse_*_trips() functions, using joins between
+    the trips and the events DataFrames instead of one pass over the events per trip.
+
+    Each trip's time window is resolved by joining the trips to the events of the same person (or vehicle) within
+    the window (see _window_join()), so the legs, their numbering and their order are those of the row-wise engine.
+
+    Returns the legs DataFrame and the ride-hail trips which cannot be matched (with RIDEHAIL_DIAGNOSTICS_COLUMNS).
+    """
+    trips = trips_df[['PID', 'Trip_ID', 'Mode']].copy()
+    trips['_trip'] = np.arange(len(trips))
+    trips['_block'] = np.select([trips['Mode'].isin(RIDEHAIL_TRIP_MODES), trips['Mode'].isin(TRANSIT_TRIP_MODES),
+                                 trips['Mode'].isin(WALK_CAR_TRIP_MODES)], [0, 1, 2], -1)
+    trips['_start'] = trips_df['Start_time'].dt.total_seconds().values
+    trips['_end'] = trips_df['End_time'].to_numpy()
+    trips = trips[trips['_block'] >= 0]
+
+    pt = non_bus_path_traversal_events.reset_index(drop=True)
+    pt['_pt'] = np.arange(len(pt))
+    bus_pt = bus_path_traversal_events.reset_index(drop=True)
+    bus_pt['_bus_pt'] = np.arange(len(bus_pt))
+    entries = enter_veh_events[['time', 'person', 'vehicle', 'is_transit']].reset_index(drop=True)
+    entries.columns = ['_time', '_person', '_vehicle', '_is_transit']
+    entries['_entry_pos'] = np.arange(len(entries))
+
+    def driven_path_traversals(selected_trips):
+        # the traversals arriving by the end of the trip departed by then too
+        joined = _window_join(selected_trips, pt, 'PID', 'driver', '_start', '_end', 'departureTime')
+        return joined[joined['arrivalTime'] <= joined['_end']]
+
+    legs_frames = []
+
+    # ride-hail trips: the single non-body vehicle entry of the trip, and the path traversal with passengers of that
+    # vehicle departing at the time of the entry
+    ridehail_trips = trips[trips['_block'] == 0]
+    ridehail_entries = _window_join(ridehail_trips, entries, 'PID', '_person', '_start', '_end', '_time')
+    ridehail_entries = ridehail_entries[ridehail_entries['_vehicle'] != 'body-' + ridehail_entries['PID']]
+    num_entries = ridehail_entries.groupby('_trip')['_entry_pos'].transform('size')
+    num_trip_entries = ridehail_trips['_trip'].map(ridehail_entries.groupby('_trip').size()).fillna(0).to_numpy()
+    ridehail_entries = ridehail_entries[num_entries == 1]
+    ridehail_entries = ridehail_entries.assign(_departure=ridehail_entries['_time'].astype(np.int64).astype(float))
+    ridehail = ridehail_entries.merge(pt[pt['numPassengers'] > 0], left_on=['_vehicle', '_departure'],
+                                      right_on=['vehicle', 'departureTime'])
+    ridehail = ridehail.sort_values('_pt', kind='mergesort').drop_duplicates('_trip')
+    ridehail_legs = _path_traversal_legs_frame(ridehail, 1)
+    ridehail_legs['Mode'] = 'OnDemand_ride'
+    ridehail_legs['Start_time'] = ridehail['_time'].to_numpy()
+    ridehail_legs['Duration_sec'] = (ridehail['arrivalTime'].to_numpy().astype(np.int64) -
+                                     ridehail['_time'].to_numpy().astype(np.int64))
+    legs_frames.append(_sort_keys(ridehail_legs, ridehail, 0, 0, 0))
+
+    # ride-hail trips without a leg, with the reason why (as _match_ridehail_trip() gives it)
+    reasons = np.select([num_trip_entries == 0, num_trip_entries > 1,
+                         ~ridehail_trips['_trip'].isin(ridehail['_trip']).to_numpy()], RIDEHAIL_UNMATCHED_REASONS, '')
+    unmatched = ridehail_trips[reasons != '']
+    diagnostics_df = pd.DataFrame({
+        'PID': unmatched['PID'].to_numpy(),
+        'Trip_ID': unmatched['Trip_ID'].to_numpy(),
+        'Start_time': unmatched['_start'].to_numpy(),
+        'End_time': unmatched['_end'].to_numpy(),
+        'Veh': unmatched['_trip'].map(ridehail_entries.set_index('_trip')['_vehicle']).to_numpy(),
+        'reason': reasons[reasons != '']}, columns=RIDEHAIL_DIAGNOSTICS_COLUMNS)
+
+    # transit trips: number the bus entries of each trip and find the time of the previous and next ones
+    bus_entries = _window_join(trips[trips['_block'] == 1], entries[entries['_is_transit']].drop(columns='_is_transit'),
+                               'PID', '_person', '_start', '_end', '_time')
+    bus_entries = bus_entries.sort_values(['_trip', '_entry_pos'], kind='mergesort')
+    by_trip = bus_entries.groupby('_trip')['_time']
+    bus_entries['_entry'] = by_trip.cumcount().values
+    bus_entries['_prev_time'] = by_trip.shift(1).fillna(bus_entries['_start']).values
+    bus_entries['_next_time'] = by_trip.shift(-1).fillna(bus_entries['_end']).values
+
+    # path traversals before (after) each bus entry, i.e. arriving between the previous (current) and the current
+    # (next) bus entries
+    transit_path_traversals = driven_path_traversals(bus_entries)
+    arrival_times = transit_path_traversals['arrivalTime']
+    before = transit_path_traversals[(arrival_times <= transit_path_traversals['_time']) &
+                                     (arrival_times >= transit_path_traversals['_prev_time'])]
+    after = transit_path_traversals[(arrival_times > transit_path_traversals['_time']) &
+                                    (arrival_times <= transit_path_traversals['_next_time'])]
+    legs_frames.append(_sort_keys(_path_traversal_legs_frame(before, before['_entry'].to_numpy()), before,
+                                  before['_entry'].to_numpy(), 0, before['_pt'].to_numpy()))
+    legs_frames.append(_sort_keys(_path_traversal_legs_frame(after, after['_entry'].to_numpy() + 1), after,
+                                  after['_entry'].to_numpy(), 2, after['_pt'].to_numpy()))
+
+    # bus legs: from the bus entry to the departure of the first path traversal after it (or to the next entry)
+    first_after = after.sort_values('_pt', kind='mergesort').drop_duplicates(['_trip', '_entry'])
+    first_after = first_after.set_index(['_trip', '_entry'])['departureTime']
+    bus_entries = bus_entries.join(first_after.rename('_first_after'), on=['_trip', '_entry'])
+    has_after = bus_entries['_first_after'].notnull()
+    bus_entries['_leg_start'] = bus_entries['_time'].astype(np.int64)
+    bus_entries['_leg_end'] = np.where(has_after, bus_entries['_first_after'].fillna(0).astype(np.int64),
+                                       bus_entries['_next_time'])
+    bus_entries['_has_after'] = has_after
+    bus_legs = _window_join(bus_entries, bus_pt, '_vehicle', 'vehicle', '_leg_start', '_leg_end', 'departureTime')
+    bus_legs = bus_legs[(bus_legs['arrivalTime'] < bus_legs['_leg_end']) |
+                        (bus_legs['_has_after'] & (bus_legs['arrivalTime'] == bus_legs['_leg_end']))]
+    bus_legs = bus_legs.sort_values(['_trip', '_entry', '_bus_pt'], kind='mergesort')
+    bus_legs = bus_legs.groupby(['_trip', '_entry'], sort=False).agg(
+        {'PID': 'first', 'Trip_ID': 'first', '_block': 'first', '_time': 'first', '_vehicle': 'first',
+         '_leg_start': 'first', '_leg_end': 'first', 'mode': 'first', 'vehicleType': 'first', 'length': 'sum',
+         'links': list}).reset_index()
+    bus_legs_df = pd.DataFrame({
+        'PID': bus_legs['PID'].to_numpy(),
+        'Trip_ID': bus_legs['Trip_ID'].to_numpy(),
+        'Leg_ID': bus_legs['Trip_ID'].to_numpy() + "_l-" + (bus_legs['_entry'].to_numpy() + 1).astype(str),
+        'Mode': bus_legs['mode'].to_numpy(),
+        'Veh': bus_legs['_vehicle'].to_numpy(),
+        'Veh_type': bus_legs['vehicleType'].to_numpy(),
+        'Start_time': bus_legs['_leg_start'].to_numpy(),
+        'End_time': bus_legs['_leg_end'].to_numpy(),
+        'Duration_sec': (bus_legs['_leg_end'].to_numpy() - bus_legs['_time'].to_numpy()).astype(np.int64),
+        'Distance_m': bus_legs['length'].to_numpy(),
+        'Path': bus_legs['links'].to_numpy(),
+        'fuel': 0,
+        'fuelType': 'Diesel'}, columns=LEGS_COLUMNS)
+    legs_frames.append(_sort_keys(bus_legs_df, bus_legs, bus_legs['_entry'].to_numpy(), 1, 0))
+
+    # walk and car trips, and transit trips without bus entries (if the agent underwent replanning)
+    walk_car_trips = trips[(trips['_block'] == 2) |
+                           ((trips['_block'] == 1) & ~trips['_trip'].isin(bus_entries['_trip']))]
+    walk_car = driven_path_traversals(walk_car_trips)
+    legs_frames.append(_sort_keys(_path_traversal_legs_frame(walk_car, 0), walk_car, 0, 0, walk_car['_pt'].to_numpy()))
+
+    legs_df = pd.concat(legs_frames, ignore_index=True, sort=False)
+    legs_df = legs_df.sort_values(['_block', '_trip', '_entry', '_part', '_event'], kind='mergesort')
+    return legs_df[LEGS_COLUMNS].reset_index(drop=True), diagnostics_df
+
+
+def _parse_legs(engine, trips_df, non_bus_path_traversal_events, bus_path_traversal_events, enter_veh_events):
+    """Reconstructs the legs of every trip of `trips_df` with the given engine (see get_legs_output()).
+
+    Returns the legs DataFrame and the ride-hail trips which could not be matched, found while matching them.
+    """
+    if engine == 'vectorized':
+        return _parse_legs_vectorized(trips_df, non_bus_path_traversal_events, bus_path_traversal_events,
+                                      enter_veh_events)
+
+    diagnostics = []
+    if engine == 'indexed':
+        legs_array = _parse_legs_indexed(trips_df, non_bus_path_traversal_events, bus_path_traversal_events,
+                                         enter_veh_events, diagnostics)
+    else:
+        legs_array = _parse_legs_rowwise(trips_df, non_bus_path_traversal_events, bus_path_traversal_events,
+                                         enter_veh_events, diagnostics)
+
+    # convert the leg array to a dataframe
+    return pd.DataFrame(legs_array, columns=LEGS_COLUMNS), pd.DataFrame(diagnostics,
+                                                                        columns=RIDEHAIL_DIAGNOSTICS_COLUMNS)
+
+
+def _parse_legs_sharded(engine, n_jobs, trips_df, non_bus_path_traversal_events, bus_path_traversal_events,
+                        enter_veh_events):
+    """Reconstructs the legs of every trip in `n_jobs` processes, each parsing the trips of a partition of the persons.
+
+    The trips are hash-partitioned by PID. Each process only receives the events its trips can use: the vehicle
+    entries of its persons, the path traversals they drove, and the path traversals of the vehicles they entered
+    (ride-hail vehicles and buses). The legs of all partitions are then put back in the order of the single-process
+    engines.
+    """
+    shards = pd.util.hash_pandas_object(trips_df['PID'], index=False).to_numpy() % n_jobs
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = []
+        for shard in range(n_jobs):
+            shard_trips_df = trips_df[shards == shard]
+            pids = shard_trips_df['PID'].unique()
+            shard_enter_veh_events = enter_veh_events[enter_veh_events['person'].isin(pids)]
+            vehicles = shard_enter_veh_events['vehicle'].unique()
+            shard_non_bus_path_traversal_events = non_bus_path_traversal_events[
+                non_bus_path_traversal_events['driver'].isin(pids) |
+                non_bus_path_traversal_events['vehicle'].isin(vehicles)]
+            shard_bus_path_traversal_events = bus_path_traversal_events[
+                bus_path_traversal_events['vehicle'].isin(vehicles)]
+            futures.append(executor.submit(_parse_legs, engine, shard_trips_df, shard_non_bus_path_traversal_events,
+                                           shard_bus_path_traversal_events, shard_enter_veh_events))
+        results = [future.result() for future in futures]
+        legs_df = pd.concat([legs for legs, _ in results], ignore_index=True)
+        diagnostics_df = pd.concat([diagnostics for _, diagnostics in results], ignore_index=True)
+
+    # order the legs by trip block (ride-hail, transit, walk/car) then by trip, as the single-process engines do
+    block = np.select([trips_df['Mode'].isin(RIDEHAIL_TRIP_MODES), trips_df['Mode'].isin(TRANSIT_TRIP_MODES)], [0, 1],
+                      2)
+    trip_order = pd.Series(block * len(trips_df) + np.arange(len(trips_df)), index=trips_df['Trip_ID'].to_numpy())
+    legs_order = np.argsort(legs_df['Trip_ID'].map(trip_order).to_numpy(), kind='mergesort')
+    diagnostics_order = np.argsort(diagnostics_df['Trip_ID'].map(trip_order).to_numpy(), kind='mergesort')
+    return (legs_df.iloc[legs_order].reset_index(drop=True),
+            diagnostics_df.iloc[diagnostics_order].reset_index(drop=True))
+
+
+def _parse_legs_rowwise(trips_df, non_bus_path_traversal_events, bus_path_traversal_events, enter_veh_events,
+                        diagnostics):
+    """Reconstructs the legs of every trip by applying the parse_*_trips() functions to each row of `trips_df`.
+
+    The ride-hail trips which cannot be matched are added to `diagnostics`.
+    """
+    legs_array = []
+
+    # record all legs corresponding to OnDemand_ride trips
+    on_demand_ride_trips = trips_df.loc[trips_df['Mode'].isin(RIDEHAIL_TRIP_MODES),]
+    on_demand_ride_legs_array = on_demand_ride_trips.apply(
+        lambda row: parse_ridehail_trips(row, non_bus_path_traversal_events, enter_veh_events, diagnostics), axis=1)
+    for bit in on_demand_ride_legs_array.tolist():
+        legs_array.extend(tid for tid in bit)
+
+    # record all legs corresponding to transit trips
+    transit_trips_df = trips_df[trips_df['Mode'].isin(TRANSIT_TRIP_MODES)]
+    transit_legs_array = transit_trips_df.apply(
+        lambda row: parse_transit_trips(row, non_bus_path_traversal_events, bus_path_traversal_events, enter_veh_events),
+        axis=1)
+    for bit in transit_legs_array.tolist():
+        legs_array.extend(tid for tid in bit)
+
+    # record all legs corresponding to walk and car trips
+    walk_car_trips_df = trips_df.loc[trips_df['Mode'].isin(WALK_CAR_TRIP_MODES),]
+    walk_car_legs_array = walk_car_trips_df.apply(
+        lambda row: parse_walk_car_trips(row, non_bus_path_traversal_events, enter_veh_events), axis=1)
+    for bit in walk_car_legs_array.tolist():
+        legs_array.extend(tid for tid in bit)
+
+    return legs_array
+
+
 def label_trip_mode(modes):
+    # modes: modes of the legs of a trip
+    # returns: realized mode of the trip, or None if the combination of modes is not recognized
+    modes = set(modes)
     if ('walk' in modes) and ('car' in modes) and ('bus' in modes):
         return 'drive_transit'
     elif ('car' in modes) and ('bus' in modes):
@@ -330,69 +1087,171 @@ def label_trip_mode(modes):
         return 'walk_transit'
     elif ('walk' in modes) and ('car' in modes):
         return 'car'
-    elif ('car' == modes):
+    elif modes == {'car'}:
         return 'car'
     elif ('OnDemand_ride' in modes):
         return 'OnDemand_ride'
-    elif ('walk' == modes):
+    elif modes == {'walk'}:
         return 'walk'
     else:
-        print(modes)
+        return None
+
+
+def _trip_mode_lookup_table():
+    # realized trip mode of every combination of the TRIP_MODE_FLAGS bits (plus one bit for any other mode)
+    table = np.empty(2 ** (len(TRIP_MODE_FLAGS) + 1), dtype=object)
+    for mask in range(len(table)):
+        modes = [mode for mode, flag in TRIP_MODE_FLAGS.items() if mask & flag]
+        if mask & OTHER_MODE_FLAG:
+            modes.append('other')
+        table[mask] = label_trip_mode(modes)
+    return table
 
 
 def merge_legs_trips(legs_df, trips_df):
-    trips_df = trips_df[ ['PID', 'Trip_ID', 'Origin_Activity_ID', 'Destination_activity_ID', 'Trip_Purpose',
-       'Mode']]
-    trips_df.columns = ['PID', 'Trip_ID', 'Origin_Activity_ID', 'Destination_activity_ID', 'Trip_Purpose',
-       'plannedTripMode']
-    legs_grouped = legs_df.groupby("Trip_ID")
-    unique_modes = legs_grouped['Mode'].unique()
-    unique_modes_df = pd.DataFrame(unique_modes)
-    unique_modes_df.columns = ['legModes']
-    merged_trips = trips_df.merge(legs_grouped['Duration_sec','Distance_m','fuel','FuelCost','Fare'].sum(),on='Trip_ID')
-    merged_trips.set_index('Trip_ID',inplace=True)
-    legs_transit = legs_df.loc[legs_df['Mode']=='bus',]
-    legs_transit_grouped = legs_transit.groupby("Trip_ID")
-    count_modes = legs_transit_grouped['Mode'].count()
-    merged_trips.loc[count_modes.loc[count_modes.values >1].index.values,'Fare'] = merged_trips.loc[count_modes.loc[count_modes.values >1].index.values,'Fare']/count_modes.loc[count_modes.values >1].values
-    merged_trips = merged_trips.merge(unique_modes_df,on='Trip_ID')
-    legs_grouped_start_min = pd.DataFrame(legs_grouped['Start_time'].min())
-    legs_grouped_end_max = pd.DataFrame(legs_grouped['End_time'].max())
-    merged_trips= merged_trips.merge(legs_grouped_start_min,on='Trip_ID')
-    merged_trips= merged_trips.merge(legs_grouped_end_max,on='Trip_ID')
-    merged_trips['realizedTripMode'] = merged_trips['legModes'].apply(lambda row: label_trip_mode(row))
+    # legs_df: legs_dataframe (with the FuelCost and Fare columns)
+    # trips_df: trips_dataframe, output of the get_trips_output() function
+    # returns: trips augmented with the sum of their legs' attributes, their start and end times and their realized mode
+    trips_df = trips_df[['PID', 'Trip_ID', 'Origin_Activity_ID', 'Destination_activity_ID', 'Trip_Purpose',
+                         'Mode']].rename(columns={'Mode': 'plannedTripMode'})
+
+    # one indicator column per mode, counted along with the other aggregations (transit legs of any mode are bus legs)
+    leg_modes = legs_df['Mode'].to_numpy()
+    leg_modes = np.where(np.isin(leg_modes, TRANSIT_MODES), 'bus', leg_modes)
+    mode_counts = {'_' + mode: (leg_modes == mode).astype(int) for mode in TRIP_MODE_FLAGS}
+    mode_counts['_other'] = 1 - sum(mode_counts.values())
+    aggregations = {column: (column, 'sum') for column in ['Duration_sec', 'Distance_m', 'fuel', 'FuelCost', 'Fare']}
+    aggregations.update(legModes=('Mode', 'unique'), Start_time=('Start_time', 'min'), End_time=('End_time', 'max'))
+    aggregations.update({column: (column, 'sum') for column in mode_counts})
+    legs_grouped = legs_df.assign(**mode_counts).groupby('Trip_ID').agg(**aggregations)
+
+    # the fare of a trip with several bus legs is the fare of one of its legs (all bus legs are charged the same)
+    bus_legs = legs_grouped['_bus'].to_numpy()
+    legs_grouped['Fare'] = np.where(bus_legs > 1, legs_grouped['Fare'].to_numpy() / np.maximum(bus_legs, 1),
+                                    legs_grouped['Fare'].to_numpy())
+
+    mode_flags = (legs_grouped['_other'].to_numpy() > 0) * OTHER_MODE_FLAG
+    for mode, flag in TRIP_MODE_FLAGS.items():
+        mode_flags = mode_flags + (legs_grouped['_' + mode].to_numpy() > 0) * flag
+    legs_grouped['realizedTripMode'] = _trip_mode_lookup_table()[mode_flags]
+
+    for modes in legs_grouped.loc[legs_grouped['realizedTripMode'].isnull(), 'legModes']:
+        print(modes)
+
+    merged_trips = trips_df.merge(legs_grouped[['Duration_sec', 'Distance_m', 'fuel', 'FuelCost', 'Fare', 'legModes',
+                                                'Start_time', 'End_time', 'realizedTripMode']],
+                                  left_on='Trip_ID', right_index=True)
+    merged_trips.set_index('Trip_ID', inplace=True)
     return merged_trips
 
 
+def load_events(events_path, cache_folder=None, columns=EVENTS_COLUMNS, event_types=LEGS_EVENT_TYPES):
+    """ Reads the events file with read_events(), caching the filtered events as a Feather file in `cache_folder`
+
+    The cache is keyed by the size, modification time and SHA-1 digest of the events file, and by the columns and
+    event types kept. The digest is only recomputed when the size or modification time of the file changed, so
+    reopening an already parsed run only memory-maps the cached file. Without pyarrow, or if `cache_folder` is None,
+    the events file is parsed every time.
+
+    Parameters
+    ----------
+    events_path: pathlib.Path object
+        Absolute path of the `ITERS/<num_iterations>.events.csv.gz` file
+
+    cache_folder: pathlib.Path object
+        Folder where the cached events are stored (created if needed)
+
+    columns: list of str
+        Columns to keep (see read_events())
+
+    event_types: list of str
+        Event types to keep (see read_events())
+
+    Returns
+    -------
+    events_df: pandas DataFrame
+        Filtered events
+    """
+    if cache_folder is None or feather is None:
+        return read_events(events_path, columns, event_types)
+
+    cache_folder = Path(cache_folder)
+    meta_path = cache_folder / (Path(events_path).name + ".json")
+    key = {"columns": list(columns), "event_types": event_types if event_types is None else list(event_types)}
+    fingerprint = file_fingerprint(events_path, digest=False)
+
+    meta = None
+    if meta_path.exists():
+        with open(str(meta_path)) as f:
+            meta = json.load(f)
+        if meta["key"] != key or meta["size"] != fingerprint["size"] or \
+                not (cache_folder / meta["cache_file"]).exists():
+            meta = None
+        elif meta["mtime"] != fingerprint["mtime"]:
+            # the file was touched or copied: only reuse the cache if its content did not change
+            fingerprint = file_fingerprint(events_path)
+            if meta["sha1"] != fingerprint["sha1"]:
+                meta = None
+            else:
+                meta["mtime"] = fingerprint["mtime"]
+                with open(str(meta_path), "w") as f:
+                    json.dump(meta, f)
+
+    if meta is not None:
+        return feather.read_table(str(cache_folder / meta["cache_file"]), memory_map=True).to_pandas()
+
+    events_df = read_events(events_path, columns, event_types)
+
+    if "sha1" not in fingerprint:
+        fingerprint = file_fingerprint(events_path)
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    cache_file = "{0}.{1}.feather".format(Path(events_path).name, fingerprint["sha1"][:16])
+    # uncompressed, so that the cached file can be memory-mapped
+    feather.write_feather(events_df, str(cache_folder / (cache_file + ".tmp")), compression="uncompressed")
+    os.replace(str(cache_folder / (cache_file + ".tmp")), str(cache_folder / cache_file))
+    for stale_file in cache_folder.glob(Path(events_path).name + ".*.feather"):
+        if stale_file.name != cache_file:
+            stale_file.unlink()
+    with open(str(meta_path), "w") as f:
+        json.dump(dict(fingerprint, key=key, cache_file=cache_file), f)
+
+    return events_df
+
+
 # ########### 2. PARSING AND PROCESSING THE XML FILES INTO PANDAS DATA FRAMES ###############
 
-def get_person_output_from_households_xml(households_xml, output_folder_path):
+def get_person_output_from_households_xml(households_path, output_folder_path, output_format='csv', writer=None):
     """
     - Parses the outputHouseholds file to create the households_dataframe gathering each person's household attributes
     (person id, household id, number of vehicles in the household, overall income of the household)
-    - Saves the household dataframe to csv
+    - Saves the household dataframe (to csv by default)
+
+    The households are read one at a time (see iterparse_elements()), so the whole file is never held in memory.
 
     Parameters
     ----------
-    households_xml: ElementTree object
-        Output of the open_xml() function for the `outputHouseholds.xml` file
+    households_path: pathlib.Path object
+        Absolute path of the `outputHouseholds.xml` file
 
     output_folder_path: pathlib.Path object
         Absolute path of the output folder of the simulation
         (format of the output folder name: `<scenario_name>-<sample_size>__<date and time>`)
 
+    output_format: str
+        Format of the written dataframe files, one of OUTPUT_FORMATS (see write_dataframe()), or None not to write them
+
+    writer: OutputWriter
+        Writer to which the dataframe files are submitted, to be written in the background (written directly if None)
+
     Returns
     -------
     households_df: pandas Dataframe
         Record of each person's household attributes
         (person id, household id, number of vehicles in the household, overall income of the household)
     """
-
-    # get root of the `outputHouseholds.xml` file
-    households_root = households_xml.getroot()
     hhd_array = []
 
-    for hhd in households_root.getchildren():
+    for hhd in iterparse_elements(households_path, '{*}household'):
         hhd_id = hhd.get('id').strip()
         hhd_children = hhd.getchildren()
         # check for vehicles; record household attributes
@@ -400,71 +1259,64 @@ def get_person_output_from_households_xml(households_xml, output_folder_path):
             members = hhd_children[0]
             vehicles = hhd_children[1]
             income = hhd_children[2]
-            vehs = vehicles.getchildren()
-            hdd_num_veh = len(vehs)
+            hdd_num_veh = len(vehicles)
         else:
             members = hhd_children[0]
-            vehicles = []
             income = hhd_children[1]
             hdd_num_veh = 0
         hhd_income = income.text.strip()
         # get list of persons in household and make a record of each person
-        list_members = members.getchildren()
-        for person in list_members:
+        for person in members:
             pid = person.attrib['refId'].strip()
             hhd_array.append([pid, hhd_id, hdd_num_veh, hhd_income])
 
     # convert array to dataframe and save
     households_df = pd.DataFrame(hhd_array, columns=['PID', 'Household_ID', 'Household_num_vehicles', 'Household_income [$]'])
-    households_df.to_csv(str(output_folder_path) + "/households_dataframe.csv")
+    _write_output(households_df, output_folder_path, "households_dataframe", output_format, writer)
 
     return households_df
 
 
-def get_person_output_from_output_plans_xml(output_plans_xml):
+def get_person_output_from_output_plans_xml(output_plans_path):
     """ Parses the outputPlans file to create the person_dataframe gathering individual attributes of each person
     (person id, age, sex, home location)
 
+    The persons are read one at a time (see iterparse_elements()), so the whole file is never held in memory.
+
     Parameters
     ----------
-    output_plans_xml: ElementTree object
-        Output of the open_xml() function for the `outputPlans.xml` file
+    output_plans_path: pathlib.Path object
+        Absolute path of the `outputPlans.xml` file
 
     Returns
     -------
     person_df: pandas DataFrame
         Record of some of each person's individual attributes (person id, age, sex, home location)
     """
-
-    # get root of the `outputPlans.xml` file
-    output_plans_root = output_plans_xml.getroot()
     person_array = []
 
-    for person in output_plans_root.findall('./person'):
+    for person in iterparse_elements(output_plans_path, 'person'):
         pid = person.get('id')
-        attributes = person.findall('./attributes')[0]
-        age = int(attributes.findall('./attribute[@name="age"]')[0].text)
-        sex = attributes.findall('./attribute[@name="sex"]')[0].text
-        plan = person.findall('./plan')[0]
-        home = plan.findall('./activity')[0]
-        home_x = home.get('x')
-        home_y = home.get('y')
-        person_array.append([pid, age, sex, home_x, home_y])
+        attributes = {attribute.get('name'): attribute.text for attribute in person.find('./attributes')}
+        home = person.find('./plan').find('./activity')
+        person_array.append([pid, int(attributes['age']), attributes['sex'], home.get('x'), home.get('y')])
     # convert person array to dataframe
     person_df = pd.DataFrame(person_array, columns=['PID', 'Age', 'Sex', 'Home_X', 'Home_Y'])
 
     return person_df
 
 
-def get_person_output_from_output_person_attributes_xml(persons_xml):
+def get_person_output_from_output_person_attributes_xml(persons_path):
     """ Parses outputPersonAttributes.xml file to create population_attributes_dataframe gathering individual attributes
     of the population (person id, excluded modes (i.e. transportation modes that the peron is not allowed to use),
     income, rank, value of time).
 
+    The persons are read one at a time (see iterparse_elements()), so the whole file is never held in memory.
+
     Parameters
     ----------
-    persons_xml: ElementTree object
-        Output of the open_xml() function for the `outputPersonAttributes.xml` file
+    persons_path: pathlib.Path object
+        Absolute path of the `outputPersonAttributes.xml` file
 
     Returns
     -------
@@ -472,18 +1324,11 @@ def get_person_output_from_output_person_attributes_xml(persons_xml):
         Record of some of each person's individual attributes (person id, excluded modes (i.e. transportation modes
         that the peron is not allowed to use), income, rank, value of time)
     """
-
-    # get root of the `outputPersonAttributes.xml` file
-    persons_root = persons_xml.getroot()
     population_attributes = []
 
-    population = persons_root.getchildren()
-    for person in population:
-        pid = person.get('id')
-        attributes = person.findall("./attribute")
-        population_attributes_dict = {}
-        population_attributes_dict['PID'] = pid
-        for attribute in attributes:
+    for person in iterparse_elements(persons_path, 'object'):
+        population_attributes_dict = {'PID': person.get('id')}
+        for attribute in person.findall("./attribute"):
             population_attributes_dict[attribute.attrib['name']] = attribute.text
         population_attributes.append(population_attributes_dict)
 
@@ -492,39 +1337,53 @@ def get_person_output_from_output_person_attributes_xml(persons_xml):
 
     return person_df_2
 
-import time
 
-def get_persons_attributes_output(output_plans_xml, persons_xml, households_xml, output_folder_path):
+def get_persons_attributes_output(output_plans_path, persons_path, households_path, output_folder_path,
+                                  output_format='csv', writer=None):
     """Outputs the augmented persons dataframe, including all individual and household attributes for each person
 
+    The three files are parsed concurrently, each in its own thread.
+
     Parameters
     ----------
-    output_plans_xml: ElementTree object
-        Output of the open_xml() function for the `outputPlans.xml` file
+    output_plans_path: pathlib.Path object
+        Absolute path of the `outputPlans.xml` file
 
-    persons_xml: ElementTree object
-        Output of the open_xml() function for the `outputPersonAttributes.xml` file
+    persons_path: pathlib.Path object
+        Absolute path of the `outputPersonAttributes.xml` file
 
-    households_xml: ElementTree object
-        Output of the open_xml() function for the `outputHouseholds.xml` file
+    households_path: pathlib.Path object
+        Absolute path of the `outputHouseholds.xml` file
 
     output_folder_path: pathlib.Path object
         Absolute path of the output folder of the simulation (format of the output folder name: `<scenario_name>-<sample_size>__<date and time>`)
 
+    output_format: str
+        Format of the written dataframe files, one of OUTPUT_FORMATS (see write_dataframe()), or None not to write them
+
+    writer: OutputWriter
+        Writer to which the dataframe files are submitted, to be written in the background (written directly if None)
+
     Returns
     -------
     persons_attributes_df: pandas DataFrame
         Record of all individual and household attributes for each person
     """
     # get the person attributes dataframes
-    households_df = get_person_output_from_households_xml(households_xml, output_folder_path)
-    person_df = get_person_output_from_output_plans_xml(output_plans_xml)
-    person_df_2 = get_person_output_from_output_person_attributes_xml(persons_xml)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        households_future = executor.submit(get_person_output_from_households_xml, households_path,
+                                            output_folder_path, output_format, writer)
+        person_future = executor.submit(get_person_output_from_output_plans_xml, output_plans_path)
+        person_2_future = executor.submit(get_person_output_from_output_person_attributes_xml, persons_path)
+        households_df = households_future.result()
+        person_df = person_future.result()
+        person_df_2 = person_2_future.result()
 
     # set the index of all dataframes to PID (person ID)
     person_df.set_index('PID', inplace=True)
     person_df_2.set_index('PID', inplace=True)
-    households_df.set_index('PID', inplace=True)
+    # (not in place: the households dataframe may still be being written)
+    households_df = households_df.set_index('PID')
 
     # join the three dataframes together
     persons_attributes_df = person_df.join(person_df_2)
@@ -533,14 +1392,14 @@ def get_persons_attributes_output(output_plans_xml, persons_xml, households_xml,
     return persons_attributes_df
 
 
-def get_activities_output(experienced_plans_xml):
+def get_activities_output(experienced_plans_xml_path):
     """ Parses the experiencedPlans.xml file to create the activities_dataframe, gathering each person's activities' attributes
     (person id, activity id, activity type, activity start time, activity end time)
 
     Parameters
     ----------
-    experienced_plans_xml: ElementTree object
-        Output of the open_xml() function for the `<num_iterations>.experiencedPlans.xml` file located in
+    experienced_plans_xml_path: str
+        Absolute path of the `<num_iterations>.experiencedPlans.xml` file located in
         the `/ITERS/it.<num_iterations> folder
 
     Returns
@@ -549,110 +1408,96 @@ def get_activities_output(experienced_plans_xml):
         Record of each person's activities' attributes
 
     trip_purposes: list of string
-        purpose of each trip, ege, "Work", "Home".etc...
+        purpose of each trip (of every person, in the order of the trips dataframe), ege, "Work", "Home".etc...
 
     """
+    activities_df, trips_df = get_activities_trips_output(experienced_plans_xml_path)
 
-    # get root of experiencedPlans xml file
-    plans_root = experienced_plans_xml.getroot()
-    acts_array = []
-
-    # iterate through persons, recording activities and trips for each person
-    for person in plans_root.findall('./person'):
-        # we use the person ID from the raw output
-        pid = person.get('id')
-        plan = person.getchildren()[0]
-        activities = plan.findall('./activity')
-
-        # initialize activity ID counters (we create activity IDs using these)
-        act_id = 0
-        trip_purposes = []
-
-        # iterate through activities and make record of each activity
-        for activity in activities:
-            act_id += 1
-            # create activity ID
-            activity_id = pid + "_a-" + str(act_id)
-            act_type = activity.get('type')
-            if activity.get('start_time') is None:
-                act_start_time = None
-            else:
-                act_start_time = activity.get('start_time')
-            if activity.get('end_time') is None:
-                act_end_time = None
-            else:
-                act_end_time = activity.get('end_time')
-
-            # record all activity types to determine trip trip_purposes
-            trip_purposes.append([act_type])
-            acts_array.append([pid, activity_id, act_type, act_start_time, act_end_time])
+    return activities_df, trips_df['Trip_Purpose'].tolist()
 
-    # convert the activity_array to a dataframe
-    activities_df = pd.DataFrame(acts_array, columns=['PID', 'Activity_ID', 'Activity_Type', 'Start_time', 'End_time'])
 
-    return activities_df, trip_purposes
+def get_activities_trips_output(experienced_plans_path):
+    """ Parses the experiencedPlans.xml file in a single pass to create both the activities dataframe and the trips
+    dataframe (see get_activities_output() and get_trips_output())
 
-
-def get_trips_output(experienced_plans_xml_path):
-    """ Parses the experiencedPlans.xml file to create the trips dataframe, gathering each person's trips' attributes
-    (person id, trip id, id of the origin activity of the trip, id of the destination activity of the trip, trip purpose,
-    mode used, start time of the trip, duration of the trip, distance of the trip, path of the trip)
+    The persons are read one at a time (see iterparse_elements()), so the whole file is never held in memory. The
+    purpose of each trip is the type of the activity following it in the plan of the same person.
 
     Parameters
     ----------
-    experienced_plans_xml_path: str
-        Output of the open_xml() function for the `<num_iterations>.experiencedPlans.xml` file located in
+    experienced_plans_path: pathlib.Path object
+        Absolute path of the `<num_iterations>.experiencedPlans.xml` file located in
         the `/ITERS/it.<num_iterations> folder
 
     Returns
     -------
+    activities_df: pandas DataFrame
+        Record of each person's activities' attributes
+
     trips_df: pandas DataFrame
         Record of each person's trips' attributes
     """
-    # get root of experiencedPlans xml file
-    experienced_plans_xml = open_xml(experienced_plans_xml_path)
-    plans_root = experienced_plans_xml.getroot()
+    acts_array = []
     trip_array = []
 
-    # Getting the activities dataframe
-    _, trip_purposes = get_activities_output(experienced_plans_xml)
-
     # iterate through persons, recording activities and trips for each person
-    for person in plans_root.findall('./person'):
+    for person in iterparse_elements(experienced_plans_path, 'person'):
         # we use the person ID from the raw output
         pid = person.get('id')
         plan = person.getchildren()[0]
-        legs = plan.findall('./leg')
 
-        # initialize trip ID counters (we create trip IDs using these)
-        trip_id = 0
+        # iterate through activities and make record of each activity
+        activity_types = []
+        for act_id, activity in enumerate(plan.findall('./activity'), start=1):
+            # create activity ID
+            activity_id = pid + "_a-" + str(act_id)
+            act_type = activity.get('type')
+            activity_types.append(act_type)
+            acts_array.append([pid, activity_id, act_type, activity.get('start_time'), activity.get('end_time')])
 
         # iterate through trips (called legs in the `experiencedPlans.xml` file) and make record of each trip
-        for trip in legs:
-            trip_id += 1
+        for trip_id, trip in enumerate(plan.findall('./leg'), start=1):
             # create trip ID
             trip_id_full = pid + "_t-" + str(trip_id)
             # record activity IDs for origin and destination activities of the trip
             o_act_id = pid + "_a-" + str(trip_id)
             d_act_id = pid + "_a-" + str(trip_id + 1)
 
-            # identify the activity type of the trip destination to record as the trip trip_purpose
-            trip_purpose = trip_purposes[trip_id][0]
+            # identify the activity type of the trip destination to record as the trip purpose
+            trip_purpose = activity_types[trip_id]
 
-            mode = trip.get('mode')
-            dep_time = trip.get('dep_time')
-            duration = trip.get('trav_time')
             route = trip.find('./route')
-            distance = route.get('distance')
-            path = route.text
             trip_array.append(
-                [pid, trip_id_full, o_act_id, d_act_id, trip_purpose, mode, dep_time, duration, distance, path])
+                [pid, trip_id_full, o_act_id, d_act_id, trip_purpose, trip.get('mode'), trip.get('dep_time'),
+                 trip.get('trav_time'), route.get('distance'), route.text])
 
-    # convert the trip_array to a dataframe
+    # convert the arrays to dataframes
+    activities_df = pd.DataFrame(acts_array, columns=['PID', 'Activity_ID', 'Activity_Type', 'Start_time', 'End_time'])
     trips_df = pd.DataFrame(trip_array,
                     columns=['PID', 'Trip_ID', 'Origin_Activity_ID', 'Destination_activity_ID', 'Trip_Purpose',
                              'Mode', 'Start_time', 'Duration_sec', 'Distance_m', 'Path_linkIds'])
 
+    return activities_df, trips_df
+
+
+def get_trips_output(experienced_plans_xml_path):
+    """ Parses the experiencedPlans.xml file to create the trips dataframe, gathering each person's trips' attributes
+    (person id, trip id, id of the origin activity of the trip, id of the destination activity of the trip, trip purpose,
+    mode used, start time of the trip, duration of the trip, distance of the trip, path of the trip)
+
+    Parameters
+    ----------
+    experienced_plans_xml_path: str
+        Absolute path of the `<num_iterations>.experiencedPlans.xml` file located in
+        the `/ITERS/it.<num_iterations> folder
+
+    Returns
+    -------
+    trips_df: pandas DataFrame
+        Record of each person's trips' attributes
+    """
+    _, trips_df = get_activities_trips_output(experienced_plans_xml_path)
+
     return trips_df
 
 
@@ -699,6 +1544,100 @@ def get_trips_output(experienced_plans_xml_path):
 #         dd[k].append(v)
 
 
+class TransitVehicles(object):
+    """Identifies the transit vehicles among the vehicles of the events.
+
+    BEAM names the vehicle of a transit trip `<agency>:<trip_id>`. A vehicle is a transit vehicle if its id is one of
+    `vehicle_ids`, if its prefix is one of `agency_ids` or if its suffix is one of `trip_ids`.
+
+    Parameters
+    ----------
+    trip_ids: iterable of str
+        GTFS trip ids of the agencies of the scenario
+    agency_ids: iterable of str
+        Prefixes of the transit vehicle ids
+    vehicle_ids: iterable of str
+        Ids of transit vehicles
+    """
+
+    def __init__(self, trip_ids=(), agency_ids=(), vehicle_ids=()):
+        self.trip_ids = pd.Index(trip_ids).astype(str).unique()
+        self.agency_ids = pd.Index(agency_ids).astype(str).unique()
+        self.vehicle_ids = pd.Index(vehicle_ids).astype(str).unique()
+
+    @classmethod
+    def from_events(cls, events_df):
+        """Transit vehicles of the path traversals of TRANSIT_MODES, for scenarios without GTFS data at hand."""
+        path_traversals = events_df[(events_df['type'] == 'PathTraversal') & events_df['mode'].isin(TRANSIT_MODES)]
+        return cls(vehicle_ids=path_traversals['vehicle'].dropna().unique())
+
+    def is_transit(self, vehicles):
+        """Returns whether each vehicle is a transit vehicle (the ids are only parsed once per distinct vehicle)."""
+        codes, uniques = pd.factorize(np.asarray(vehicles, dtype=object))
+        uniques = pd.Series(uniques, dtype=object).astype(str)
+        prefix_suffix = uniques.str.split(':', n=1)
+        is_transit = (uniques.isin(self.vehicle_ids) | prefix_suffix.str[0].isin(self.agency_ids) |
+                      prefix_suffix.str[1].isin(self.trip_ids)).to_numpy()
+        if len(uniques) == 0:
+            return np.zeros(len(codes), dtype=bool)
+        # missing vehicles (code -1) are not transit vehicles
+        return (codes >= 0) & is_transit[np.maximum(codes, 0)]
+
+
+def load_transit_vehicles(data_dir, scenario_name):
+    """ Loads the trip and agency ids of all the GTFS agencies of a scenario
+
+    Parameters
+    ----------
+    data_dir: pathlib.Path object
+        Absolute path of the root data directory (`reference-data`)
+    scenario_name: str
+        Name of the scenario with GTFS data (e.g. `sioux_faux`)
+
+    Returns
+    -------
+    transit_vehicles: TransitVehicles
+        Transit vehicles of the scenario
+    """
+    trip_ids = []
+    agency_ids = []
+    for agency, agency_path in scenario_agencies(Path(data_dir), scenario_name).items():
+        gtfs_path = Path(agency_path) / "gtfs_data"
+        if not (gtfs_path / "trips.txt").exists():
+            # not an agency (e.g. the `bau` or `config` folders of the scenario)
+            continue
+        trip_ids.extend(pd.read_csv(gtfs_path / "trips.txt", usecols=['trip_id'], dtype=str)['trip_id'])
+        agency_ids.append(agency)
+        if (gtfs_path / "agency.txt").exists():
+            agency_ids.extend(pd.read_csv(gtfs_path / "agency.txt", dtype=str)['agency_id'].dropna())
+
+    return TransitVehicles(trip_ids, agency_ids)
+
+
+def tag_transit_events(events_df, transit_vehicles=None):
+    """ Adds the boolean `is_transit` column to the events, telling whether their vehicle is a transit vehicle
+
+    Parameters
+    ----------
+    events_df: pandas DataFrame
+        Events (not modified)
+    transit_vehicles: TransitVehicles
+        Transit vehicles of the scenario (see load_transit_vehicles()). If None, the vehicles of the transit path
+        traversals of the events are used.
+
+    Returns
+    -------
+    events_df: pandas DataFrame
+        Copy of the events with the `is_transit` column
+    """
+    if transit_vehicles is None:
+        transit_vehicles = TransitVehicles.from_events(events_df)
+    # a shallow copy is enough: only a column is added
+    events_df = events_df.copy(deep=False)
+    events_df['is_transit'] = transit_vehicles.is_transit(events_df['vehicle'])
+    return events_df
+
+
 def get_path_traversal_output(events_df):
     """ Parses the experiencedPlans.xml file to create the trips dataframe, gathering each person's trips' attributes
     (person id, trip id, id of the origin activity of the trip, id of the destination activity of the trip, trip purpose,
@@ -724,7 +1663,7 @@ def get_path_traversal_output(events_df):
     # Selecting the columns of interest
     events_df = events_df[['time', 'type', 'person', 'vehicle', 'driver', 'vehicleType', 'length',
          'numPassengers', 'departureTime', 'arrivalTime', 'mode', 'links',
-         'fuelType', 'fuel']]
+         'fuelType', 'fuel'] + (['is_transit'] if 'is_transit' in events_df.columns else [])]
 
     # get all path traversal events (all vehicle movements, and all person walk movements)
     path_traversal_events_df = events_df[(events_df['type'] == 'PathTraversal') & (events_df['length'] > 0)]
@@ -734,10 +1673,33 @@ def get_path_traversal_output(events_df):
     return path_traversal_events_df
 
 
-def get_legs_output(events_df, trips_df):
-    """ Parses the outputEvents.xml and trips_df file to create the legs dataframe, gathering each person's trips' legs' attributes
-    (PID, Trip_ID, Leg_ID, Mode, Veh, Veh_type, Start_time, End_time,
-                                    Duration, Distance, Path, fuel, fuelType)
+def _split_legs_events(events_df, trips_df, transit_vehicles=None):
+    # splits the events used to rebuild the legs of the trips
+    events_df = tag_transit_events(events_df, transit_vehicles)
+
+    # convert trip times to timedelta; calculate end time of trips
+    trips_df['Start_time'] = pd.to_timedelta(trips_df['Start_time'])
+    trips_df['Duration_sec'] = pd.to_timedelta(trips_df['Duration_sec'])
+    trips_df['End_time'] = trips_df['Start_time'].dt.seconds + trips_df['Duration_sec'].dt.seconds + (
+            3600 * 24 * trips_df['Start_time'].dt.days)
+
+    path_traversal_events_full = get_path_traversal_output(events_df)
+
+    # get all relevant personEntersVehicle events (those occurring at time ==0 are all ridehail/bus drivers)
+    enter_veh_events = events_df[(events_df['type'] == 'PersonEntersVehicle') & (events_df['time'] > 0)]
+
+    # filter for transit path traversals only
+    bus_path_traversal_events = path_traversal_events_full[path_traversal_events_full['is_transit']]
+
+    # filter for car & body path traversals only
+    non_bus_path_traversal_events = path_traversal_events_full[~path_traversal_events_full['is_transit']]
+
+    return trips_df, path_traversal_events_full, enter_veh_events, bus_path_traversal_events, \
+        non_bus_path_traversal_events
+
+
+def get_ridehail_diagnostics(events_df, trips_df, transit_vehicles=None):
+    """ Lists the ride-hail trips for which no leg can be reconstructed from the events, with the reason why
 
     Parameters
     ----------
@@ -747,71 +1709,102 @@ def get_legs_output(events_df, trips_df):
     trips_df: pandas DataFrame
         Record of each person's trips' attributes: output of the get_trips_output() function
 
+    transit_vehicles: TransitVehicles
+        Transit vehicles of the scenario (see tag_transit_events())
+
     Returns
     -------
-    legs_df: pandas DataFrame
-        Records the legs attributes for each person's trip
-
+    ridehail_diagnostics_df: pandas DataFrame
+        Unmatched ride-hail trips (PID, Trip_ID, Start_time, End_time, Veh) with the reason why (one of
+        RIDEHAIL_UNMATCHED_REASONS)
     """
-    
-    # convert trip times to timedelta; calculate end time of trips
-    trips_df['Start_time'] = pd.to_timedelta(trips_df['Start_time'])
-    trips_df['Duration_sec'] = pd.to_timedelta(trips_df['Duration_sec'])
-    trips_df['End_time'] = trips_df['Start_time'].dt.seconds + trips_df['Duration_sec'].dt.seconds + (
-            3600 * 24 * trips_df['Start_time'].dt.days)
+    trips_df, _, enter_veh_events, bus_path_traversal_events, non_bus_path_traversal_events = _split_legs_events(
+        events_df, trips_df, transit_vehicles)
+    # only the ride-hail trips are matched
+    ridehail_trips_df = trips_df[trips_df['Mode'].isin(RIDEHAIL_TRIP_MODES)]
+    return _parse_legs('indexed', ridehail_trips_df, non_bus_path_traversal_events, bus_path_traversal_events,
+                       enter_veh_events)[1]
 
-    path_traversal_events_full = get_path_traversal_output(events_df)
 
-    # get all relevant personEntersVehicle events (those occurring at time ==0 are all ridehail/bus drivers)
-    enter_veh_events = events_df[(events_df['type'] == 'PersonEntersVehicle') & (events_df['time'] > 0)]
+def get_legs_output(events_df, trips_df, engine='indexed', n_jobs=1, return_diagnostics=False, transit_vehicles=None):
+    """ Parses the outputEvents.xml and trips_df file to create the legs dataframe, gathering each person's trips' legs' attributes
+    (PID, Trip_ID, Leg_ID, Mode, Veh, Veh_type, Start_time, End_time,
+                                    Duration, Distance, Path, fuel, fuelType)
 
-    # filter for bus path traversals only
-    bus_path_traversal_events = path_traversal_events_full[path_traversal_events_full['mode'] == "bus"]
+    Parameters
+    ----------
+    events_df: pandas DataFrame
+        DataFrame extracted from the outputEvents.xml` file: output of the extract_dataframe() function
 
-    # filter for car & body path traversals only
-    non_bus_path_traversal_events = path_traversal_events_full[path_traversal_events_full['mode'] != "bus"]
+    trips_df: pandas DataFrame
+        Record of each person's trips' attributes: output of the get_trips_output() function
 
-    # get all PersonCost events (record the expenditures of persons during a trip)
-    # person_costs = events_df.loc[events_df['type']=='PersonCost',]
+    engine: str
+        How the legs are reconstructed (see LEGS_ENGINES):
+        - "indexed" (default) groups the events by person and by vehicle once and looks up each trip's time window
+        by binary search;
+        - "vectorized" joins the trips to the events of the same person (or vehicle) and filters the joined rows on
+        each trip's time window, without any per-trip Python code;
+        - "rowwise" applies the parse_*_trips() functions to each trip, scanning all events for every trip.
+        All engines produce the same legs, in the same order.
 
-    legs_array = []
-    
-    # record all legs corresponding to OnDemand_ride trips
-    on_demand_ride_trips = trips_df.loc[((trips_df['Mode'] == 'OnDemand_ride') | (trips_df['Mode'] == 'ride_hail')),]
-    on_demand_ride_legs_array = on_demand_ride_trips.apply(
-        lambda row: parse_ridehail_trips(row, non_bus_path_traversal_events, enter_veh_events), axis=1)
-    for bit in on_demand_ride_legs_array.tolist():
-        legs_array.extend(tid for tid in bit)
-        
-    # record all legs corresponding to transit trips
-    transit_trips_df = trips_df[(trips_df['Mode'] == 'drive_transit') | (trips_df['Mode'] == 'walk_transit')]
-    transit_legs_array = transit_trips_df.apply(
-        lambda row: parse_transit_trips(row, non_bus_path_traversal_events, bus_path_traversal_events, enter_veh_events),
-        axis=1)
-    for bit in transit_legs_array.tolist():
-        legs_array.extend(tid for tid in bit)
+    n_jobs: int
+        Number of processes parsing the legs. As in joblib, negative values count from the number of cores: -1 uses
+        all the cores, -2 all but one, etc. With more than one process, the trips are partitioned by person and each
+        partition is parsed, with its own events only, in a separate process.
 
-    # record all legs corresponding to walk and car trips
-    walk_car_trips_df = trips_df.loc[(trips_df['Mode'] == 'car') | (trips_df['Mode'] == 'walk'),]
-    walk_car_legs_array = walk_car_trips_df.apply(
-        lambda row: parse_walk_car_trips(row, non_bus_path_traversal_events, enter_veh_events), axis=1)
-    for bit in walk_car_legs_array.tolist():
-        legs_array.extend(tid for tid in bit)
+    return_diagnostics: bool
+        Whether to also return the ride-hail trips for which no leg could be reconstructed
+
+    transit_vehicles: TransitVehicles
+        Transit vehicles of the scenario (see load_transit_vehicles()), telling the transit path traversals and
+        vehicle entries apart (see tag_transit_events()); if None, the transit vehicles are found from the modes of the
+        events.
 
-    
+    Returns
+    -------
+    legs_df: pandas DataFrame
+        Records the legs attributes for each person's trip
 
-    # convert the leg array to a dataframe  
-    legs_df = pd.DataFrame(legs_array,
-                           columns=['PID', 'Trip_ID', 'Leg_ID', 'Mode', 'Veh', 'Veh_type', 'Start_time', 'End_time', 'Duration_sec', 'Distance_m', 'Path', 'fuel', 'fuelType'])
+    path_traversal_events_full: pandas DataFrame
+        Path traversal events (without the `is_transit` column)
 
+    ridehail_diagnostics_df: pandas DataFrame
+        Unmatched ride-hail trips with the reason why (one of RIDEHAIL_UNMATCHED_REASONS), only if `return_diagnostics`
+        is True
+
+    """
+    if engine not in LEGS_ENGINES:
+        raise ValueError("{0} is not a valid legs engine, choose one of {1}.".format(engine, LEGS_ENGINES))
+    num_processes = 1 if n_jobs is None else n_jobs if n_jobs > 0 else os.cpu_count() + 1 + n_jobs
+    if n_jobs == 0 or num_processes < 1:
+        raise ValueError("n_jobs={0} leaves no process to parse the legs on {1} cores.".format(n_jobs,
+                                                                                            os.cpu_count()))
+
+    trips_df, path_traversal_events_full, enter_veh_events, bus_path_traversal_events, \
+        non_bus_path_traversal_events = _split_legs_events(events_df, trips_df, transit_vehicles)
+
+    if num_processes == 1:
+        legs_df, ridehail_diagnostics_df = _parse_legs(engine, trips_df, non_bus_path_traversal_events,
+                                                       bus_path_traversal_events, enter_veh_events)
+    else:
+        legs_df, ridehail_diagnostics_df = _parse_legs_sharded(engine, num_processes, trips_df,
+                                                               non_bus_path_traversal_events,
+                                                               bus_path_traversal_events, enter_veh_events)
+
+    # the transit tag is only used to split the events
+    path_traversal_events_full = path_traversal_events_full.drop(columns='is_transit')
+    if return_diagnostics:
+        return legs_df, path_traversal_events_full, ridehail_diagnostics_df
     return legs_df, path_traversal_events_full
 
 
 # ############ 3. GENERATE THE CSV FILES ###########
 
 
-def extract_person_dataframes(output_plans_path, persons_path, households_path, output_folder_path):
-    """ Create a csv file from the processed person dataframe
+def extract_person_dataframes(output_plans_path, persons_path, households_path, output_folder_path,
+                              output_format='csv', writer=None):
+    """ Create a csv (or parquet/feather) file from the processed person dataframe
 
     Parameters
     ----------
@@ -827,6 +1820,12 @@ def extract_person_dataframes(output_plans_path, persons_path, households_path,
     output_folder_path: pathlib.Path object
         Absolute path of the output folder of the simulation (format of the output folder name: `<scenario_name>-<sample_size>__<date and time>`)
 
+    output_format: str
+        Format of the written dataframe files, one of OUTPUT_FORMATS (see write_dataframe()), or None not to write them
+
+    writer: OutputWriter
+        Writer to which the dataframe files are submitted, to be written in the background (written directly if None)
+
     Returns
     -------
     persons_attributes_df: pandas DataFrame
@@ -834,20 +1833,16 @@ def extract_person_dataframes(output_plans_path, persons_path, households_path,
 
     """
 
-    # opens the xml files
-    output_plans_xml = open_xml(output_plans_path)
-    persons_xml = open_xml(persons_path)
-    households_xml = open_xml(households_path)
-
-    persons_attributes_df = get_persons_attributes_output(output_plans_xml, persons_xml, households_xml, output_folder_path)
-    persons_attributes_df.to_csv(str(output_folder_path) + "/persons_dataframe.csv")
-    print("person_dataframe.csv generated")
+    persons_attributes_df = get_persons_attributes_output(output_plans_path, persons_path, households_path,
+                                                          output_folder_path, output_format, writer)
+    _write_output(persons_attributes_df, output_folder_path, "persons_dataframe", output_format, writer)
 
     return persons_attributes_df
 
 
-def extract_activities_dataframes(experienced_plans_path, output_folder):
-    """ Create a csv file from the processed activities dataframe
+def extract_activities_trips_dataframes(experienced_plans_path, output_folder, output_format='csv', writer=None):
+    """ Parses the experiencedPlans file once to create the activities and trips dataframes, and creates a csv (or
+    parquet/feather) file from the activities dataframe
 
     Parameters
     ----------
@@ -857,26 +1852,53 @@ def extract_activities_dataframes(experienced_plans_path, output_folder):
         Absolute path of the output folder of the simulation
         (format of the output folder name: `<scenario_name>-<sample_size>__<date and time>`)
 
+    output_format: str
+        Format of the written dataframe files, one of OUTPUT_FORMATS (see write_dataframe()), or None not to write them
+
+    writer: OutputWriter
+        Writer to which the dataframe files are submitted, to be written in the background (written directly if None)
+
     Returns
     -------
-    activities_df
+    activities_df: pandas DataFrame
+
+    trips_df: pandas DataFrame
     """
+    activities_df, trips_df = get_activities_trips_output(experienced_plans_path)
+
+    # convert dataframes into files
+    _write_output(activities_df, output_folder, "activities_dataframe", output_format, writer)
 
-    # opens the experiencedPlans and passes the xml file to get_activity_trip_output
-    # returns the actitivities_dataframe and trips_dataframe
+    return activities_df, trips_df
 
-    experienced_plans_xml = open_xml(experienced_plans_path)
-    activities_df, _ = get_activities_output(experienced_plans_xml)
 
-    # convert dataframes into csv files
-    activities_df.to_csv(str(output_folder) + "/activities_dataframe.csv")
-    print("activities_dataframe.csv generated")
+def extract_activities_dataframes(experienced_plans_path, output_folder, output_format='csv'):
+    """ Create a csv (or parquet/feather) file from the processed activities dataframe
+
+    Parameters
+    ----------
+    experienced_plans_path: pathlib.Path object
+
+    output_folder_path: pathlib.Path object
+        Absolute path of the output folder of the simulation
+        (format of the output folder name: `<scenario_name>-<sample_size>__<date and time>`)
+
+    output_format: str
+        Format of the written dataframe files, one of OUTPUT_FORMATS (see write_dataframe()), or None not to write them
+
+    Returns
+    -------
+    activities_df
+    """
+    activities_df, _ = extract_activities_trips_dataframes(experienced_plans_path, output_folder, output_format)
 
     return activities_df
 
 
-def extract_legs_dataframes(events_path, trips_df, person_df, bus_fares_df, trip_to_route, fuel_costs, output_folder_path):
-    """ Create a csv file from the processes legs dataframe
+def extract_legs_dataframes(events_path, trips_df, person_df, bus_fares_df, trip_to_route, fuel_costs, output_folder_path,
+                            cache_events=True, output_format='csv', return_path_traversals=False, writer=None,
+                            transit_vehicles=None, engine='indexed', n_jobs=1):
+    """ Create a csv (or parquet/feather) file from the processes legs dataframe
 
     Parameters
     ----------
@@ -889,8 +1911,8 @@ def extract_legs_dataframes(events_path, trips_df, person_df, bus_fares_df, trip
     person_df: pandas DataFrame
         Record of each person's trips' attributes: output of the  get_persons_attributes_output() function
 
-    bus_fares_df: pandas DataFrame
-        Dataframe with rows = ages and columns = routes: output of the parse_bus_fare_input() function
+    bus_fares_df: BusFareTable or pandas DataFrame
+        Fares indexed by age and route: output of the compile_bus_fares() or parse_bus_fare_input() function
 
     trip_to_route: dictionary
         route_id / trip_id correspondence extracted from the `trips.csv` file in the
@@ -904,49 +1926,296 @@ def extract_legs_dataframes(events_path, trips_df, person_df, bus_fares_df, trip
         Absolute path of the output folder of the simulation
         (format of the output folder name: `<scenario_name>-<sample_size>__<date and time>`)
 
+    cache_events: bool
+        Whether to cache the filtered events in the `EVENTS_CACHE_FOLDER` of the output folder (see load_events())
+
+    output_format: str
+        Format of the written dataframe files, one of OUTPUT_FORMATS (see write_dataframe()), or None not to write them
+
+    return_path_traversals: bool
+        Whether to also return the path traversals dataframe
+
+    writer: OutputWriter
+        Writer to which the dataframe files are submitted, to be written in the background (written directly if None)
+
+    transit_vehicles: TransitVehicles
+        Transit vehicles of the scenario (see load_transit_vehicles()), found from the modes of the events if None
+
+    engine: str
+        How the legs are reconstructed, one of LEGS_ENGINES (see get_legs_output())
+
+    n_jobs: int
+        Number of processes parsing the legs, negative values counting from the number of cores (see
+        get_legs_output())
+
     Returns
     -------
     legs_df: pandas DataFrame
         Records the legs attributes for each person's trips
+
+    path_traversal_df: pandas DataFrame
+        Records the path traversals with their fuel costs (only if `return_path_traversals` is True)
     """
     # opens the outputevents and passes the xml file to get_legs_output
     # augments the legs dataframe with estimates of the fuelcosts and fares for each leg
 
-    # extract a dataframe from the `outputEvents.xml` file
-    #all_events_df = extract_dataframe(str(events_path))
-    
-    
-    all_events_df = pd.read_csv(events_path)
-    legs_df, path_traversal_df = get_legs_output(all_events_df, trips_df)
-    
-    
-    
-    
+    # only the PathTraversal and PersonEntersVehicle events (and the columns) used to build the legs are kept
+    all_events_df = load_events(events_path, Path(output_folder_path) / EVENTS_CACHE_FOLDER if cache_events else None)
+    legs_df, path_traversal_df = get_legs_output(all_events_df, trips_df, engine=engine, n_jobs=n_jobs,
+                                                 transit_vehicles=transit_vehicles)
+
     path_traversal_df_new = calc_fuel_costs(path_traversal_df, fuel_costs)
-    path_traversal_df_new.to_csv(str(output_folder_path) + '/path_traversals_dataframe.csv')
-    print("path_traversals_dataframe.csv generated")
+    _write_output(path_traversal_df_new, output_folder_path, "path_traversals_dataframe", output_format, writer)
     legs_df_new = calc_fuel_costs(legs_df, fuel_costs)
-    ride_hail_fares = {'base': 0.0, 'distance': 1.0, 'duration': 0.5}
-
-    legs_df_new_new = calc_fares(legs_df_new, ride_hail_fares, bus_fares_df, person_df, trip_to_route)
-    legs_df.to_csv(str(output_folder_path) + '/legs_dataframe.csv')
-    print("legs_dataframe.csv generated")
+    legs_df_new_new = calc_fares(legs_df_new, RIDE_HAIL_FARES, bus_fares_df, person_df, trip_to_route)
+    _write_output(legs_df, output_folder_path, "legs_dataframe", output_format, writer)
 
+    if return_path_traversals:
+        return legs_df_new_new, path_traversal_df_new
     return legs_df_new_new
 
 
+class ParsedOutputs(object):
+    """Dataframes parsed from the outputs of a simulation by output_parse()
+
+    Attributes
+    ----------
+    persons_df: pandas DataFrame
+        Individual and household attributes of each person, indexed by PID
+    activities_df: pandas DataFrame
+        Activities of each person
+    legs_df: pandas DataFrame
+        Legs of each person's trips, with their fuel costs and fares
+    path_traversals_df: pandas DataFrame
+        Path traversals of all vehicles, with their fuel costs
+    trips_df: pandas DataFrame
+        Trips of each person augmented with the attributes of their legs, indexed by Trip_ID
+    ridehail_diagnostics_df: pandas DataFrame
+        Ride-hail trips for which no leg could be reconstructed, with the reason why (None unless requested)
+    """
+
+    def __init__(self, persons_df, activities_df, legs_df, path_traversals_df, trips_df, ridehail_diagnostics_df=None):
+        self.persons_df = persons_df
+        self.activities_df = activities_df
+        self.legs_df = legs_df
+        self.path_traversals_df = path_traversals_df
+        self.trips_df = trips_df
+        self.ridehail_diagnostics_df = ridehail_diagnostics_df
+
+
+def _read_parse_manifest(output_folder_path, output_format):
+    # manifest of a previous parse in the same output format (empty if there is none)
+    manifest_path = Path(output_folder_path) / PARSE_MANIFEST
+    if not manifest_path.exists():
+        return {}
+    with open(str(manifest_path)) as f:
+        manifest = json.load(f)
+    if manifest.get("output_format") != output_format:
+        return {}
+    return manifest
+
+
+def _write_parse_manifest(output_folder_path, manifest):
+    manifest_path = Path(output_folder_path) / PARSE_MANIFEST
+    with open(str(manifest_path) + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(str(manifest_path) + ".tmp", str(manifest_path))
+
+
+def _input_fingerprint(path, previous=None):
+    # fingerprint of an input file (None if it is missing); the SHA-1 digest is reused while its size and mtime match
+    if not Path(path).exists():
+        return None
+    fingerprint = file_fingerprint(path, digest=False)
+    if previous is not None and previous["size"] == fingerprint["size"] and previous["mtime"] == fingerprint["mtime"]:
+        return previous
+    return file_fingerprint(path)
+
+
+def _digest(*values):
+    # SHA-1 digest of json-serializable values
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _parse_stage_keys(fingerprints, bus_fares_df, trip_to_route, fuel_costs, transit_vehicles):
+    # digest of the inputs of each parsing stage: a stage is rebuilt when its key changes (or one of its dependencies
+    # is rebuilt, see PARSE_STAGE_DEPENDENCIES)
+    def content(name):
+        return None if fingerprints[name] is None else fingerprints[name]["sha1"]
+
+    if isinstance(bus_fares_df, pd.DataFrame):
+        bus_fares_df = BusFareTable.from_frame(bus_fares_df)
+    fares_digest = hashlib.sha1(bus_fares_df.fares.tobytes())
+    fares_digest.update(json.dumps(bus_fares_df.route_index.tolist(), default=str).encode("utf-8"))
+    transit_digest = None if transit_vehicles is None else _digest(
+        sorted(transit_vehicles.trip_ids), sorted(transit_vehicles.agency_ids), sorted(transit_vehicles.vehicle_ids))
+
+    return {
+        "persons": _digest(content("output_plans"), content("persons"), content("households")),
+        "plans": _digest(content("experienced_plans")),
+        "legs": _digest(content("events"), LEGS_COLUMNS, transit_digest),
+        "fuel": _digest(sorted(fuel_costs.items())),
+        "fares": _digest(fares_digest.hexdigest(), sorted(trip_to_route.items()), sorted(RIDE_HAIL_FARES.items()),
+                         TRANSIT_MODES),
+        "trips": _digest(sorted(TRIP_MODE_FLAGS.items()), TRANSIT_MODES),
+    }
+
+
+def _dirty_parse_stages(keys, manifest, output_folder_path, output_format):
+    # a stage is dirty if its inputs changed, if one of its files is missing or if a stage it depends on is dirty
+    dirty = {}
+    for stage in PARSE_STAGES:
+        dirty[stage] = keys[stage] != manifest.get("stages", {}).get(stage) or \
+            any(not dataframe_path(output_folder_path, name, output_format).exists()
+                for name in PARSE_STAGE_OUTPUTS[stage]) or \
+            any(dirty[dependency] for dependency in PARSE_STAGE_DEPENDENCIES[stage])
+    return dirty
+
+
+def _trips_from_dataframe(trips_dataframe):
+    # trips as output by get_trips_output(), rebuilt from a trips_dataframe (only the columns used by merge_legs_trips())
+    return trips_dataframe.reset_index().rename(columns={'plannedTripMode': 'Mode'})[
+        ['PID', 'Trip_ID', 'Origin_Activity_ID', 'Destination_activity_ID', 'Trip_Purpose', 'Mode']]
+
+
 def output_parse(events_path, output_plans_path, persons_path, households_path, experienced_plans_path,
-                bus_fares_data_df, route_ids, trip_to_route, fuel_costs, output_folder_path):
+                bus_fares_data_df, route_ids, trip_to_route, fuel_costs, output_folder_path, output_format='csv',
+                incremental=False, return_diagnostics=False, transit_vehicles=None, engine='indexed', n_jobs=1):
+    """ Parses the outputs of a simulation into the persons, activities, legs, path traversals and trips dataframes
+
+    The dataframes are returned in memory, and written to the output folder unless `output_format` is None. The files
+    are written in the background while the parsing goes on (see OutputWriter), and are all written when this
+    function returns.
+
+    With `incremental`, the inputs of each parsing stage (see PARSE_STAGES) are recorded in the PARSE_MANIFEST of the
+    output folder, and only the stages whose inputs changed since the previous parse are rebuilt. The dataframes of the
+    other stages are read from the output folder. For instance, new bus fares only recompute the `Fare` column of the
+    legs and the trips, without parsing the events again.
 
-    persons_attributes_df = extract_person_dataframes(output_plans_path, persons_path, households_path, output_folder_path)
+    Parameters
+    ----------
+    events_path, output_plans_path, persons_path, households_path, experienced_plans_path: pathlib.Path objects
+        Absolute paths of the `ITERS/<num_iterations>.events.csv.gz`, `outputPlans.xml`, `outputPersonAttributes.xml`,
+        `outputHouseholds.xml` and `ITERS/<num_iterations>.experiencedPlans.xml` files
 
-    activities_df = extract_activities_dataframes(experienced_plans_path, output_folder_path)
+    bus_fares_data_df: pandas DataFrame
+        Bus fares extracted from the "submission-inputs/MassTransitFares.csv"
 
-    trips_df = get_trips_output(experienced_plans_path)
+    route_ids: list
+        All routes ids where buses operate
+
+    trip_to_route: dictionary
+        route_id / trip_id correspondence
+
+    fuel_costs: dictionary
+        fuel type / fuel price correspondence
+
+    output_folder_path: pathlib.Path object
+        Absolute path of the output folder of the simulation
+
+    output_format: str
+        Format of the written dataframe files, one of OUTPUT_FORMATS (see write_dataframe()), or None not to write them
+
+    incremental: bool
+        Whether to only rebuild the stages whose inputs changed since the previous parse
+
+    return_diagnostics: bool
+        Whether to list the ride-hail trips for which no leg could be reconstructed (see get_ridehail_diagnostics())
+
+    transit_vehicles: TransitVehicles
+        Transit vehicles of the scenario (see load_transit_vehicles()), found from the modes of the events if None
+
+    engine: str
+        How the legs are reconstructed, one of LEGS_ENGINES (see get_legs_output()). All the engines give the same
+        legs, so changing it does not rebuild the legs of an incremental parse.
+
+    n_jobs: int
+        Number of processes parsing the legs, negative values counting from the number of cores (see
+        get_legs_output())
+
+    Returns
+    -------
+    parsed_outputs: ParsedOutputs
+        Parsed dataframes
+    """
+
+    if incremental and output_format is None:
+        raise ValueError("An incremental parse needs an output format to store the dataframes")
+
+    bus_fares_df = compile_bus_fares(bus_fares_data_df, route_ids)
+
+    if incremental:
+        manifest = _read_parse_manifest(output_folder_path, output_format)
+        input_paths = {"events": events_path, "output_plans": output_plans_path, "persons": persons_path,
+                       "households": households_path, "experienced_plans": experienced_plans_path}
+        fingerprints = {name: _input_fingerprint(path, manifest.get("inputs", {}).get(name))
+                        for name, path in input_paths.items()}
+        keys = _parse_stage_keys(fingerprints, bus_fares_df, trip_to_route, fuel_costs, transit_vehicles)
+        dirty = _dirty_parse_stages(keys, manifest, output_folder_path, output_format)
+        print("Rebuilding the {} stages".format([stage for stage in PARSE_STAGES if dirty[stage]]))
+        # forget the stages being rebuilt, in case the parse is interrupted while their files are being written
+        _write_parse_manifest(output_folder_path, {
+            "output_format": output_format, "inputs": fingerprints,
+            "stages": {stage: keys[stage] for stage in PARSE_STAGES if not dirty[stage]}})
+    else:
+        dirty = {stage: True for stage in PARSE_STAGES}
+
+    # the dataframes are written in the background as soon as they are final, and all written when leaving the block
+    with OutputWriter(output_folder_path, output_format) as writer:
+        if dirty["persons"]:
+            persons_attributes_df = extract_person_dataframes(output_plans_path, persons_path, households_path,
+                                                              output_folder_path, output_format, writer)
+        else:
+            persons_attributes_df = read_dataframe(output_folder_path, "persons_dataframe", output_format)
+
+        # the trips are parsed again to rebuild the legs (and the trips dataframe if it is missing)
+        trips_df = None
+        if dirty["plans"]:
+            activities_df, trips_df = extract_activities_trips_dataframes(experienced_plans_path, output_folder_path,
+                                                                          output_format, writer)
+        else:
+            activities_df = read_dataframe(output_folder_path, "activities_dataframe", output_format)
+            if dirty["legs"] or return_diagnostics or \
+                    not dataframe_path(output_folder_path, "trips_dataframe", output_format).exists():
+                _, trips_df = get_activities_trips_output(experienced_plans_path)
+
+        ridehail_diagnostics_df = None
+        if dirty["legs"]:
+            all_events_df = load_events(events_path, Path(output_folder_path) / EVENTS_CACHE_FOLDER)
+            legs_output = get_legs_output(all_events_df, trips_df, engine=engine, n_jobs=n_jobs,
+                                          return_diagnostics=return_diagnostics, transit_vehicles=transit_vehicles)
+            legs_df, path_traversal_df = legs_output[:2]
+            if return_diagnostics:
+                ridehail_diagnostics_df = legs_output[2]
+        else:
+            legs_df = read_dataframe(output_folder_path, "legs_dataframe", output_format)
+            path_traversal_df = read_dataframe(output_folder_path, "path_traversals_dataframe", output_format)
+            if return_diagnostics:
+                all_events_df = load_events(events_path, Path(output_folder_path) / EVENTS_CACHE_FOLDER)
+                ridehail_diagnostics_df = get_ridehail_diagnostics(all_events_df, trips_df, transit_vehicles)
+
+        if dirty["fuel"]:
+            path_traversal_df = calc_fuel_costs(path_traversal_df, fuel_costs)
+            legs_df = calc_fuel_costs(legs_df, fuel_costs)
+            writer.write(path_traversal_df, "path_traversals_dataframe")
+        if dirty["fares"]:
+            legs_df = calc_fares(legs_df, RIDE_HAIL_FARES, bus_fares_df, persons_attributes_df, trip_to_route)
+        if dirty["fuel"] or dirty["fares"]:
+            writer.write(legs_df, "legs_dataframe")
+
+        if dirty["trips"]:
+            if trips_df is None:
+                trips_df = _trips_from_dataframe(read_dataframe(output_folder_path, "trips_dataframe", output_format))
+            final_trips_df = merge_legs_trips(legs_df, trips_df)
+            writer.write(final_trips_df, "trips_dataframe")
+        else:
+            final_trips_df = read_dataframe(output_folder_path, "trips_dataframe", output_format)
 
-    bus_fares_df = parse_bus_fare_input(bus_fares_data_df, route_ids)
-    legs_df = extract_legs_dataframes(events_path, trips_df, persons_attributes_df, bus_fares_df, trip_to_route, fuel_costs, output_folder_path)
+    if incremental:
+        _write_parse_manifest(output_folder_path, {"output_format": output_format, "inputs": fingerprints,
+                                                   "stages": keys})
 
-    final_trips_df = merge_legs_trips(legs_df, trips_df)
-    final_trips_df.to_csv(str(output_folder_path) +'/trips_dataframe.csv')
-    print("trips_dataframe.csv generated")
\ No newline at end of file
+    # the same dtypes whether the dataframes were rebuilt or read back, whatever the output format
+    return ParsedOutputs(normalize_dtypes(persons_attributes_df), normalize_dtypes(activities_df),
+                         normalize_dtypes(legs_df), normalize_dtypes(path_traversal_df),
+                         normalize_dtypes(final_trips_df), ridehail_diagnostics_df)
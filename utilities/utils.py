@@ -1,4 +1,6 @@
 import functools
+import hashlib
+import os
 
 
 def lazyprop(fn):
@@ -13,3 +15,31 @@ def lazyprop(fn):
         return getattr(self, attr_name)
 
     return _lazyprop
+
+
+def file_fingerprint(path, digest=True, block_size=1 << 20):
+    """Identifies the content of a file by its size, modification time and (optionally) SHA-1 digest.
+
+    Parameters
+    ----------
+    path : pathlib.Path object or str
+        Path of the file
+    digest : bool
+        Whether to read the whole file to compute its SHA-1 digest
+    block_size : int
+        Number of bytes read at a time to compute the digest
+
+    Returns
+    -------
+    dict
+        "size" (bytes), "mtime" (nanoseconds) and, if `digest` is True, "sha1" of the file
+    """
+    stat = os.stat(str(path))
+    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if digest:
+        sha1 = hashlib.sha1()
+        with open(str(path), "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                sha1.update(block)
+        fingerprint["sha1"] = sha1.hexdigest()
+    return fingerprint